@@ -85,10 +85,12 @@ setup(
   ],
   packages = [
     "deso.execute",
+    "deso.execute.bench",
     "deso.execute.test",
   ],
   package_dir = {
     "deso.execute": join("src", "deso", "execute"),
+    "deso.execute.bench": join("src", "deso", "execute", "bench"),
     "deso.execute.test": join("src", "deso", "execute", "test"),
   },
   test_suite = "deso.execute.test.allTests",
@@ -20,14 +20,47 @@
 """Initialization file for the deso.execute package."""
 
 
+from deso.execute.async_ import (
+  executeAsync,
+  pipelineAsync,
+  springAsync,
+)
+from deso.execute.batch import (
+  PipelineBatch,
+)
 from deso.execute.execute_ import (
   execute,
+  FORK,
   formatCommands,
+  HEAD,
+  OutputLimitError,
   pipeline,
+  pipelineIter,
   ProcessError,
+  ProcessTimeoutError,
+  RAISE,
+  Result,
+  run,
+  setDefaultLauncher,
+  SPAWN,
   spring,
+  springIter,
+  TAIL,
+)
+from deso.execute.fanout_ import (
+  fanout,
+)
+from deso.execute.server import (
+  ForkServer,
+)
+from deso.execute.template import (
+  Command,
+  Pipeline,
 )
 from deso.execute.util import (
+  clearCommandCache,
+  commandCacheInfo,
   findCommand,
+  findCommands,
   isExecutable,
 )
@@ -0,0 +1,381 @@
+# async_.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Functions for command execution on top of asyncio.
+
+  The functions provided here are the asynchronous counterparts of
+  execute, pipeline, and spring. Instead of polling the file descriptors
+  of the pipes connecting us with the started processes ourselves, they
+  are registered with the running event loop. Processes are reaped
+  without blocking the event loop, either by means of a pidfd (if
+  supported) or by periodically checking for their termination.
+"""
+
+from asyncio import (
+  ensure_future,
+  gather,
+  get_running_loop,
+  sleep,
+  wait,
+)
+from deso.cleanup import (
+  defer,
+)
+from deso.execute.execute_ import (
+  _decodeStatus,
+  EXEC_FAIL,
+  _flatten,
+  _handle,
+  _isSource,
+  _launchFunction,
+  _openSource,
+  _OUT,
+  _output,
+  _pidfd,
+  _pipeline,
+  _PipelineFileDescriptors,
+  _pump,
+  _pumpData,
+  _stages,
+  _terminated,
+  _wait,
+  _wait4,
+)
+from os import (
+  close as close_,
+  O_CLOEXEC,
+  pipe2,
+  WNOHANG,
+)
+from select import (
+  POLLIN,
+  POLLOUT,
+)
+
+
+# The maximum delay between two checks for the termination of a process
+# in case we cannot use a pidfd.
+_MAX_DELAY = 0.1
+
+
+def _tryWaitpid(pid):
+  """Check whether a process terminated and retrieve its status and resource usage if so."""
+  pid_, status, usage = _wait4(pid, WNOHANG)
+  if pid_ == 0:
+    return None
+
+  assert pid_ == pid
+  status = _decodeStatus(status)
+  return (status, usage) if status is not None else None
+
+
+async def _waitpid(pid):
+  """Wait for a process to terminate without blocking the event loop.
+
+    The process' status is returned along with its resource usage.
+  """
+  # If the kernel does not support pidfds, we fall back to polling.
+  fd = _pidfd(pid)
+  try:
+    delay = 0.001
+
+    while True:
+      result = _tryWaitpid(pid)
+      if result is not None:
+        return result
+
+      if fd is not None:
+        # A pidfd becomes readable once the process terminated.
+        loop = get_running_loop()
+        future = loop.create_future()
+        loop.add_reader(fd, lambda: future.done() or future.set_result(None))
+        try:
+          await future
+        finally:
+          loop.remove_reader(fd)
+      else:
+        await sleep(delay)
+        delay = min(2 * delay, _MAX_DELAY)
+  finally:
+    if fd is not None:
+      close_(fd)
+
+
+async def _pumpSource(source, out, reader=None):
+  """Move all data of a file source to the given file descriptor.
+
+    If 'reader' is given, it is the ID of the process reading the data.
+    We stop once it terminated, as we would wait for the file
+    descriptor to become writable forever otherwise.
+  """
+  loop = get_running_loop()
+  data = _pumpData(source, out)
+  delay = 0.001
+
+  while True:
+    future = loop.create_future()
+    loop.add_writer(out, lambda: future.done() or future.set_result(None))
+    try:
+      done, _ = await wait([future], timeout=delay if reader is not None else None)
+    finally:
+      loop.remove_writer(out)
+
+    if not done:
+      # Note that the process is not reaped here, we only check whether
+      # it terminated.
+      if _terminated(reader):
+        return
+
+      delay = min(2 * delay, _MAX_DELAY)
+      continue
+
+    try:
+      if _pump(data):
+        return
+    except BrokenPipeError:
+      # Nobody is interested in our output anymore.
+      return
+
+
+async def _poll(fds):
+  """Handle all data of a set of pipes until each indicated that it is done."""
+  loop = get_running_loop()
+  done = loop.create_future()
+  # A mapping from file descriptor to the function for removing it from
+  # the event loop.
+  pending = {}
+
+  def handle(fd, data, event):
+    """Handle an event for one of our pipes."""
+    try:
+      if _handle(data, event):
+        pending.pop(fd)(fd)
+        if not pending:
+          done.set_result(None)
+    except Exception as e:
+      if not done.done():
+        done.set_exception(e)
+
+  for fd, events, data in fds.channels():
+    if events == _OUT:
+      loop.add_writer(fd, handle, fd, data, POLLOUT)
+      pending[fd] = loop.remove_writer
+    else:
+      loop.add_reader(fd, handle, fd, data, POLLIN)
+      pending[fd] = loop.remove_reader
+
+  try:
+    if pending:
+      await done
+  finally:
+    for fd, remove in pending.items():
+      remove(fd)
+
+
+class _Unpolled:
+  """A stand-in for a multiplexer, for file descriptors polled by the event loop.
+
+    The pipes of a command run asynchronously are registered with the
+    running event loop instead (see _poll), so any registration with a
+    multiplexer is simply ignored.
+  """
+  def register(self, fd, events, handler):
+    """Ignore the registration of a file descriptor."""
+    pass
+
+
+  def unregister(self, fd):
+    """Ignore the removal of a file descriptor."""
+    pass
+
+
+_UNPOLLED = _Unpolled()
+
+
+async def _reapAll(pids, reaped, usage):
+  """Wait for all processes in a list, recording their statuses and resource usage."""
+  results = await gather(*[_waitpid(pid) for pid in pids])
+  for pid, (status, usage_) in zip(pids, results):
+    reaped[pid] = status
+    usage[pid] = usage_
+
+
+async def executeAsync(*args, env=None, stdin=None, stdout=None, stderr=b"", launcher=None,
+                       usage=None):
+  """Execute a program asynchronously."""
+  return await pipelineAsync([list(args)], env, stdin, stdout, stderr, launcher,
+                             usage=usage)
+
+
+async def pipelineAsync(commands, env=None, stdin=None, stdout=None, stderr=b"", launcher=None,
+                        usage=None):
+  """Execute a pipeline asynchronously.
+
+    Please refer to pipeline for a description of the parameters and
+    the return value.
+  """
+  launch = _launchFunction(launcher)
+
+  with defer() as later:
+    with defer() as here:
+      fds = _PipelineFileDescriptors(later, here, stdin, stdout, stderr, _UNPOLLED)
+      pids, status, failed = _pipeline(commands, env, fds.stdin, fds.stdout,
+                                       fds.stderr, fds.interr, launch)
+
+    # We always reap all processes, even if polling for data failed.
+    reaped, usage_ = {}, {}
+    try:
+      await _poll(fds)
+    except BaseException:
+      # Our ends of the pipes are closed first, so that no process
+      # blocks writing to a pipe nobody reads anymore.
+      later.destroy()
+      await _reapAll(pids, reaped, usage_)
+      raise
+
+    await _reapAll(pids, reaped, usage_)
+
+    data_out, data_err, int_err = fds.data()
+
+  # All processes got reaped already, so no waiting takes place here.
+  error = data_err if stderr is not None else None
+  _wait(pids, commands, error, int_err, status=status, failed=failed,
+        reaped=reaped, usage=usage_, stages=_stages(pids, commands), out=usage)
+  return _output(stdout, stderr, data_out, data_err)
+
+
+async def _spring(commands, env, fds, later, launch, pids, started, usage):
+  """Execute a spring asynchronously, returning its status and the failed command.
+
+    The IDs of the processes still to wait for are stored in 'pids' as
+    they get started, those of the commands of the spring in 'started',
+    by index. The resource usage of those waited for here is stored in
+    'usage'.
+  """
+  assert len(commands) > 0, commands
+  assert len(commands[0]) > 0, commands
+  assert isinstance(commands[0][0], list) or _isSource(commands[0][0]), commands
+
+  status = 0
+  failed = None
+
+  spring_cmds = commands[0]
+  pipe_cmds = commands[1:]
+  # Just as for the synchronous version, file sources are opened before
+  # any command is started.
+  sources = {
+    i: _openSource(source, later)
+    for i, source in enumerate(spring_cmds) if _isSource(source)
+  }
+
+  # Just as for the synchronous version we need a pipe to connect the
+  # spring's output with the pipeline's input, if there is a pipeline.
+  if pipe_cmds:
+    fd_in_new, fd_out_new = pipe2(O_CLOEXEC)
+  else:
+    fd_out_new = fds.stdout
+
+  try:
+    # In contrast to the synchronous version we can start the pipeline
+    # first. All data is handled by the event loop while we wait for the
+    # individual commands of the spring to finish.
+    if pipe_cmds:
+      launched, status, failed = _pipeline(pipe_cmds, env, fd_in_new, fds.stdout,
+                                           fds.stderr, fds.interr, launch)
+      pids += launched
+      if status != 0:
+        return status, failed
+
+    for i, command in enumerate(spring_cmds):
+      last = i == len(spring_cmds) - 1
+
+      if i in sources:
+        # The first command of the pipeline is the only one reading
+        # what we write.
+        await _pumpSource(sources[i], fd_out_new, pids[0] if pids else None)
+        continue
+
+      pid = launch(command, env, fds.stdin, fd_out_new, fds.stderr, fds.interr)
+      if pid is None:
+        return EXEC_FAIL, command
+
+      started[i] = pid
+      if not last:
+        status, usage[pid] = await _waitpid(pid)
+        if status != 0:
+          return status, command
+      else:
+        # The last command of the spring goes in front of the pipeline,
+        # just like it does in the command list used for reporting.
+        pids[0:0] = [pid]
+  finally:
+    if pipe_cmds:
+      close_(fd_in_new)
+      close_(fd_out_new)
+
+  return status, failed
+
+
+async def springAsync(commands, env=None, stdout=None, stderr=b"", launcher=None,
+                      usage=None):
+  """Execute a spring asynchronously.
+
+    Please refer to spring for a description of the parameters and the
+    return value.
+  """
+  launch = _launchFunction(launcher)
+  pids, started = [], {}
+  reaped, usage_ = {}, {}
+
+  try:
+    with defer() as later:
+      with defer() as here:
+        fds = _PipelineFileDescriptors(later, here, None, stdout, stderr, _UNPOLLED)
+        # Data is handled in the background while the spring is running.
+        poll = ensure_future(_poll(fds))
+        try:
+          status, failed = await _spring(commands, env, fds, later, launch, pids,
+                                         started, usage_)
+        except BaseException:
+          poll.cancel()
+          raise
+
+      # If polling fails, processes are reaped once all of our pipes
+      # got closed (see below).
+      await poll
+      await _reapAll(pids, reaped, usage_)
+
+      data_out, data_err, int_err = fds.data()
+  except BaseException:
+    # If the spring got aborted (e.g., because we got cancelled), the
+    # commands started already are reaped once all of our pipes are
+    # closed, just as the synchronous version does. Otherwise a process
+    # writing to a pipe nobody reads anymore would never terminate.
+    running = [pid for pid in started.values() if pid not in pids] + pids
+    await _reapAll([pid for pid in running if pid not in usage_], reaped, usage_)
+    raise
+
+  heads = [started.get(i) for i in range(len(commands[0]))]
+  piped = [pid for pid in pids if pid not in heads]
+  stages = heads + _stages(piped, commands[1:])
+
+  error = data_err if stderr is not None else None
+  _wait(pids, _flatten(commands), error, int_err, status=status, failed=failed,
+        reaped=reaped, usage=usage_, stages=stages, out=usage)
+  return _output(stdout, stderr, data_out, data_err)
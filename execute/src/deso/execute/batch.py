@@ -0,0 +1,313 @@
+# batch.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Functionality for running many pipelines concurrently.
+
+  A batch comprises any number of independent commands, pipelines, and
+  springs. When run, up to a configurable number of them is executed
+  concurrently, with all their file descriptors being multiplexed by a
+  single poll loop in the calling thread.
+"""
+
+from collections import (
+  deque,
+)
+from deso.cleanup import (
+  defer,
+)
+from deso.execute.execute_ import (
+  _checkOverflow,
+  _checkParallel,
+  _checkSpringTimeouts,
+  _deadlines,
+  _flatten,
+  _launchFunction,
+  _Multiplexer,
+  _output,
+  _pipeline,
+  _PipelineFileDescriptors,
+  _Spring,
+  _stages,
+  _timeouts,
+  _traceLaunch,
+  _wait,
+  _waitpid,
+)
+from functools import (
+  partial,
+)
+from os import (
+  cpu_count,
+)
+
+
+def _capture(max_stdout, max_stderr, overflow, spill, memfd=None, trace=None):
+  """Create the keyword arguments controlling how the data of a job is transferred and traced."""
+  return {
+    "max_stdout": max_stdout,
+    "max_stderr": max_stderr,
+    "overflow": overflow,
+    "spill": spill,
+    "memfd": memfd,
+    "trace": trace,
+  }
+
+
+class _Job:
+  """A pipeline or spring executed as part of a batch."""
+  def __init__(self, commands, env, stdin, stdout, stderr, spring, parallel=None,
+               timeout=None, timeouts=None, grace=5, capture=None, usage=None):
+    """Initialize the job."""
+    self._commands = commands
+    self._env = env
+    self._stdin = stdin
+    self._stdout = stdout
+    self._stderr = stderr
+    self._spring = spring
+    self._parallel = parallel
+    self._timeout = timeout
+    self._timeouts = timeouts
+    self._grace = grace
+    # Keyword arguments controlling how output is captured, as accepted
+    # by _PipelineFileDescriptors.
+    self._capture = capture or {}
+    self._usage = usage
+    self._fds = None
+    self._deadlines = None
+    self._later = None
+    self._run = None
+    self._pids = []
+    self._status = 0
+    self._failed = None
+
+
+  def start(self, mux, launch):
+    """Set up all file descriptors and start the job's processes."""
+    self._later = defer()
+    here = defer()
+
+    launch = _traceLaunch(launch, self._capture.get("trace"))
+    if self._timeout is not None or self._timeouts is not None:
+      launch = partial(launch, group=True)
+
+    try:
+      self._fds = _PipelineFileDescriptors(self._later, here, self._stdin,
+                                           self._stdout, self._stderr, mux,
+                                           **self._capture)
+      self._deadlines = _deadlines(self._fds, self._later, self._commands,
+                                   self._timeout, self._timeouts, self._grace)
+      if self._spring:
+        # The spring takes care of destroying 'here' once it is done.
+        self._run = _Spring(self._commands, self._env, self._fds, self._later,
+                            here, launch, self._parallel, self._deadlines,
+                            self._timeouts)
+        self._run.start()
+      else:
+        fds = self._fds
+        self._pids, self._status, self._failed = _pipeline(
+          self._commands, self._env, fds.stdin, fds.stdout, fds.stderr,
+          fds.interr, launch
+        )
+        for pid in self._pids:
+          fds.watch(pid)
+
+        if self._deadlines is not None:
+          timeouts = _timeouts(self._timeouts)
+          for pid, command, timeout in zip(self._pids, self._commands, timeouts):
+            self._deadlines.add(pid, command, timeout)
+
+        here.destroy()
+    except BaseException:
+      here.destroy()
+      if self._fds is not None:
+        # Processes may have been started already, which we have to reap.
+        self.abort()
+      else:
+        self._later.destroy()
+      raise
+
+
+  @property
+  def done(self):
+    """Check whether the job finished."""
+    if self._run is not None and self._run.active:
+      return False
+
+    return self._fds.done
+
+
+  def finish(self):
+    """Finish the job, returning its result or raising its error."""
+    commands = self._commands
+    pids, status, failed = self._pids, self._status, self._failed
+    stages = _stages(pids, commands)
+
+    if self._run is not None:
+      pids, status, failed = self._run.pids, self._run.status, self._run.failed
+      commands = _flatten(commands)
+      stages = self._run.stages
+
+    data_out, data_err, int_err = self._fds.data()
+    self._later.destroy()
+
+    if self._deadlines is not None:
+      self._deadlines.check(self._commands, self._stdout, self._stderr,
+                            data_out, data_err)
+
+    _checkOverflow(self._fds, self._commands, self._stderr, data_err)
+
+    error = self._fds.error(data_err) if self._stderr is not None else None
+    _wait(pids, commands, error, int_err, status=status, failed=failed,
+          reaped=self._fds.reaped(), usage=self._fds.usage(), stages=stages,
+          out=self._usage)
+    return _output(self._stdout, self._stderr, data_out, data_err)
+
+
+  def abort(self):
+    """Abort the job, closing all file descriptors and reaping all processes."""
+    # Closing all our file descriptors first makes sure that no process
+    # blocks on a pipe to us.
+    self._later.destroy()
+
+    pids = self._pids
+    if self._run is not None:
+      pids = self._run.pids
+      if self._run.active:
+        self._run.abort()
+
+    reaped = self._fds.reaped()
+    for pid in pids:
+      if pid not in reaped:
+        _waitpid(pid)
+
+
+class PipelineBatch:
+  """A batch of independent commands, pipelines, and springs to run concurrently.
+
+    Jobs are added to the batch by means of the execute, pipeline, and
+    spring methods, which accept the same arguments as the equally named
+    functions. Once all jobs were added, the batch can be run, which
+    executes up to 'concurrency' jobs at a time on a single poll loop.
+  """
+  def __init__(self, concurrency=None, launcher=None):
+    """Initialize an empty batch.
+
+      If 'concurrency' is None, the number of CPUs is used.
+    """
+    if concurrency is None:
+      concurrency = cpu_count() or 1
+
+    if concurrency < 1:
+      raise ValueError("Invalid concurrency: {c}".format(c=concurrency))
+
+    self._concurrency = concurrency
+    self._launch = _launchFunction(launcher)
+    self._jobs = []
+
+
+  def __len__(self):
+    """Retrieve the number of jobs in the batch."""
+    return len(self._jobs)
+
+
+  def _add(self, job):
+    """Add a job to the batch, returning its index."""
+    self._jobs += [job]
+    return len(self._jobs) - 1
+
+
+  def execute(self, *args, env=None, stdin=None, stdout=None, stderr=b"",
+              timeout=None, grace=5, max_stdout=None, max_stderr=None,
+              overflow=None, spill=None, memfd=None, usage=None, trace=None):
+    """Add a command to the batch."""
+    return self.pipeline([list(args)], env, stdin, stdout, stderr,
+                         timeout=timeout, grace=grace, max_stdout=max_stdout,
+                         max_stderr=max_stderr, overflow=overflow, spill=spill,
+                         memfd=memfd, usage=usage, trace=trace)
+
+
+  def pipeline(self, commands, env=None, stdin=None, stdout=None, stderr=b"",
+               timeout=None, timeouts=None, grace=5, max_stdout=None,
+               max_stderr=None, overflow=None, spill=None, memfd=None, usage=None,
+               trace=None):
+    """Add a pipeline to the batch.
+
+      Timeouts start once the pipeline is started, not when it is added.
+      A list provided as 'usage' is filled once the job finished.
+    """
+    capture = _capture(max_stdout, max_stderr, overflow, spill, memfd, trace)
+    return self._add(_Job(commands, env, stdin, stdout, stderr, False,
+                          timeout=timeout, timeouts=timeouts, grace=grace,
+                          capture=capture, usage=usage))
+
+
+  def spring(self, commands, env=None, stdout=None, stderr=b"", parallel=None,
+             timeout=None, timeouts=None, grace=5, max_stdout=None,
+             max_stderr=None, overflow=None, spill=None, usage=None, trace=None):
+    """Add a spring to the batch."""
+    _checkParallel(parallel)
+    _checkSpringTimeouts(commands, timeouts)
+    capture = _capture(max_stdout, max_stderr, overflow, spill, trace=trace)
+    return self._add(_Job(commands, env, None, stdout, stderr, True, parallel,
+                          timeout=timeout, timeouts=timeouts, grace=grace,
+                          capture=capture, usage=usage))
+
+
+  def run(self):
+    """Run all jobs of the batch.
+
+      The result is a list containing, in the order in which jobs were
+      added, the value the respective function would have returned or
+      the exception it would have raised (such as a ProcessError).
+      Errors not related to any job in particular (e.g., a failure to
+      poll) abort the entire batch and are raised directly.
+    """
+    mux = _Multiplexer()
+    results = [None] * len(self._jobs)
+    pending = deque(enumerate(self._jobs))
+    active = []
+
+    try:
+      while pending or active:
+        while pending and len(active) < self._concurrency:
+          index, job = pending.popleft()
+          try:
+            job.start(mux, self._launch)
+            active += [(index, job)]
+          except Exception as e:
+            results[index] = e
+
+        finished = [(index, job) for index, job in active if job.done]
+        for index, job in finished:
+          active.remove((index, job))
+          try:
+            results[index] = job.finish()
+          except Exception as e:
+            results[index] = e
+
+        if active and not finished:
+          mux.poll()
+    except BaseException:
+      for _, job in active:
+        job.abort()
+      raise
+    finally:
+      mux.close()
+
+    return results
@@ -0,0 +1,73 @@
+# benchCapture.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Benchmark the throughput of capturing the output of a pipeline."""
+
+from deso.execute import (
+  findCommand,
+  pipeline,
+)
+from deso.execute.bench.util import (
+  formatRecord,
+  MIB as _MIB,
+  RATE,
+  record,
+)
+from time import (
+  perf_counter,
+)
+
+
+_DD = findCommand("dd")
+
+
+def benchCapture(mebibytes, stdout, spill=None):
+  """Capture the given amount of output and return the time it took."""
+  command = [_DD, "if=/dev/zero", "bs=%d" % _MIB, "count=%d" % mebibytes]
+
+  start = perf_counter()
+  out = pipeline([command], stdout=stdout, stderr=None, spill=spill)
+  end = perf_counter()
+
+  # Output read into a buffer is reported as a byte count.
+  size = out if isinstance(out, int) else len(out)
+  assert size == mebibytes * _MIB, size
+  return end - start
+
+
+def results(quick=False):
+  """Run the capture benchmark for a set of output sizes, yielding the results as records."""
+  for mebibytes in (1, 100) if quick else (1, 100, 1024):
+    for name, stdout, spill in (("bytes", b"", None),
+                                ("bytearray", bytearray(), None),
+                                ("spill", b"", _MIB),
+                                ("buffer", memoryview(bytearray(mebibytes * _MIB)), None)):
+      time = benchCapture(mebibytes, stdout, spill)
+      name = "capture/{size} MiB/{name}".format(size=mebibytes, name=name)
+      yield record(name, mebibytes / time, RATE)
+
+
+def main():
+  """Run the capture benchmark."""
+  for record_ in results():
+    print(formatRecord(record_))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,90 @@
+# benchLatency.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Benchmark the latency of executing a command.
+
+  The time it takes to execute a command that does nothing is dominated
+  by starting the process and waiting for it. We measure it for all of
+  our launchers and compare it to subprocess.run. Executing a command
+  through a template, which has its arguments and environment prepared
+  already, is measured as well.
+"""
+
+from deso.execute import (
+  Command,
+  execute,
+  findCommand,
+  FORK,
+  ForkServer,
+  SPAWN,
+)
+from deso.execute.bench.util import (
+  formatRecord,
+  measure,
+  record,
+  SECONDS,
+)
+from os import (
+  environ,
+)
+from subprocess import (
+  DEVNULL,
+  run,
+)
+
+
+_TRUE = findCommand("true")
+
+
+def results(quick=False):
+  """Measure the latency of executing a command, yielding the results as records."""
+  iterations = 20 if quick else 200
+
+  with ForkServer() as server:
+    for name, launcher in (("fork", FORK), ("spawn", SPAWN), ("server", server)):
+      time = measure(lambda: execute(_TRUE, stderr=None, launcher=launcher),
+                     iterations)
+      yield record("latency/execute/{n}".format(n=name), time, SECONDS)
+
+    # Both variants use an explicit environment, as that is what a
+    # template benefits from most.
+    env = dict(environ)
+    for name, launcher in (("fork", FORK), ("spawn", SPAWN), ("server", server)):
+      time = measure(lambda: execute(_TRUE, env=env, stderr=None, launcher=launcher),
+                     iterations)
+      yield record("latency/execute-env/{n}".format(n=name), time, SECONDS)
+
+      true = Command(_TRUE, env=env, stderr=None, launcher=launcher)
+      time = measure(true, iterations)
+      yield record("latency/template/{n}".format(n=name), time, SECONDS)
+
+  # Just as above, all output is redirected to the null device.
+  time = measure(lambda: run([_TRUE], stdout=DEVNULL, stderr=DEVNULL, check=True),
+                 iterations)
+  yield record("latency/subprocess.run", time, SECONDS)
+
+
+def main():
+  """Run the latency benchmark."""
+  for record_ in results():
+    print(formatRecord(record_))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,134 @@
+# benchMultiplexer.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Benchmark the multiplexer with large numbers of file descriptors.
+
+  We measure the time of a single round of polling while a large set of
+  pipes is registered, only one of which is ready, for each backend. In
+  addition, a batch of pipelines is run with enough of them being
+  active at a time to have more than a thousand file descriptors
+  registered, once with the backend being selected automatically and
+  once with poll only.
+"""
+
+from contextlib import (
+  nullcontext,
+)
+from deso.cleanup import (
+  defer,
+)
+from deso.execute import (
+  findCommand,
+  PipelineBatch,
+)
+from deso.execute.bench.util import (
+  formatRecord,
+  measure,
+  record,
+  SECONDS,
+)
+from deso.execute.execute_ import (
+  _EPOLL,
+  epoll,
+  _Multiplexer,
+  _POLL,
+)
+from os import (
+  close as close_,
+  O_CLOEXEC,
+  pipe2,
+  read,
+  write,
+)
+from select import (
+  POLLIN,
+)
+from unittest.mock import (
+  patch,
+)
+
+
+_CAT = findCommand("cat")
+
+
+def _pollOnly():
+  """Keep multiplexers from switching over to epoll."""
+  return patch("deso.execute.execute_._EPOLL_THRESHOLD", float("inf"))
+
+
+def _round(mux, pipes, index):
+  """Make a single pipe readable and poll for the event."""
+  write(pipes[index[0] % len(pipes)][1], b"x")
+  index[0] += 1
+  mux.poll()
+
+
+def _batch(count, data):
+  """Run a batch of pipelines all of which are active at the same time."""
+  batch = PipelineBatch(concurrency=count)
+  for _ in range(count):
+    batch.pipeline([[_CAT]], stdin=data, stdout=b"", stderr=None)
+
+  for result in batch.run():
+    assert result == data, result
+
+
+def results(quick=False):
+  """Measure the multiplexer with many file descriptors, yielding the results as records."""
+  counts = (1024,) if quick else (1024, 4096)
+  backends = [_POLL] + ([_EPOLL] if epoll is not None else [])
+
+  for count in counts:
+    with defer() as d:
+      pipes = []
+      for _ in range(count):
+        fd_in, fd_out = pipe2(O_CLOEXEC)
+        d.defer(close_, fd_in)
+        d.defer(close_, fd_out)
+        pipes += [(fd_in, fd_out)]
+
+      for backend in backends:
+        mux = _Multiplexer(backend)
+        d.defer(mux.close)
+        for fd_in, _ in pipes:
+          mux.register(fd_in, POLLIN, lambda event, fd=fd_in: read(fd, 1))
+
+        time = measure(lambda: _round(mux, pipes, [0]), 1000)
+        name = "multiplexer/{b}/{c} pipes".format(b=backend, c=count)
+        yield record(name, time, SECONDS)
+
+  # Each pipeline registers four file descriptors: stdin, stdout, the
+  # one for reporting exec failures, and a pidfd.
+  count = 256 if quick else 512
+  data = b"x" * 4096
+  for name, context in (("auto", nullcontext), ("poll", _pollOnly)):
+    with context():
+      time = measure(lambda: _batch(count, data), repeat=3)
+      name = "multiplexer/batch/{n}/{c} pipelines".format(n=name, c=count)
+      yield record(name, time, SECONDS)
+
+
+def main():
+  """Run the multiplexer benchmark."""
+  for record_ in results():
+    print(formatRecord(record_))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,83 @@
+# benchPipeline.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Benchmark the throughput of pipelines with large input and output.
+
+  Data is fed into a pipeline of cat commands and read back. For
+  comparison, the same pipeline is run by a shell by means of
+  subprocess.run, in which case data is passed through pipes created
+  by the shell.
+"""
+
+from deso.execute import (
+  findCommand,
+  pipeline,
+)
+from deso.execute.bench.util import (
+  formatRecord,
+  measure,
+  MIB,
+  RATE,
+  record,
+)
+from subprocess import (
+  DEVNULL,
+  PIPE,
+  run,
+)
+
+
+_CAT = findCommand("cat")
+_SH = findCommand("sh")
+
+
+def _pipeline(data, count):
+  """Run a pipeline of cat commands using our pipeline function."""
+  out = pipeline([[_CAT]] * count, stdin=data, stdout=b"", stderr=None)
+  assert len(out) == len(data), len(out)
+
+
+def _shell(data, count):
+  """Run a pipeline of cat commands by means of a shell."""
+  script = " | ".join([_CAT] * count)
+  out = run([_SH, "-c", script], input=data, stdout=PIPE, stderr=DEVNULL,
+            check=True).stdout
+  assert len(out) == len(data), len(out)
+
+
+def results(quick=False):
+  """Measure the throughput of pipelines, yielding the results as records."""
+  mebibytes = 16 if quick else 256
+  data = bytes(mebibytes * MIB)
+
+  for count in (1, 3):
+    for name, function in (("pipeline", _pipeline), ("sh -c", _shell)):
+      time = measure(lambda: function(data, count), repeat=3)
+      name = "throughput/{n}/{c}x cat".format(n=name, c=count)
+      yield record(name, mebibytes / time, RATE)
+
+
+def main():
+  """Run the pipeline throughput benchmark."""
+  for record_ in results():
+    print(formatRecord(record_))
+
+
+if __name__ == "__main__":
+  main()
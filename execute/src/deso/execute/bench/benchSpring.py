@@ -0,0 +1,109 @@
+# benchSpring.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Benchmark springs whose commands produce more than a pipe buffer of output.
+
+  Besides the wall clock time we measure the CPU time spent by the
+  calling process itself (not the children it runs). Waiting for data
+  and for the termination of commands is supposed to be entirely event
+  driven, so the latter should stay a small fraction of the former.
+"""
+
+from deso.execute import (
+  findCommand,
+  spring,
+)
+from deso.execute.bench.util import (
+  formatRecord,
+  measure,
+  MIB as _MIB,
+  record,
+  SECONDS,
+)
+from resource import (
+  getrusage,
+  RUSAGE_SELF,
+)
+from time import (
+  perf_counter,
+)
+
+
+_DD = findCommand("dd")
+_CAT = findCommand("cat")
+_ECHO = findCommand("echo")
+
+
+def _cpuTime():
+  """Retrieve the CPU time (user and system) consumed by this process so far."""
+  usage = getrusage(RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime
+
+
+def benchSpring(heads, mebibytes, pipe_cmds, parallel):
+  """Run a spring and return the wall clock and CPU time it took."""
+  command = [_DD, "if=/dev/zero", "bs=%d" % _MIB, "count=%d" % mebibytes]
+  commands = [[command] * heads] + pipe_cmds
+
+  cpu = _cpuTime()
+  start = perf_counter()
+  out = spring(commands, stdout=b"", stderr=None, parallel=parallel)
+  end = perf_counter()
+  cpu = _cpuTime() - cpu
+
+  assert len(out) == heads * mebibytes * _MIB, len(out)
+  return end - start, cpu
+
+
+def benchScaling(heads, parallel):
+  """Measure the time it takes to run a spring of commands producing little output."""
+  commands = [[[_ECHO, "test"]] * heads, [_CAT]]
+  return measure(lambda: spring(commands, stdout=b"", stderr=None, parallel=parallel),
+                 repeat=3)
+
+
+def results(quick=False):
+  """Run the spring benchmark for a set of configurations, yielding the results as records."""
+  configs = ((4, 1), (16, 4)) if quick else ((4, 1), (16, 4), (4, 64))
+  for heads, mebibytes in configs:
+    for name, pipe_cmds in (("no pipeline", []), ("pipeline", [[_CAT]])):
+      for parallel in (None, 4):
+        wall, cpu = benchSpring(heads, mebibytes, pipe_cmds, parallel)
+        mode = "serial" if parallel is None else "parallel={p}".format(p=parallel)
+        name_ = "spring/{h}x{s} MiB/{n}/{m}".format(h=heads, s=mebibytes, n=name, m=mode)
+        yield record(name_ + "/wall", wall, SECONDS)
+        yield record(name_ + "/cpu", cpu, SECONDS)
+
+  # The time it takes to run a spring should scale linearly with the
+  # number of its commands.
+  for heads in (1, 4, 16) if quick else (1, 4, 16, 64):
+    for parallel in (None, 8):
+      mode = "serial" if parallel is None else "parallel={p}".format(p=parallel)
+      name = "spring/scaling/{h} heads/{m}".format(h=heads, m=mode)
+      yield record(name, benchScaling(heads, parallel), SECONDS)
+
+
+def main():
+  """Run the spring benchmark."""
+  for record_ in results():
+    print(formatRecord(record_))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,166 @@
+# suite.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Run all benchmarks, optionally comparing the results to a baseline.
+
+  Results can be printed in a human readable form or as JSON and they
+  can be saved as a baseline, which subsequent runs can be compared
+  against. A baseline for a reference machine is stored alongside the
+  benchmarks. Comparing results of different machines is of limited
+  use, though.
+"""
+
+from argparse import (
+  ArgumentParser,
+)
+from deso.execute.bench import (
+  benchCapture,
+  benchLatency,
+  benchMultiplexer,
+  benchPipeline,
+  benchSpring,
+)
+from deso.execute.bench.util import (
+  compare,
+  formatRecord,
+)
+from json import (
+  dump,
+  dumps,
+  load,
+)
+from os.path import (
+  dirname,
+  join,
+)
+from platform import (
+  platform,
+  python_version,
+)
+from sys import (
+  argv as sysargv,
+)
+
+
+BENCHMARKS = {
+  "latency": benchLatency,
+  "pipeline": benchPipeline,
+  "capture": benchCapture,
+  "spring": benchSpring,
+  "multiplexer": benchMultiplexer,
+}
+BASELINE = join(dirname(__file__), "baseline.json")
+
+
+def run(names, quick=False, report=None):
+  """Run the given benchmarks, returning all records.
+
+    If 'report' is provided, it is invoked for each record as soon as
+    it is available.
+  """
+  records = []
+  for name in names:
+    for record in BENCHMARKS[name].results(quick):
+      if report is not None:
+        report(record)
+      records += [record]
+
+  return records
+
+
+def _document(records):
+  """Create the JSON document for a list of records."""
+  return {
+    "platform": platform(),
+    "python": python_version(),
+    "results": records,
+  }
+
+
+def main(argv=None):
+  """Run the benchmark suite."""
+  parser = ArgumentParser(prog="deso.execute.bench.suite", description=__doc__)
+  parser.add_argument(
+    "benchmarks", nargs="*", metavar="BENCHMARK",
+    help="The benchmarks to run, out of {b} (default: all)."
+         .format(b=", ".join(BENCHMARKS)),
+  )
+  parser.add_argument(
+    "--quick", action="store_true",
+    help="Use fewer iterations and smaller data sizes.",
+  )
+  parser.add_argument(
+    "--json", action="store_true",
+    help="Print the results as JSON.",
+  )
+  parser.add_argument(
+    "--save", metavar="FILE",
+    help="Save the results as a baseline to FILE.",
+  )
+  parser.add_argument(
+    "--compare", action="store_true",
+    help="Compare the results against the baseline. The exit status is 1 "
+         "if any result regressed by more than the tolerance.",
+  )
+  parser.add_argument(
+    "--baseline", metavar="FILE", default=BASELINE,
+    help="The baseline to compare against (default: the stored baseline).",
+  )
+  parser.add_argument(
+    "--tolerance", type=float, default=0.25,
+    help="The relative regression tolerated when comparing (default: 0.25).",
+  )
+  args = parser.parse_args(sysargv[1:] if argv is None else argv)
+
+  for name in args.benchmarks:
+    if name not in BENCHMARKS:
+      parser.error("invalid benchmark: {n}".format(n=name))
+
+  names = args.benchmarks or list(BENCHMARKS)
+  report = None if args.json else lambda record: print(formatRecord(record))
+  records = run(names, args.quick, report)
+
+  if args.json:
+    print(dumps(_document(records), indent=2))
+
+  if args.save is not None:
+    with open(args.save, "w") as f:
+      dump(_document(records), f, indent=2)
+      f.write("\n")
+
+  if args.compare:
+    with open(args.baseline) as f:
+      baseline = load(f)["results"]
+
+    regressed = False
+    print()
+    for record, old, change in compare(records, baseline):
+      bad = change < -args.tolerance
+      regressed = regressed or bad
+      print("{name:<48s} {old:12.6f} -> {new:12.6f} {unit:<5s} {change:+7.1%}{mark}"
+            .format(name=record["name"], old=old, new=record["value"],
+                    unit=record["unit"], change=change, mark=" !" if bad else ""))
+
+    return 1 if regressed else 0
+
+  return 0
+
+
+if __name__ == "__main__":
+  exit(main())
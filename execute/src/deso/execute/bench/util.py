@@ -0,0 +1,107 @@
+# util.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Utility functionality for benchmarks.
+
+  Each benchmark module provides a 'results' function yielding its
+  measurements as records, i.e., dicts comprising the name of the
+  benchmark case, the measured value, and the unit of the latter. The
+  unit determines whether lower (durations) or higher (rates) values
+  are better.
+"""
+
+from statistics import (
+  median,
+)
+from time import (
+  perf_counter,
+)
+
+
+# Units of measurements, along with whether higher values are better.
+SECONDS = "s"
+RATE = "MiB/s"
+_HIGHER_IS_BETTER = {
+  SECONDS: False,
+  RATE: True,
+}
+
+MIB = 1024 * 1024
+
+
+def record(name, value, unit):
+  """Create a record describing a single measurement."""
+  return {
+    "name": name,
+    "value": value,
+    "unit": unit,
+  }
+
+
+def measure(function, iterations=1, repeat=5):
+  """Measure the time it takes to invoke a function.
+
+    The function is invoked 'iterations' times in a row and the time
+    per invocation is determined. That is repeated 'repeat' times and
+    the median of the results is returned, which makes the result less
+    susceptible to outliers caused by other activity on the system.
+  """
+  times = []
+  for _ in range(repeat):
+    start = perf_counter()
+    for _ in range(iterations):
+      function()
+    times += [(perf_counter() - start) / iterations]
+
+  return median(times)
+
+
+def compare(records, baseline):
+  """Compare records against those of a baseline.
+
+    The result is a list of (record, baseline value, change) triples,
+    with the change being the relative change of the value, positive if
+    the value improved and negative if it regressed. Records without a
+    counterpart in the baseline are skipped.
+  """
+  baseline = {r["name"]: r for r in baseline}
+  result = []
+
+  for record_ in records:
+    old = baseline.get(record_["name"])
+    if old is None or old["unit"] != record_["unit"]:
+      continue
+
+    new, old = record_["value"], old["value"]
+    if old <= 0 or new <= 0:
+      continue
+
+    if _HIGHER_IS_BETTER[record_["unit"]]:
+      change = new / old - 1
+    else:
+      change = old / new - 1
+
+    result += [(record_, old, change)]
+
+  return result
+
+
+def formatRecord(record_):
+  """Format a record in a human readable way."""
+  return "{name:<48s} {value:12.6f} {unit}".format(**record_)
@@ -47,10 +47,25 @@
     ['/bin/dd', 'of=/tmp/output'],
   ]
 
+  Instead of a command, the spring may also contain a file source, that
+  is, a path-like object (such as a pathlib.Path) or a file object, the
+  contents of which are used as if they were the output of a command:
+  [
+    [Path('/tmp/input1'), ['/bin/cat', '/tmp/input2']],
+    ['/bin/tr', 'a', 'a'],
+  ]
+
   Note that executed processes stay alive independently of their parents
   (i.e., the Python instance in our case). That is, if the parent is
   killed the child is unaffected. The prctl PR_SET_PDEATHSIG can be used
   to influence this behavior on a per-child basis.
+
+  Processes can be started by means of different launchers. By default,
+  the classic fork/exec model is used (FORK). Alternatively, processes
+  can be created using posix_spawn (SPAWN), which does not require the
+  page tables of the parent to be copied and is hence considerably
+  cheaper for parents with a large address space. The launcher can be
+  selected on a per-call basis or globally, using setDefaultLauncher.
 """
 
 from contextlib import (
@@ -59,25 +74,70 @@ from contextlib import (
 from deso.cleanup import (
   defer,
 )
+from errno import (
+  EINVAL,
+  ENOSYS,
+  ENOTSOCK,
+)
+from fcntl import (
+  fcntl,
+)
+from functools import (
+  partial,
+)
+from heapq import (
+  heappop,
+  heappush,
+)
+from itertools import (
+  count,
+  repeat,
+)
 from json import (
   dumps,
   loads,
 )
+from math import (
+  ceil,
+)
+from mmap import (
+  mmap,
+  PROT_READ,
+)
 from os import (
+  O_RDONLY,
   O_RDWR,
   O_CLOEXEC,
+  P_PID,
   _exit,
   close as close_,
   devnull,
+  dup,
   dup2,
   execv,
   execve,
   fork,
+  environ,
+  fsdecode,
+  fspath,
+  get_blocking,
+  killpg,
+  lseek,
   open as open_,
+  PathLike,
   pipe2,
   read,
-  waitpid as waitpid_,
+  readv,
+  SEEK_SET,
+  set_blocking,
+  setpgid,
+  unlink,
+  wait4,
+  waitid,
   write,
+  WEXITED,
+  WNOHANG,
+  WNOWAIT,
   WIFCONTINUED,
   WIFEXITED,
   WIFSIGNALED,
@@ -95,11 +155,108 @@ from select import (
   POLLPRI,
   poll,
 )
+from signal import (
+  SIGKILL,
+  SIGPIPE,
+  SIGTERM,
+)
 from sys import (
   stderr as stderr_,
   stdin as stdin_,
   stdout as stdout_,
 )
+from tempfile import (
+  mkstemp,
+)
+from threading import (
+  Thread,
+)
+from time import (
+  monotonic,
+)
+from traceback import (
+  print_exc,
+)
+
+try:
+  from fcntl import (
+    F_GETPIPE_SZ,
+  )
+except ImportError:
+  # F_GETPIPE_SZ is Linux specific and only exported by Python 3.10 and
+  # higher.
+  F_GETPIPE_SZ = None
+
+try:
+  from fcntl import (
+    F_ADD_SEALS,
+    F_SEAL_GROW,
+    F_SEAL_SEAL,
+    F_SEAL_SHRINK,
+    F_SEAL_WRITE,
+  )
+except ImportError:
+  # File sealing is Linux specific and only exported by Python 3.8 and
+  # higher.
+  F_ADD_SEALS = None
+
+try:
+  from os import (
+    POSIX_SPAWN_DUP2,
+    posix_spawn,
+  )
+except ImportError:
+  # posix_spawn is only available on Python 3.8 and higher and not on
+  # all platforms. We just fall back to fork/exec if it is missing.
+  posix_spawn = None
+
+try:
+  from os import (
+    pidfd_open,
+  )
+except ImportError:
+  # pidfd_open is Linux specific and only available on Python 3.9 and
+  # higher. Without it we wait for processes after polling for data.
+  pidfd_open = None
+
+try:
+  from os import (
+    MFD_ALLOW_SEALING,
+    MFD_CLOEXEC,
+    memfd_create,
+  )
+except ImportError:
+  # memfd_create is Linux specific. Without it output is spilled into
+  # an unlinked temporary file instead and input is always written to
+  # a pipe.
+  memfd_create = None
+
+try:
+  from os import (
+    splice,
+    SPLICE_F_NONBLOCK,
+  )
+except ImportError:
+  # splice is Linux specific and only available on Python 3.10 and
+  # higher. Without it spilled output is copied through a buffer.
+  splice = None
+
+try:
+  from select import (
+    epoll,
+  )
+except ImportError:
+  # epoll is Linux specific. Without it we always use poll.
+  epoll = None
+
+try:
+  from os import (
+    sendfile,
+  )
+except ImportError:
+  # sendfile is not available on all platforms. Without it (and splice)
+  # the data of file sources is copied through a buffer.
+  sendfile = None
 
 
 # An error code used when communicating exec* failures from a forked off
@@ -110,6 +267,38 @@ from sys import (
 # fail, causing us to fall back to the regular error reporting path.
 EXEC_FAIL = 127
 
+# The size of the first read from a pipe. Later reads can be larger.
+_READ_SIZE = 4 * 1024
+# The pipe capacity we assume if we cannot query the actual one. This is
+# the default on Linux.
+_PIPE_SIZE = 64 * 1024
+
+# The initial and maximum interval in which to check for the
+# termination of a watched process in case we cannot use a pidfd.
+_REAP_DELAY = 0.001
+_REAP_MAX_DELAY = 0.1
+
+# The amount of output of a command of a parallel spring that we buffer
+# at most before we stop reading from it.
+_SPRING_BUFFER = 1024 * 1024
+
+# The launcher using the classic fork/exec model.
+FORK = "fork"
+# The launcher using posix_spawn.
+SPAWN = "spawn"
+
+# The overflow policy keeping the first bytes of an output exceeding its
+# limit.
+HEAD = "head"
+# The overflow policy keeping the last bytes of an output exceeding its
+# limit.
+TAIL = "tail"
+# The overflow policy stopping to read an output exceeding its limit and
+# raising an OutputLimitError.
+RAISE = "raise"
+
+_POLICIES = (HEAD, TAIL, RAISE)
+
 
 class ProcessError(RuntimeError):
   """A class enhancing a the RuntimeError class with proper attributes for our use case.
@@ -123,7 +312,7 @@ class ProcessError(RuntimeError):
     newline characters will be printed directly as '\n' instead of
     resulting in a line break.
   """
-  def __init__(self, status, name, stderr=None):
+  def __init__(self, status, name, stderr=None, usage=None):
     super().__init__()
 
     # POSIX let's us have an error range of 8 bits. We do not want to
@@ -138,6 +327,7 @@ class ProcessError(RuntimeError):
     # We want to get rid of all leading and trailing newlines
     # occasionally contained in stderr outputs.
     self._stderr = stderr.strip() if stderr is not None else None
+    self._usage = usage
 
 
   def __str__(self):
@@ -173,6 +363,87 @@ class ProcessError(RuntimeError):
     return self._stderr
 
 
+  @property
+  def usage(self):
+    """Retrieve the resource usage of the processes involved, if known.
+
+      The usage is a list containing a resource.struct_rusage object for
+      each command, in the order of the commands, with None for commands
+      for which no process ran (to completion).
+    """
+    return self._usage
+
+
+class ProcessTimeoutError(ProcessError):
+  """An error indicating that a process or a pipeline of them timed out.
+
+    Once a timeout expired, all affected processes are terminated. The
+    error carries the output captured up to that point.
+  """
+  def __init__(self, status, name, timeout, stdout=None, stderr=None):
+    super().__init__(status, name, stderr)
+
+    self._timeout = timeout
+    self._stdout = stdout
+
+
+  def __str__(self):
+    """Convert the error into a human readable string."""
+    s = "[Timeout {timeout}s] {name}"
+    if self.stderr:
+      s += ": '{stderr}'"
+
+    return s.format(timeout=self._timeout, name=self.name, stderr=self.stderr)
+
+
+  @property
+  def timeout(self):
+    """Retrieve the timeout, in seconds, that expired."""
+    return self._timeout
+
+
+  @property
+  def stdout(self):
+    """Retrieve the stdout output captured before the timeout expired, if any."""
+    return self._stdout
+
+
+class OutputLimitError(ProcessError):
+  """An error indicating that the output of a pipeline exceeded its limit.
+
+    This error is only raised for outputs using the RAISE overflow
+    policy. Once the limit is exceeded, the output is no longer read
+    and the pipe it is written to gets closed.
+  """
+  def __init__(self, status, name, stream, limit, stderr=None):
+    super().__init__(status, name, stderr)
+
+    self._stream = stream
+    self._limit = limit
+
+
+  def __str__(self):
+    """Convert the error into a human readable string."""
+    s = "[Limit {limit:d}b exceeded on {stream}] {name}"
+    if self.stderr:
+      s += ": '{stderr}'"
+
+    return s.format(limit=self._limit, stream=self._stream, name=self.name,
+                    stderr=self.stderr)
+
+
+  @property
+  def stream(self):
+    """Retrieve the name of the output that exceeded its limit ("stdout" or "stderr")."""
+    return self._stream
+
+
+  @property
+  def limit(self):
+    """Retrieve the limit, in bytes, that was exceeded."""
+    return self._limit
+
+
 @contextmanager
 def exitOnException(interr):
   """Context manager to exit the program on any exception.
@@ -186,29 +457,33 @@ def exitOnException(interr):
   try:
     yield
   except Exception as e:
-    # Ideally we would want to take the exception, serialize it, and
-    # then deserialize it in the parent and re-raise it. That is not
-    # possible. It is not possible because an exception contains a
-    # 'traceback' object and those cannot be created or cloned or
-    # otherwise manufactured from within Python, probably because they
-    # originate in C. We can create a StackSummary object effectively
-    # capturing most of the information, but we have no way to really
-    # synthesize the same exception (without that the StackSummary
-    # object is pretty much useless). So in the end all we can do is to
-    # provide all the information necessary to recreate the exception
-    # minus the traceback. So that's what we do. Ultimately we need the
-    # exception class' name and the arguments passed to it.
-    serialized = dumps((e.__class__.__name__,) + e.args).encode("ascii")
-    # We separate each exception by a newline. That is required because
-    # multiple child processes may fail and write data but we are only
-    # interested in (and, in fact, can only deal with) the data from the
-    # first child. So on the decoding side we only look at the first
-    # line.
-    write(interr, serialized + b"\n")
-
+    _reportException(interr, e)
     _exit(EXEC_FAIL)
 
 
+def _reportException(interr, e):
+  """Report an exception through the given internal error pipe."""
+  # Ideally we would want to take the exception, serialize it, and
+  # then deserialize it in the parent and re-raise it. That is not
+  # possible. It is not possible because an exception contains a
+  # 'traceback' object and those cannot be created or cloned or
+  # otherwise manufactured from within Python, probably because they
+  # originate in C. We can create a StackSummary object effectively
+  # capturing most of the information, but we have no way to really
+  # synthesize the same exception (without that the StackSummary
+  # object is pretty much useless). So in the end all we can do is to
+  # provide all the information necessary to recreate the exception
+  # minus the traceback. So that's what we do. Ultimately we need the
+  # exception class' name and the arguments passed to it.
+  serialized = dumps((e.__class__.__name__,) + e.args).encode("ascii")
+  # We separate each exception by a newline. That is required because
+  # multiple child processes may fail and write data but we are only
+  # interested in (and, in fact, can only deal with) the data from the
+  # first child. So on the decoding side we only look at the first
+  # line.
+  write(interr, serialized + b"\n")
+
+
 def _exec(*args, env=None):
   """Convenience wrapper around the set of exec* functions."""
   # We do not use the exec*p* set of execution functions here, although
@@ -224,97 +499,471 @@ def _exec(*args, env=None):
     execve(args[0], list(args), env)
 
 
+def _argv(command):
+  """Retrieve the arguments to pass to the OS for a command.
+
+    A command prepared by a template carries its arguments in encoded
+    form already, which is used in favor of the command itself.
+  """
+  return getattr(command, "argv", command)
+
+
+def _decodeStatus(status):
+  """Decode a status as reported by waitpid or wait4.
+
+    None is returned for statuses indicating that the process was
+    stopped or continued.
+  """
+  if WIFEXITED(status):
+    return WEXITSTATUS(status)
+  elif WIFSIGNALED(status):
+    # Signals are usually represented as the negated signal number.
+    return -WTERMSIG(status)
+  elif WIFSTOPPED(status) or WIFCONTINUED(status):
+    return None
+  else:
+    assert False
+    return 1
+
+
+# Processes started on our behalf by a fork server, mapped to the
+# server to retrieve their status from. As they are not our children,
+# we cannot wait for them ourselves. Stages of a pipeline run in a
+# thread are registered here as well.
+_foreign = {}
+
+
+def _wait4(pid, options):
+  """Wait for a process just like wait4 does, be it a child of ours or one of a fork server."""
+  server = _foreign.get(pid)
+  if server is None:
+    return wait4(pid, options)
+
+  result = server.wait4(pid, options)
+  if result[0] != 0:
+    del _foreign[pid]
+  return result
+
+
+def _pidfd(pid):
+  """Open a file descriptor becoming readable once a process terminated.
+
+    None is returned if no such file descriptor can be provided. For a
+    process that is not a child of ours, the file descriptor is provided
+    by its owner (see _foreign). We never open a pidfd for it, as such a
+    pidfd would become readable before the owner is able to report the
+    process' status and its ID may even have been reused already.
+  """
+  owner = _foreign.get(pid)
+  if owner is not None:
+    pidfd = getattr(owner, "pidfd", None)
+    return pidfd(pid) if pidfd is not None else None
+
+  if pidfd_open is not None:
+    try:
+      return pidfd_open(pid)
+    except OSError:
+      # Linux supports pidfds only since 5.3.
+      pass
+
+  return None
+
+
+def _terminated(pid):
+  """Check whether a process terminated, without reaping it."""
+  server = _foreign.get(pid)
+  if server is None:
+    return waitid(P_PID, pid, WEXITED | WNOHANG | WNOWAIT) is not None
+
+  return server.terminated(pid)
+
+
 def _waitpid(pid):
-  """Convenience wrapper around the original waitpid invocation."""
-  # 0 and -1 trigger a different behavior in waitpid. We disallow those
+  """Wait for a process, returning its status and resource usage.
+
+    We use wait4 instead of waitpid because it reports the resource
+    usage of the process along with its status, at no extra cost.
+  """
+  # 0 and -1 trigger a different behavior in wait4. We disallow those
   # values.
-  assert pid > 0
+  assert pid > 0 or pid in _foreign
 
   while True:
-    pid_, status = waitpid_(pid, 0)
+    pid_, status, usage = _wait4(pid, 0)
     assert pid_ == pid
 
-    if WIFEXITED(status):
-      return WEXITSTATUS(status)
-    elif WIFSIGNALED(status):
-      # Signals are usually represented as the negated signal number.
-      return -WTERMSIG(status)
-    elif WIFSTOPPED(status) or WIFCONTINUED(status):
-      # In our current usage scenarios we can simply ignore SIGSTOP and
-      # SIGCONT by restarting the wait.
-      continue
-    else:
-      assert False
-      return 1
+    status = _decodeStatus(status)
+    # In our current usage scenarios we can simply ignore SIGSTOP and
+    # SIGCONT by restarting the wait.
+    if status is not None:
+      return status, usage
+
+
+def _fork(command, env, fd_in, fd_out, fd_err, fd_interr, group=False):
+  """Start a command in a forked off child process.
+
+    If 'group' is True, the process is made the leader of a new process
+    group.
+  """
+  pid = fork()
+  if pid == 0:
+    with exitOnException(fd_interr):
+      if group:
+        setpgid(0, 0)
+
+      # Note that all pipe file descriptors we create are opened with
+      # O_CLOEXEC and so we do not have to close the originals here, the
+      # exec will take care of that.
+      dup2(fd_in, stdin_.fileno())
+      dup2(fd_out, stdout_.fileno())
+      # Stderr is redirected for all commands because each process'
+      # output should be rerouted and stderr is not affected by the pipe
+      # between the processes in any way.
+      dup2(fd_err, stderr_.fileno())
+
+      _exec(*_argv(command), env=env)
+
+  if group:
+    # We set the process group in the parent as well, to make sure it
+    # is in place once we return, no matter how the child got scheduled.
+    # If the child already managed to exec, the call fails but the group
+    # was set by the child itself.
+    try:
+      setpgid(pid, pid)
+    except OSError:
+      pass
+
+  return pid
+
+
+def _spawn(command, env, fd_in, fd_out, fd_err, fd_interr, group=False):
+  """Start a command using posix_spawn.
+
+    In contrast to the fork based approach, failures to execute the
+    command are reported synchronously by posix_spawn. We report them
+    through the internal error pipe just as a child would and signal the
+    failure by returning None instead of a process ID.
+  """
+  # Just as for _fork, the file descriptors we do not dup2 have the
+  # O_CLOEXEC flag set and do not require an explicit close action.
+  file_actions = [
+    (POSIX_SPAWN_DUP2, fd_in, stdin_.fileno()),
+    (POSIX_SPAWN_DUP2, fd_out, stdout_.fileno()),
+    (POSIX_SPAWN_DUP2, fd_err, stderr_.fileno()),
+  ]
+  # Passing 'setpgroup' makes the process the leader of a new process
+  # group. It only accepts an integer, so we omit it if not needed.
+  kwargs = {"setpgroup": 0} if group else {}
+  # See _exec for why we do not perform any path lookup here.
+  argv = _argv(command)
+  try:
+    return posix_spawn(argv[0], argv,
+                       environ if env is None else env,
+                       file_actions=file_actions, **kwargs)
+  except OSError as e:
+    _reportException(fd_interr, e)
+    return None
+
+
+# Process IDs for the stages of pipelines that run in a thread. They
+# are negative in order to never clash with those of actual processes.
+_stageIds = count(-1, -1)
+
+
+class _Stage:
+  """A Python callable run in a thread as a stage of a pipeline.
+
+    The callable is invoked with a binary file object for reading the
+    stage's input. It is expected to return an iterable of bytes-like
+    objects (e.g., by being a generator), which are written to the
+    stage's output. The stage stands in for a process: it has a
+    (negative) process ID and can be waited for just like a process
+    started by a fork server. Its status mirrors that of a Python
+    interpreter: 1 if an exception got raised (the traceback of which
+    is written to stderr) and -SIGPIPE if the output got closed before
+    all data got written.
+  """
+  def __init__(self, function, fd_in, fd_out, fd_err):
+    """Prepare the stage, without running it yet."""
+    # We work on copies of the file descriptors as the originals are
+    # closed once all commands of the pipeline got started.
+    self._function = function
+    self._in = dup(fd_in)
+    self._out = dup(fd_out)
+    self._err = dup(fd_err)
+    # The write end of the pipe is closed once the stage finished,
+    # making the read end readable, just as a pidfd would be.
+    self._done, self._notify = pipe2(O_CLOEXEC)
+    self._status = None
+    self._thread = Thread(target=self._run, daemon=True)
+    self.pid = next(_stageIds)
+    _foreign[self.pid] = self
+
+
+  def start(self):
+    """Start the thread running the stage."""
+    self._thread.start()
+
+
+  def discard(self):
+    """Discard the stage without ever running it."""
+    for fd in (self._in, self._out, self._err, self._done, self._notify):
+      close_(fd)
+
+    del _foreign[self.pid]
+
+
+  def _run(self):
+    """Run the stage."""
+    # The status is encoded as reported by wait4.
+    status = 0
+    try:
+      with open(self._in, "rb") as stdin, open(self._out, "wb") as stdout:
+        for data in self._function(stdin):
+          stdout.write(data)
+    except BrokenPipeError:
+      status = SIGPIPE
+    except BaseException:
+      status = 1 << 8
+      try:
+        with open(self._err, "w", closefd=False) as stderr:
+          print_exc(file=stderr)
+      except OSError:
+        pass
+    finally:
+      close_(self._err)
+      self._status = status
+      close_(self._notify)
+
+
+  def wait4(self, pid, options):
+    """Wait for the stage to finish, just as os.wait4 does for a process."""
+    if options & WNOHANG and self._status is None:
+      return 0, 0, None
+
+    self._thread.join()
+    close_(self._done)
+    return pid, self._status, None
+
+
+  def terminated(self, pid):
+    """Check whether the stage finished."""
+    return self._status is not None
+
+
+  def pidfd(self, pid):
+    """Retrieve a file descriptor becoming readable once the stage finished."""
+    return dup(self._done)
+
+
+def _stageName(function):
+  """Retrieve a human readable name for a stage run in a thread."""
+  return getattr(function, "__name__", None) or repr(function)
+
+
+_LAUNCHERS = {
+  FORK: _fork,
+  SPAWN: _spawn if posix_spawn is not None else _fork,
+}
+_launcher = FORK
+
+
+def setDefaultLauncher(launcher):
+  """Set the launcher used when none is specified explicitly.
+
+    Besides FORK and SPAWN, the launcher can be a ForkServer.
+  """
+  global _launcher
+
+  if launcher is None:
+    raise ValueError("Invalid launcher: {l}".format(l=launcher))
+
+  _launchFunction(launcher)
+  _launcher = launcher
+
 
+def _launchFunction(launcher):
+  """Retrieve the function for launching processes with the given launcher."""
+  if launcher is None:
+    launcher = _launcher
 
-def execute(*args, env=None, stdin=None, stdout=None, stderr=b""):
+  # A fork server (or any other object providing a launch method with
+  # the signature of _fork) launches processes on our behalf.
+  launch = getattr(launcher, "launch", None)
+  if launch is not None:
+    return launch
+
+  try:
+    return _LAUNCHERS[launcher]
+  except (KeyError, TypeError):
+    raise ValueError("Invalid launcher: {l}".format(l=launcher))
+
+
+def _traceLaunch(launch, trace):
+  """Wrap a launch function to report the start of each process to a tracer.
+
+    The tracer is invoked as trace(event, time, subject), with 'time'
+    being a timestamp as reported by time.monotonic. For each process
+    started, a "fork" event with the time at which we started launching
+    it is reported, with the process ID as the subject. Without a
+    tracer, the launch function is used as is, i.e., tracing comes at
+    no cost when not used.
+  """
+  if trace is None:
+    return launch
+
+  def traced(*args, **kwargs):
+    """Launch a process and report it to the tracer."""
+    time = monotonic()
+    pid = launch(*args, **kwargs)
+    if pid is not None:
+      trace("fork", time, pid)
+    return pid
+
+  return traced
+
+
+def _isSource(obj):
+  """Check whether an object is a file source, i.e., a path-like or a file object."""
+  return isinstance(obj, PathLike) or hasattr(obj, "fileno")
+
+
+def _openSource(source, later):
+  """Retrieve a file descriptor for reading from a file source.
+
+    Paths are opened and the resulting file descriptor is closed by the
+    given defer object. For file objects the underlying file descriptor
+    is used directly.
+  """
+  if isinstance(source, PathLike):
+    fd = open_(source, O_RDONLY | O_CLOEXEC)
+    later.defer(close_, fd)
+    return fd
+
+  return source.fileno()
+
+
+def _isBuffer(obj):
+  """Check whether an object is a buffer to read output into directly.
+
+    Such a buffer is any writable object supporting the buffer protocol,
+    except for a bytearray, to which data is appended instead.
+  """
+  if obj is None or isinstance(obj, (int, bytes, bytearray)):
+    return False
+
+  try:
+    with memoryview(obj) as view:
+      return not view.readonly
+  except TypeError:
+    return False
+
+
+def _sourceName(source):
+  """Retrieve a human readable name for a file source."""
+  if isinstance(source, PathLike):
+    return fsdecode(fspath(source))
+
+  return str(getattr(source, "name", source))
+
+
+def execute(*args, env=None, stdin=None, stdout=None, stderr=b"", launcher=None,
+            timeout=None, grace=5, max_stdout=None, max_stderr=None, overflow=None,
+            spill=None, memfd=None, usage=None, trace=None):
   """Execute a program synchronously."""
   # Note that 'args' is a tuple. We do not want that so explicitly
   # convert it into a list. Then create another list out of this one to
   # effectively have a pipeline.
-  return pipeline([list(args)], env, stdin, stdout, stderr)
+  return pipeline([list(args)], env, stdin, stdout, stderr, launcher,
+                  timeout=timeout, grace=grace, max_stdout=max_stdout,
+                  max_stderr=max_stderr, overflow=overflow, spill=spill,
+                  memfd=memfd, usage=usage, trace=trace)
+
+
+def _pipeline(commands, env, fd_in, fd_out, fd_err, fd_interr, launch):
+  """Run a series of commands connected by their stdout/stdin.
+
+    The function returns the list of process IDs of the started
+    processes along with a status and the failed command. The latter two
+    are only set in case a command could not be launched, in which case
+    no further commands are started.
+    Commands that are callables are run in a thread (see _Stage). The
+    threads are started only after all processes got launched, as
+    forking a process with multiple threads is best avoided.
+  """
+  stages = []
+  try:
+    result = _launchPipeline(commands, env, fd_in, fd_out, fd_err, fd_interr,
+                             launch, stages)
+  except BaseException:
+    # Nobody is going to wait for the stages, so they are never run.
+    for stage in stages:
+      stage.discard()
+    raise
+
+  for stage in stages:
+    stage.start()
+
+  return result
 
 
-def _pipeline(commands, env, fd_in, fd_out, fd_err, fd_interr):
-  """Run a series of commands connected by their stdout/stdin."""
+def _launchPipeline(commands, env, fd_in, fd_out, fd_err, fd_interr, launch, stages):
+  """Launch the commands of a pipeline, collecting the stages to run in 'stages'."""
   pids = []
-  first = True
 
   for i, command in enumerate(commands):
     last = i == len(commands) - 1
 
-    # If there are more commands upcoming then we need to set up a pipe.
+    # If there are more commands upcoming then we need to set up a pipe
+    # to establish a communication channel with the next process.
     if not last:
       fd_in_new, fd_out_new = pipe2(O_CLOEXEC)
+    else:
+      fd_out_new = fd_out
 
-    pids += [fork()]
-    child = pids[-1] == 0
-
-    if child:
-      with exitOnException(fd_interr):
-        if not first:
-          # Establish communication channel with previous process.
-          dup2(fd_in_old, stdin_.fileno())
-          close_(fd_in_old)
-          close_(fd_out_old)
-        else:
-          dup2(fd_in, stdin_.fileno())
-
-        if not last:
-          # Establish communication channel with next process.
-          close_(fd_in_new)
-          dup2(fd_out_new, stdout_.fileno())
-          close_(fd_out_new)
-        else:
-          dup2(fd_out, stdout_.fileno())
+    try:
+      if callable(command):
+        stage = _Stage(command, fd_in, fd_out_new, fd_err)
+        stages += [stage]
+        pid = stage.pid
+      else:
+        pid = launch(command, env, fd_in, fd_out_new, fd_err, fd_interr)
+    except BaseException:
+      if not last:
+        close_(fd_in_new)
+        close_(fd_out_new)
+      raise
+    finally:
+      # Any pipe to the previous process is of no use to us anymore.
+      if i > 0:
+        close_(fd_in)
+
+    if pid is None:
+      if not last:
+        close_(fd_in_new)
+        close_(fd_out_new)
 
-        # Stderr is redirected for all commands in the pipeline because each
-        # process' output should be rerouted and stderr is not affected by
-        # the pipe between the processes in any way.
-        dup2(fd_err, stderr_.fileno())
+      return pids, EXEC_FAIL, command
 
-        _exec(*command, env=env)
-    else:
-      if not first:
-        close_(fd_in_old)
-        close_(fd_out_old)
-      else:
-        first = False
+    pids += [pid]
 
-      # If there are further commands then update the "old" pipe file
-      # descriptors for future reference.
-      if not last:
-        fd_in_old = fd_in_new
-        fd_out_old = fd_out_new
+    # If there are further commands then update the "old" pipe file
+    # descriptors for future reference.
+    if not last:
+      close_(fd_out_new)
+      fd_in = fd_in_new
 
-  return pids
+  return pids, 0, None
 
 
 def formatCommands(commands):
   """Convert a command, pipeline, or spring into a string."""
   def depth(l, d):
     """Determine the maximum nesting depth of lists."""
+    if _isSource(l) or callable(l):
+      # A file source or a stage run in a thread counts as a command.
+      return d + 1
+
     if not isinstance(l, list):
       return d
 
@@ -337,6 +986,14 @@ def formatCommands(commands):
       in our command set as input parameter and use that as the base to
       determine how to properly format the commands at each level.
     """
+    # A file source takes the place of a command and is formatted like
+    # an input redirection.
+    if _isSource(commands):
+      return "< %s" % _sourceName(commands), 0
+
+    if callable(commands):
+      return _stageName(commands), 0
+
     # We have reached a string (or something else "atomic" in our
     # sense). We can stop here.
     if not isinstance(commands, list):
@@ -363,12 +1020,23 @@ def formatCommands(commands):
   return s
 
 
-def _wait(pids, commands, data_err, int_err, status=0, failed=None):
+def _wait(pids, commands, data_err, int_err, status=0, failed=None, reaped=None,
+          usage=None, stages=None, out=None):
   """Wait for all processes represented by a list of process IDs.
 
     Although it might not seem necessary to wait for any other than the
     last process, we wait for all of them. The main reason is that we
-    want to clean up all left-over zombie processes.
+    want to clean up all left-over zombie processes. Processes that got
+    reaped already (while polling for data), along with their status,
+    can be provided in the form of the 'reaped' dict and are not waited
+    for again. Their resource usage can be provided in the 'usage' dict,
+    which is amended by the resource usage of the processes waited for
+    here.
+    The function returns the resource usage of the processes listed in
+    'stages', which contains a process ID (or None) for each command
+    (of a spring, possibly) and defaults to 'pids'. If a list is
+    provided as 'out', it is extended by the resource usage and
+    returned instead.
 
     Notes:
       We also check the return code of every child process and raise an
@@ -384,26 +1052,70 @@ def _wait(pids, commands, data_err, int_err, status=0, failed=None):
       stage). We set a high priority on reporting potential failures to
       users.
   """
+  if reaped is None:
+    reaped = {}
+  if usage is None:
+    usage = {}
+
+  statuses = []
+  for pid in pids:
+    if pid not in reaped:
+      reaped[pid], usage[pid] = _waitpid(pid)
+    statuses += [reaped[pid]]
+
+  stages = pids if stages is None else stages
+  usage = [usage.get(pid) if pid is not None else None for pid in stages]
+  if out is not None:
+    out += usage
+    usage = out
+
+  _check(statuses, commands, data_err, int_err, status=status, failed=failed,
+         usage=usage)
+  return usage
+
+
+def _stages(pids, commands):
+  """Pad a list of process IDs of a pipeline with None for commands that did not run."""
+  return pids + [None] * (len(commands) - len(pids))
+
+
+def _check(statuses, commands, data_err, int_err, status=0, failed=None, usage=None):
+  """Check the statuses of a set of processes and raise an error for the first failure.
+
+    The resource usage of the processes, if provided, is attached to the
+    error.
+  """
   # In case of an error during execution of a spring (no error will be
-  # detected that early in a pipeline) we might have less pids to wait
-  # for than commands passed in because not all commands were executed
-  # yet. Also note that although 'commands' might be a spring (i.e.,
-  # contain a list of commands itself), the number of pids cannot exceed
-  # the top-level length of this list because inside of a spring we
-  # already execute (and wait for) all but the last of these "internal"
-  # commands.
-  assert len(pids) <= len(commands)
+  # detected that early in a pipeline) we might have less statuses to
+  # check than commands passed in because not all commands were
+  # executed yet. Also note that although 'commands' might be a spring
+  # (i.e., contain a list of commands itself), the number of statuses
+  # cannot exceed the top-level length of this list because inside of a
+  # spring we already execute (and wait for) all but the last of these
+  # "internal" commands.
+  assert len(statuses) <= len(commands)
   # If an error status is set we also must have received the failed
   # command.
   assert status == 0 or len(failed) > 0
 
-  for i, pid in enumerate(pids):
-    this_status = _waitpid(pid)
+  for i, this_status in enumerate(statuses):
     if this_status != 0 and status == 0:
-      # Only remember the first failure here, then continue clean up.
+      # Only remember the first failure here.
       failed = commands[i]
       status = this_status
 
+  if int_err and status != EXEC_FAIL:
+    # If a command could not be executed, other commands may fail as a
+    # consequence (e.g., because the pipe they write to got closed). As
+    # the root cause, we always report the exec failure in such a case.
+    # Note that springs report failures of already finished commands
+    # directly and those do not have a status in our list.
+    for i, this_status in enumerate(statuses):
+      if this_status == EXEC_FAIL:
+        failed = commands[i]
+        status = this_status
+        break
+
   if status != 0:
     if status == EXEC_FAIL and int_err:
       # In case of an exec failure we make sure to print information
@@ -430,37 +1142,293 @@ def _wait(pids, commands, data_err, int_err, status=0, failed=None):
 
     error = data_err.decode("utf-8") if data_err is not None else None
     command = formatCommands([failed])
-    raise ProcessError(status, command, error)
+    raise ProcessError(status, command, error, usage)
 
 
 def _write(data):
   """Write data to one of our pipe dicts."""
-  # Note that we are only guaranteed to write PIPE_BUF bytes at a time
-  # without blocking.
-  count = write(data["out"], data["data"][:PIPE_BUF])
+  # The file descriptor we write to is non-blocking. That allows us to
+  # just hand in all remaining data and let the kernel decide how much
+  # of it fits into the pipe, instead of limiting ourselves to the
+  # PIPE_BUF bytes that we are guaranteed to be able to write without
+  # blocking. Note that slicing a memoryview does not copy any data.
+  view = data["data"]
+  try:
+    data["pos"] += write(data["out"], view[data["pos"]:])
+  except BlockingIOError:
+    # Although we were told that the pipe is writable, another party
+    # (e.g., a background process) may have filled it in the meantime.
+    return False
+
+  return data["pos"] >= len(view)
+
+
+def _pipeSize(fd):
+  """Retrieve the capacity of the pipe referenced by the given file descriptor."""
+  if F_GETPIPE_SZ is not None:
+    try:
+      return fcntl(fd, F_GETPIPE_SZ)
+    except OSError:
+      pass
+
+  return _PIPE_SIZE
+
+
+def _readHead(data, size):
+  """Read data from a pipe dict with a limit, keeping only the first bytes."""
+  remaining = data["limit"] - data["count"]
+  if "into" in data and remaining > 0:
+    # We read directly into the user provided buffer, which is exactly
+    # as large as the limit.
+    count = data["count"]
+    return readv(data["in"], [data["into"][count:count + min(size, remaining)]])
+
+  buf = read(data["in"], size)
+  if remaining > 0:
+    data["data"] += buf if len(buf) <= remaining else memoryview(buf)[:remaining]
+
+  return len(buf)
+
+
+def _readTail(data, size):
+  """Read data from a pipe dict with a limit, keeping only the last bytes."""
+  # The ring buffer has the size of the limit. We read directly into it,
+  # wrapping around at its end.
+  view = data["view"]
+  limit = len(view)
+  pos = data["count"] % limit
+  end = pos + min(size, limit)
+  if end <= limit:
+    buffers = [view[pos:end]]
+  else:
+    buffers = [view[pos:], view[:end - limit]]
+
+  return readv(data["in"], buffers)
+
+
+def _spillFile():
+  """Create an anonymous file to spill output into."""
+  if memfd_create is not None:
+    try:
+      return memfd_create("execute", MFD_CLOEXEC)
+    except OSError:
+      pass
+
+  fd, path = mkstemp()
+  unlink(path)
+  return fd
 
-  data["data"] = data["data"][count:]
-  return not data["data"]
+
+def _writeAll(fd, data):
+  """Write all of the given data to a blocking file descriptor."""
+  with memoryview(data) as view:
+    pos = 0
+    while pos < len(view):
+      pos += write(fd, view[pos:])
+
+
+def _spill(data):
+  """Move the data of one of our pipe dicts into a file, where all further data goes."""
+  fd = _spillFile()
+  data["close_file"] = data["later"].defer(close_, fd)
+  data["file"] = fd
+  _writeAll(fd, data["data"])
+  data["written"] = len(data["data"])
+  # The data now lives in the file only and we free our buffer.
+  data["data"] = bytearray()
+
+
+def _readFile(data, size):
+  """Read data from a pipe dict that spilled into a file."""
+  if splice is not None:
+    # Data is moved from the pipe into the file by the kernel, without
+    # ever being copied into our address space.
+    count = splice(data["in"], data["file"], size)
+  else:
+    buf = read(data["in"], size)
+    _writeAll(data["file"], buf)
+    count = len(buf)
+
+  data["written"] += count
+  return count
+
+
+def _pumpData(source, out):
+  """Create a pump dict for moving the data of a source file descriptor to another one."""
+  return {
+    "source": source,
+    "out": out,
+    # Data read from the source but not yet written, if the kernel
+    # cannot move data between the two file descriptors for us.
+    "data": None,
+    "pos": 0,
+    # If the destination is blocking, we may only move as much data at
+    # once as we can write without blocking after a POLLOUT event.
+    "size": PIPE_BUF if get_blocking(out) else _pipeSize(out),
+    "max": _pipeSize(out),
+    "splice": splice is not None,
+    "sendfile": sendfile is not None,
+  }
+
+
+def _pump(data):
+  """Move data from the source of one of our pump dicts to its destination.
+
+    The function returns True once the source is exhausted.
+  """
+  try:
+    if data["data"] is None:
+      if data["splice"]:
+        # With SPLICE_F_NONBLOCK the operation does not block on the
+        # pipe, irrespective of the destination being blocking or not.
+        try:
+          return splice(data["source"], data["out"], data["max"],
+                        flags=SPLICE_F_NONBLOCK) == 0
+        except OSError as e:
+          # Splicing requires one of the file descriptors to be a pipe.
+          if e.errno != EINVAL:
+            raise
+          data["splice"] = False
+
+      if data["sendfile"]:
+        try:
+          return sendfile(data["out"], data["source"], None, data["size"]) == 0
+        except OSError as e:
+          # The source may not support sendfile or, depending on the
+          # platform, the destination has to be a socket.
+          if e.errno not in (EINVAL, ENOSYS, ENOTSOCK):
+            raise
+          data["sendfile"] = False
+
+      buf = read(data["source"], data["size"])
+      if not buf:
+        return True
+
+      data["data"] = memoryview(buf)
+      data["pos"] = 0
+
+    data["pos"] += write(data["out"], data["data"][data["pos"]:])
+    if data["pos"] >= len(data["data"]):
+      data["data"] = None
+  except BlockingIOError:
+    pass
+
+  return False
 
 
 def _read(data):
   """Read data from one of our pipe dicts."""
-  # We use 4 KiB as the maximum buffer size. This is quite a bit smaller
-  # than the 64 KiB that /bin/cat apparently uses (and that seem to be
-  # the default buffer size of pipes on some systems) but we expect way
-  # less high-volume data to be read here (it should be piped directly
-  # to the next process instead of going through a Python buffer). It
-  # still is kind of an arbitrary value. We could also start of with a
-  # small(er) value and increase it with every iteration or, if
-  # performance measurements suggest it, just pick a larger value
-  # altogether.
-  buf = read(data["in"], 4 * 1024)
-  if buf:
+  # We start off reading small chunks because we expect most of the
+  # data read here to be of low volume (high-volume data should rather
+  # be piped directly to the next process instead of going through a
+  # Python buffer). Whenever a read fills the entire chunk, though, we
+  # double the chunk size, up to the capacity of the pipe. That way we
+  # keep the number of system calls low in case larger amounts of data
+  # are to be read.
+  size = data["size"]
+  limit = data["limit"]
+  if "file" in data:
+    count = _readFile(data, size)
+  elif limit is None:
+    buf = read(data["in"], size)
+    # Note that data["data"] is a bytearray and appending to it takes
+    # amortized constant time, as opposed to the linear time it would
+    # take with an immutable bytes object.
     data["data"] += buf
-    return False
+    count = len(buf)
+
+    if "spill" in data and len(data["data"]) > data["spill"]:
+      _spill(data)
+  elif "view" in data:
+    count = _readTail(data, size)
   else:
+    count = _readHead(data, size)
+
+  if count == 0:
     return True
 
+  if count == size and size < data["max"]:
+    data["size"] = min(2 * size, data["max"])
+
+  if limit is not None:
+    data["count"] += count
+    if data["count"] > limit and data["policy"] == RAISE:
+      # We stop reading. The writer will see a broken pipe once we
+      # closed our end.
+      return True
+
+  return False
+
+
+def _rotate(view, pos):
+  """Rotate the contents of a memoryview in place, making 'pos' the new start."""
+  # We only copy the smaller of the two parts.
+  size = len(view)
+  if pos <= size - pos:
+    head = bytes(view[:pos])
+    view[:size - pos] = view[pos:]
+    view[size - pos:] = head
+  else:
+    tail = bytes(view[pos:])
+    view[size - pos:] = view[:pos]
+    view[:size - pos] = tail
+
+
+def _peek(data):
+  """Retrieve a copy of the data read into one of our pipe dicts so far."""
+  if "view" in data:
+    # The ring buffer is left as it is, as more data may be read into it.
+    view = data["view"]
+    pos = data["count"] % len(view)
+    head = bytes(view[pos:]) if data["count"] >= len(view) else b""
+    return bytes(data["data"]) + head + bytes(view[:pos])
+
+  return bytes(data["data"])
+
+
+def _result(data):
+  """Retrieve the data read into one of our pipe dicts."""
+  if "into" in data:
+    # The data was read into a user provided buffer and we report how
+    # many bytes it contains. With the TAIL policy the buffer was used
+    # as a ring buffer and we have to put its contents in order.
+    view = data["into"]
+    if "view" in data:
+      del data["view"]
+      if data["count"] > len(view):
+        _rotate(view, data["count"] % len(view))
+
+    return min(data["count"], len(view))
+
+  if "view" in data:
+    # Move the contents of the ring buffer over, in order. This happens
+    # exactly once, as the ring buffer is gone afterwards.
+    view = data.pop("view")
+    pos = data["count"] % len(view)
+    if data["count"] >= len(view):
+      data["data"] += view[pos:]
+    data["data"] += view[:pos]
+    view.release()
+
+  if "file" in data:
+    # Spilled data is mapped into memory from the file, leaving it to
+    # the kernel to page it in and out as necessary. Once mapped, the
+    # file is no longer needed.
+    mapping = mmap(data["file"], data["written"], prot=PROT_READ)
+    data["close_file"]()
+    return memoryview(mapping)
+
+  if "spill" in data:
+    return memoryview(bytes(data["data"]))
+
+  # If the user provided a bytearray we appended to it directly and hand
+  # it back. Otherwise we convert the data into bytes, just as we got
+  # it. That is the only copy of the read data that we ever make.
+  if data["bytes"]:
+    return bytes(data["data"])
+
+  return data["data"]
+
 
 # The event mask for which to poll for a write channel (such as stdin).
 _OUT = POLLOUT | POLLHUP | POLLERR
@@ -468,6 +1436,95 @@ _OUT = POLLOUT | POLLHUP | POLLERR
 _IN = POLLPRI | POLLHUP | POLLIN
 
 
+def _reap(data):
+  """Reap the process represented by one of our process dicts, if it terminated."""
+  pid, status, usage = _wait4(data["pid"], WNOHANG)
+  if pid == 0:
+    return False
+
+  status = _decodeStatus(status)
+  if status is None:
+    return False
+
+  data["status"] = status
+  data["usage"] = usage
+  return True
+
+
+def _close(data):
+  """Close the file descriptor of one of our pipe or process dicts.
+
+    If the file descriptor is registered with a multiplexer (in which
+    case an "unreg" function is present), it is unregistered first. With
+    epoll, a file descriptor stays registered after being closed as long
+    as the underlying file is still referenced elsewhere, e.g., by a
+    child that did not yet exec.
+  """
+  unreg = data.get("unreg")
+  if unreg is not None:
+    unreg()
+
+  data["close"]()
+
+
+def _handle(data, event):
+  """Handle a poll event for one of our pipe or process dicts.
+
+    The function returns True if the file descriptor got closed, i.e.,
+    if no more events are to be expected for it.
+  """
+  if "pid" in data:
+    # A pidfd becomes readable once the process terminated.
+    if not _reap(data):
+      return False
+
+    _close(data)
+    return True
+
+  close = False
+
+  # Note that reading (POLLIN or POLLPRI) and writing (POLLOUT) are
+  # mutually exclusive operations on a pipe. All can be combined with a
+  # HUP or with other errors (POLLERR or POLLNVAL; even though we did
+  # not subscribe to them), though.
+  if event & POLLOUT or event & POLLERR and "pos" in data:
+    # A pipe we write to whose reader went away may report just an
+    # error, without being writable. Writing to it reports the broken
+    # pipe as such.
+    close = _write(data)
+  elif event & POLLIN or event & POLLPRI:
+    if event & POLLHUP:
+      # In case we received a combination of a data-is-available and a
+      # HUP event we need to make sure that we flush the entire pipe
+      # buffer before we stop the polling. Otherwise we might leave data
+      # unread that was successfully sent to us.
+      # Note that from a logical point of view this problem occurs only
+      # in the receive case. In the write case we have full control over
+      # the file descriptor ourselves and if the remote side closes its
+      # part there is no point in sending any more data.
+      while not _read(data):
+        pass
+    else:
+      close = _read(data)
+
+  # We explicitly (and early, compared to the defers we scheduled
+  # previously) close the file descriptor on POLLHUP, when we received
+  # EOF (for reading), or run out of data to send (for writing).
+  if event & POLLHUP or close:
+    _close(data)
+    close = True
+
+  # All error codes are reported to clients such that they can deal
+  # with potentially incomplete data.
+  if event & (POLLERR | POLLNVAL):
+    string = eventToString(event)
+    error = "Error while polling for new data, event: {s} ({e})"
+    error = error.format(s=string, e=event)
+    raise ConnectionError(error)
+
+  return close
+
+
 def eventToString(events):
   """Convert an event set to a human readable string."""
   errors = {
@@ -481,33 +1538,351 @@ def eventToString(events):
   return "|".join([v for k, v in errors.items() if k & events])
 
 
-class _PipelineFileDescriptors:
-  """This class manages file descriptors for use with any pipeline of commands."""
-  def __init__(self, later, here, stdin, stdout, stderr):
-    """Initialize the pipe infrastructure on demand."""
-    # We got two defer objects here. So here is how it works: Some of
-    # the resources should be freed latest after the pipeline finished
-    # its work. That is what 'here' is for. Others need to be freed
+# The mechanisms a multiplexer can use for waiting for events.
+_POLL = "poll"
+_EPOLL = "epoll"
+
+# The number of registered file descriptors beyond which a multiplexer
+# switches from poll to epoll, if supported. poll hands the entire set
+# of file descriptors to the kernel on every call, making its cost grow
+# with the size of the set. epoll keeps the set in the kernel instead,
+# at the cost of a system call for every change to it, which does not
+# pay off for the handful of file descriptors of a single pipeline.
+_EPOLL_THRESHOLD = 64
+
+
+class _Poll:
+  """A multiplexer backend using poll."""
+  def __init__(self):
+    """Create the poll object."""
+    self._poll = poll()
+
+
+  def register(self, fd, events):
+    """Register a file descriptor for the given events."""
+    self._poll.register(fd, events)
+
+
+  def unregister(self, fd):
+    """Unregister a file descriptor."""
+    self._poll.unregister(fd)
+
+
+  def poll(self, timeout):
+    """Wait for events, with the timeout given in milliseconds (None meaning forever)."""
+    return self._poll.poll(timeout)
+
+
+  def close(self):
+    """Release the backend's resources, of which there are none."""
+    pass
+
+
+class _Epoll:
+  """A multiplexer backend using epoll.
+
+    Events are reported level-triggered, just as they are by poll. Our
+    handlers move a bounded amount of data per event (to honor output
+    limits and to not starve other file descriptors) and rely on being
+    notified again while more data is available. Regular files, which
+    epoll does not support, are always ready, which is how poll treats
+    them as well.
+  """
+  def __init__(self):
+    """Create the epoll object."""
+    self._epoll = epoll()
+    # The events of file descriptors not supported by epoll.
+    self._ready = {}
+
+
+  def register(self, fd, events):
+    """Register a file descriptor for the given events."""
+    try:
+      self._epoll.register(fd, events)
+    except PermissionError:
+      self._ready[fd] = events & (POLLIN | POLLOUT)
+
+
+  def unregister(self, fd):
+    """Unregister a file descriptor."""
+    if self._ready.pop(fd, None) is None:
+      self._epoll.unregister(fd)
+
+
+  def poll(self, timeout):
+    """Wait for events, with the timeout given in milliseconds (None meaning forever)."""
+    ready = [(fd, events) for fd, events in self._ready.items() if events]
+    if ready:
+      timeout = 0
+
+    events = self._epoll.poll(timeout / 1000 if timeout is not None else -1)
+    return events + ready
+
+
+  def close(self):
+    """Close the epoll file descriptor."""
+    self._epoll.close()
+
+
+class _Multiplexer:
+  """A multiplexer dispatching events for any number of file descriptors.
+
+    Besides file descriptors the multiplexer manages timers, which are
+    fired as part of polling once they are due.
+  """
+  def __init__(self, backend=None):
+    """Initialize the multiplexer without any file descriptors.
+
+      The 'backend' used for waiting for events can be forced to be
+      _POLL or _EPOLL. By default, poll is used while only few file
+      descriptors are registered and we switch over to epoll (if
+      supported) once there are more than _EPOLL_THRESHOLD.
+    """
+    if backend not in (None, _POLL, _EPOLL) or (backend == _EPOLL and epoll is None):
+      raise ValueError("Invalid multiplexer backend: {b}".format(b=backend))
+
+    self._backend = _Epoll() if backend == _EPOLL else _Poll()
+    self._switch = backend is None and epoll is not None
+    # A mapping from each registered file descriptor to the function
+    # handling its events and one to the events it is registered for.
+    self._handlers = {}
+    self._events = {}
+    # A heap of timers, each a [deadline, sequence number, function]
+    # list. The sequence number keeps timers with the same deadline in
+    # the order they were scheduled.
+    self._timers = []
+    self._sequence = 0
+
+
+  def __len__(self):
+    """Retrieve the number of registered file descriptors."""
+    return len(self._handlers)
+
+
+  def close(self):
+    """Release the resources of the multiplexer."""
+    self._backend.close()
+
+
+  @property
+  def backend(self):
+    """Retrieve the name of the backend currently in use."""
+    return _EPOLL if isinstance(self._backend, _Epoll) else _POLL
+
+
+  def _upgrade(self):
+    """Switch over from poll to epoll."""
+    backend = _Epoll()
+    try:
+      for fd, events in self._events.items():
+        backend.register(fd, events)
+    except BaseException:
+      backend.close()
+      raise
+
+    self._backend.close()
+    self._backend = backend
+    self._switch = False
+
+
+  def register(self, fd, events, handler):
+    """Register a file descriptor along with a function handling its events."""
+    if self._switch and len(self._handlers) >= _EPOLL_THRESHOLD:
+      self._upgrade()
+
+    self._backend.register(fd, events)
+    self._handlers[fd] = handler
+    self._events[fd] = events
+
+
+  def unregister(self, fd):
+    """Unregister a file descriptor."""
+    self._backend.unregister(fd)
+    del self._handlers[fd]
+    del self._events[fd]
+
+
+  def schedule(self, delay, function):
+    """Schedule a function to be invoked after the given delay (in seconds).
+
+      The returned timer object can be used to cancel the invocation.
+    """
+    timer = [monotonic() + delay, self._sequence, function]
+    self._sequence += 1
+    heappush(self._timers, timer)
+    return timer
+
+
+  def cancel(self, timer):
+    """Cancel a timer scheduled earlier."""
+    # Canceled timers are just marked as such. They are removed once
+    # they become due.
+    timer[2] = None
+
+
+  def poll(self, timeout=None):
+    """Wait for events and dispatch them to the respective handlers.
+
+      The timeout is given in seconds. None means we block until an
+      event arrives or the next timer is due.
+    """
+    if self._timers:
+      delay = max(self._timers[0][0] - monotonic(), 0)
+      timeout = delay if timeout is None else min(timeout, delay)
+
+    if timeout is not None:
+      # We round up in order to not wake up just before a timer is due.
+      timeout = ceil(timeout * 1000)
+
+    for fd, event in self._backend.poll(timeout):
+      # A handler may have unregistered any file descriptor, so we have
+      # to be prepared for events for which no handler exists anymore.
+      handler = self._handlers.get(fd)
+      if handler is not None:
+        handler(event)
+
+    now = monotonic()
+    while self._timers and self._timers[0][0] <= now:
+      _, _, function = heappop(self._timers)
+      if function is not None:
+        function()
+
+
+class _PipelineFileDescriptors:
+  """This class manages file descriptors for use with any pipeline of commands."""
+  def __init__(self, later, here, stdin, stdout, stderr, mux=None,
+               max_stdout=None, max_stderr=None, overflow=None, spill=None,
+               memfd=None, trace=None):
+    """Initialize the pipe infrastructure on demand.
+
+      The file descriptors are polled using the given multiplexer, which
+      may be shared with other users. If none is provided, a new one is
+      created. The amount of data read from stdout and stderr can be
+      limited, with 'overflow' being the policy to apply once a limit
+      is exceeded (by default TAIL, or RAISE for a buffer to read stdout
+      into). Alternatively, stdout data exceeding 'spill' bytes
+      is moved into a file and eventually mapped into memory. Data for
+      stdin larger than 'memfd' bytes is provided through a sealed memfd
+      instead of a pipe. Lifecycle events are reported to 'trace', if
+      given (see _traceLaunch for the events of launching).
+    """
+    # We got two defer objects here. So here is how it works: Some of
+    # the resources should be freed latest after the pipeline finished
+    # its work. That is what 'here' is for. Others need to be freed
     # later (by 'later'), think, the file descriptors we need to poll.
     def pipeWrite(argument, data):
       """Setup a pipe for writing data."""
       data["in"], data["out"] = pipe2(O_CLOEXEC)
-      data["data"] = argument
+      # We work on a flat byte view of the data to write. That way we
+      # support any object implementing the buffer protocol and never
+      # have to copy (parts of) the data.
+      view = memoryview(argument).cast("B")
+      later.defer(view.release)
+      data["data"] = view
+      data["pos"] = 0
+      set_blocking(data["out"], False)
       data["close"] = later.defer(close_, data["out"])
       here.defer(close_, data["in"])
 
-    def pipeRead(argument, data):
+    def fileWrite(argument):
+      """Setup a sealed memfd containing data, if the data is large enough."""
+      with memoryview(argument) as view:
+        if memfd_create is None or view.nbytes <= memfd:
+          return None
+
+        try:
+          fd = memfd_create("stdin", MFD_CLOEXEC | MFD_ALLOW_SEALING)
+        except OSError:
+          return None
+
+        # The file is needed only until the first command got started,
+        # which inherits its own reference to it.
+        here.defer(close_, fd)
+        with view.cast("B") as data:
+          _writeAll(fd, data)
+
+      # The command reads the file through its own file descriptor but
+      # shares the file offset with us.
+      lseek(fd, 0, SEEK_SET)
+      if F_ADD_SEALS is not None:
+        # Sealing guarantees the reader that the contents of the file
+        # stay as they are, making it safe to mmap it, for example.
+        seals = F_SEAL_GROW | F_SEAL_SHRINK | F_SEAL_WRITE | F_SEAL_SEAL
+        fcntl(fd, F_ADD_SEALS, seals)
+      return fd
+
+    def pipeRead(argument, data, limit=None, into=False):
       """Setup a pipe for reading data."""
       data["in"], data["out"] = pipe2(O_CLOEXEC)
-      data["data"] = argument
+      # We always read into a bytearray. If the user supplied one
+      # already we use it directly.
+      data["bytes"] = not isinstance(argument, bytearray)
+      data["data"] = bytearray(argument) if data["bytes"] and not into else argument
+      data["size"] = _READ_SIZE
+      data["max"] = _pipeSize(data["in"])
       data["close"] = later.defer(close_, data["in"])
       here.defer(close_, data["out"])
 
-    # By default we are blockable, i.e., we invoke poll without a
-    # timeout. This property has to be an attribute of the object
-    # because we might want to change it during an invocation of the
-    # poll method that yielded.
-    self._timeout = None
+      if into:
+        # Data is read directly into the given buffer. Its size acts as
+        # the limit.
+        view = memoryview(argument).cast("B")
+        later.defer(view.release)
+        data["data"] = bytearray()
+        data["into"] = view
+        limit = len(view)
+
+      # A limit applies to the data read, not to any initial contents.
+      data["limit"] = limit
+      if limit is not None:
+        # Data not fitting into a user provided buffer is an error unless
+        # another policy was asked for explicitly. Truncating it silently
+        # could easily go unnoticed.
+        policy = overflow if overflow is not None else RAISE if into else TAIL
+        data["count"] = 0
+        data["policy"] = policy
+        if policy == TAIL and limit > 0:
+          data["view"] = data["into"] if into else memoryview(bytearray(limit))
+
+    for limit in (max_stdout, max_stderr):
+      if limit is not None and limit < 0:
+        raise ValueError("Invalid output limit: {l}".format(l=limit))
+
+    if overflow is not None and overflow not in _POLICIES:
+      raise ValueError("Invalid overflow policy: {p}".format(p=overflow))
+
+    if memfd is not None and memfd < 0:
+      raise ValueError("Invalid memfd threshold: {m}".format(m=memfd))
+
+    if spill is not None:
+      if spill < 0:
+        raise ValueError("Invalid spill threshold: {s}".format(s=spill))
+      if max_stdout is not None:
+        raise ValueError("Spilling cannot be combined with an output limit")
+      if isinstance(stdout, bytearray):
+        raise ValueError("Spilling cannot be combined with a bytearray for stdout")
+
+    into = _isBuffer(stdout)
+    if into:
+      if max_stdout is not None:
+        raise ValueError("An output limit cannot be combined with a buffer for stdout")
+      if spill is not None:
+        raise ValueError("Spilling cannot be combined with a buffer for stdout")
+
+    self._later = later
+    if mux is None:
+      mux = _Multiplexer()
+      later.defer(mux.close)
+    self._mux = mux
+    # The number of our file descriptors still registered with the
+    # multiplexer. Processes can be watched at any time, so this count
+    # can increase while we are polling.
+    self._pending = 0
+    self._reaped = {}
+    self._usage = {}
+    self._trace = trace
+    # The stderr data to report errors with, if not all of it.
+    self._marked = None
 
     # We need four dict objects, each representing one of the available
     # std data channels and an internal channel used for error
@@ -535,130 +1910,251 @@ class _PipelineFileDescriptors:
         stderr = null
 
     # At this point stdin, stdout, and stderr are all either a valid
-    # file descriptor (i.e., of type int) or some data.
+    # file descriptor (i.e., of type int) or some data. Stdin may also be
+    # a file source.
 
     # Now, depending on whether we got passed in a file descriptor (an
     # object of type int), remember it or create a pipe to read or write
-    # data.
+    # data. A file source is read by the first command directly.
     if isinstance(stdin, int):
       self._file_in = stdin
+    elif _isSource(stdin):
+      self._file_in = _openSource(stdin, here)
     else:
-      pipeWrite(stdin, self._stdin)
+      self._file_in = fileWrite(stdin) if memfd is not None else None
+      if self._file_in is None:
+        pipeWrite(stdin, self._stdin)
 
     if isinstance(stdout, int):
       self._file_out = stdout
     else:
-      pipeRead(stdout, self._stdout)
+      pipeRead(stdout, self._stdout, max_stdout, into)
+      if spill is not None:
+        self._stdout["spill"] = spill
+        self._stdout["later"] = later
 
     if isinstance(stderr, int):
       self._file_err = stderr
     else:
-      pipeRead(stderr, self._stderr)
+      pipeRead(stderr, self._stderr, max_stderr)
 
     pipeRead(b"", self._interr)
 
+    if trace is not None:
+      for name, data in (("stdin", self._stdin), ("stdout", self._stdout),
+                         ("stderr", self._stderr), ("interr", self._interr)):
+        if data:
+          data["trace"] = name
+
+    for fd, events, data in self.channels():
+      self._register(fd, events, data)
+
   def poll(self):
     """Poll the file pipe descriptors for more data until each indicated that it is done.
 
-      There are two modes in which this method can work. In blocking
-      mode (the default), we will block waiting for new data to become
-      available for processing. In non-blocking mode we yield if no more
-      data is currently available but can resume polling later. The
-      blocking mode can be influenced via the blockable member function.
-      Note that this change can even happen after we yielded execution
-      in the non blockable case.
-
-      Note that because we require non-blocking behavior in order to
-      support springs, this function uses 'yield' instead of 'return'
-      for conveying any results to the caller (even in the blockable
-      case). The reason is a little Python oddity where a function that
-      yields anything (even in a path that is never reached), always
-      implicitly returns a generator rather as opposed to a "direct"
-      result.
+      Polling blocks until events arrive for any of the file
+      descriptors registered with our multiplexer. This method yields
+      after each round of handled events. That allows callers to consume
+      data as it arrives.
     """
-    def pollWrite(data):
-      """Conditionally set up polling for write events."""
-      if data:
-        poll_.register(data["out"], _OUT)
-        data["unreg"] = d.defer(poll_.unregister, data["out"])
-        polls[data["out"]] = data
+    while self._pending:
+      self._mux.poll()
+      yield
 
-    def pollRead(data):
-      """Conditionally set up polling for read events."""
+    yield
+
+
+  def _register(self, fd, events, data, callback=None):
+    """Register a file descriptor with our multiplexer."""
+    def handle(event):
+      """Handle an event for the file descriptor."""
+      if _handle(data, event):
+        self._unregister(data)
+
+        if "pid" in data:
+          self._reaped[data["pid"]] = data["status"]
+          self._usage[data["pid"]] = data["usage"]
+          if self._trace is not None:
+            self._trace("exit", monotonic(), data["pid"])
+          if callback is not None:
+            callback(data["status"])
+
+    if "trace" in data:
+      handle = self._traced(handle, data)
+
+    self._mux.register(fd, events, handle)
+    data["unreg"] = self._later.defer(self._mux.unregister, fd)
+    data["handle"] = handle
+    self._pending += 1
+
+
+  def _traced(self, handle, data):
+    """Wrap the event handler for one of our pipes to report events to the tracer.
+
+      The tracer is told about the first data being available for
+      reading ("output") and about the pipe reaching EOF ("eof"), along
+      with the name of the pipe. EOF on the pipe used for reporting exec
+      failures without any data means that all processes exec'd
+      successfully, which is reported as "exec" instead.
+    """
+    trace = self._trace
+    name = data["trace"]
+    first = [name != "interr"]
+
+    def traced(event):
+      """Handle an event for the pipe, reporting it to the tracer."""
+      time = monotonic()
+      if first[0] and event & POLLIN:
+        first[0] = False
+        trace("output", time, name)
+
+      handle(event)
+
+      if "unreg" not in data:
+        if name != "interr":
+          trace("eof", time, name)
+        elif not data["data"]:
+          trace("exec", time, None)
+
+    return traced
+
+
+  def _unregister(self, data):
+    """Unregister a file descriptor from our multiplexer, if it still is registered."""
+    unreg = data.pop("unreg", None)
+    if unreg is not None:
+      unreg()
+      self._pending -= 1
+
+
+  def closeStdin(self):
+    """Stop writing data to stdin and close the corresponding pipe."""
+    if self._stdin:
+      self._unregister(self._stdin)
+      self._stdin["close"]()
+
+
+  def markStderr(self):
+    """Mark the stderr data read up to now as the data to report errors with.
+
+      All data readily available on the pipe is read first. Data
+      arriving afterwards is still captured but not reported as part of
+      an error.
+    """
+    data = self._stderr
+    if not data:
+      return
+
+    poller = poll()
+    poller.register(data["in"], _IN)
+    while "unreg" in data:
+      events = poller.poll(0)
+      if not events:
+        break
+
+      (_, event), = events
+      data["handle"](event)
+
+    self._marked = _peek(data)
+
+
+  def error(self, data_err):
+    """Retrieve the stderr data to report errors with, given all the data read."""
+    return data_err if self._marked is None else self._marked
+
+
+  def watch(self, pid, callback=None):
+    """Watch a process for termination while polling.
+
+      Processes that are watched are reaped as part of polling, as soon
+      as they terminate, and polling continues until all of them did.
+      The optional callback is invoked with the process' status once it
+      got reaped. If process file descriptors are not supported, we
+      check for the termination of the process periodically instead.
+    """
+    fd = _pidfd(pid)
+    if fd is not None:
+      data = {"in": fd, "pid": pid}
+      data["close"] = self._later.defer(close_, fd)
+      self._register(fd, _IN, data, callback)
+      return
+
+    data = {"pid": pid}
+
+    def check(delay):
+      """Check whether the process terminated."""
+      if _reap(data):
+        self._pending -= 1
+        self._reaped[pid] = data["status"]
+        self._usage[pid] = data["usage"]
+        if self._trace is not None:
+          self._trace("exit", monotonic(), pid)
+        if callback is not None:
+          callback(data["status"])
+      else:
+        delay = min(2 * delay, _REAP_MAX_DELAY)
+        data["timer"] = self._mux.schedule(delay, lambda: check(delay))
+
+    # A process not being a child of ours may have terminated already,
+    # with its status being available right away.
+    delay = 0 if pid in _foreign and _terminated(pid) else _REAP_DELAY
+    data["timer"] = self._mux.schedule(delay, lambda: check(_REAP_DELAY))
+    self._later.defer(lambda: self._mux.cancel(data["timer"]))
+    self._pending += 1
+
+
+  @property
+  def done(self):
+    """Check whether all pipes are closed and all watched processes reaped."""
+    return self._pending == 0
+
+
+  def reaped(self):
+    """Retrieve a dict mapping the IDs of all reaped processes to their status."""
+    return self._reaped
+
+
+  def usage(self):
+    """Retrieve a dict mapping the IDs of all reaped processes to their resource usage."""
+    return self._usage
+
+
+  def channels(self):
+    """Retrieve the pipes to poll as (file descriptor, event mask, pipe dict) triples."""
+    channels = []
+    if self._stdin:
+      channels += [(self._stdin["out"], _OUT, self._stdin)]
+
+    for data in (self._stdout, self._stderr, self._interr):
       if data:
-        poll_.register(data["in"], _IN)
-        data["unreg"] = d.defer(poll_.unregister, data["in"])
-        polls[data["in"]] = data
-
-    poll_ = poll()
-    # We use a dictionary here to elegantly look up the entry (which is,
-    # another dictionary) for the respective file descriptor we received
-    # an event for and to decide if we need to poll more.
-    polls = {}
-
-    with defer() as d:
-      # Set up the polling infrastructure.
-      pollWrite(self._stdin)
-      pollRead(self._stdout)
-      pollRead(self._stderr)
-      pollRead(self._interr)
-
-      while polls:
-        events = poll_.poll(self._timeout)
-
-        for fd, event in events:
-          close = False
-          data = polls[fd]
-
-          # Note that reading (POLLIN or POLLPRI) and writing (POLLOUT)
-          # are mutually exclusive operations on a pipe. All can be
-          # combined with a HUP or with other errors (POLLERR or
-          # POLLNVAL; even though we did not subscribe to them), though.
-          if event & POLLOUT:
-            close = _write(data)
-          elif event & POLLIN or event & POLLPRI:
-            if event & POLLHUP:
-              # In case we received a combination of a data-is-available
-              # and a HUP event we need to make sure that we flush the
-              # entire pipe buffer before we stop the polling. Otherwise
-              # we might leave data unread that was successfully sent to
-              # us.
-              # Note that from a logical point of view this problem
-              # occurs only in the receive case. In the write case we
-              # have full control over the file descriptor ourselves and
-              # if the remote side closes its part there is no point in
-              # sending any more data.
-              while not _read(data):
-                pass
-            else:
-              close = _read(data)
-
-          # We explicitly (and early, compared to the defers we
-          # scheduled previously) close the file descriptor on POLLHUP,
-          # when we received EOF (for reading), or run out of data to
-          # send (for writing).
-          if event & POLLHUP or close:
-            data["close"]()
-            data["unreg"]()
-            del polls[fd]
-
-          # All error codes are reported to clients such that they can
-          # deal with potentially incomplete data.
-          if event & (POLLERR | POLLNVAL):
-            string = eventToString(event)
-            error = "Error while polling for new data, event: {s} ({e})"
-            error = error.format(s=string, e=event)
-            raise ConnectionError(error)
-
-        if self._timeout is not None:
-          yield
+        channels += [(data["in"], _IN, data)]
 
-      yield
+    return channels
+
+
+  def overflowed(self):
+    """Retrieve the (name, limit) pair of an output that exceeded its limit, if any.
+
+      Only outputs using the RAISE overflow policy are considered.
+    """
+    for name, data in (("stdout", self._stdout), ("stderr", self._stderr)):
+      if data and data["limit"] is not None and data["policy"] == RAISE:
+        if data["count"] > data["limit"]:
+          return name, data["limit"]
+
+    return None
+
+
+  @property
+  def captured(self):
+    """Check whether stdout is captured, i.e., read by us through a pipe."""
+    return bool(self._stdout)
 
 
-  def blockable(self, can_block):
-    """Set whether or not polling is allowed to block."""
-    self._timeout = None if can_block else 0
+  @property
+  def mux(self):
+    """Retrieve the multiplexer the file descriptors are registered with."""
+    return self._mux
 
 
   @property
@@ -685,220 +2181,1274 @@ class _PipelineFileDescriptors:
     return self._interr["out"]
 
 
+  def drain(self):
+    """Retrieve and remove the stdout data polled so far."""
+    data = self._stdout["data"]
+    chunk = bytes(data)
+    data.clear()
+    return chunk
+
+
   def data(self):
     """Retrieve the data polled so far as a (stdout, stderr, interr) triple."""
-    return self._stdout["data"] if self._stdout else b"",\
-           self._stderr["data"] if self._stderr else b"",\
-           self._interr["data"]
+    return _result(self._stdout) if self._stdout else b"",\
+           _result(self._stderr) if self._stderr else b"",\
+           _result(self._interr)
+
+
+class _Deadlines:
+  """Deadlines for the processes of a pipeline or spring.
+
+    All processes subject to a deadline are expected to lead a process
+    group of their own. Once a deadline expires, the process groups
+    affected are sent SIGTERM and, if they are still around after a
+    grace period, SIGKILL. The processes are reaped as usual, as part of
+    polling.
+  """
+  def __init__(self, fds, later, timeout, grace):
+    """Initialize the deadlines, with 'timeout' applying to all processes."""
+    self._fds = fds
+    self._later = later
+    self._grace = grace
+    self._pids = []
+    # The first deadline that expired, as a (timeout, process IDs,
+    # command) triple. The command is None for the overall timeout.
+    self.expired = None
+
+    if timeout is not None:
+      self._schedule(timeout, lambda: self._expire(timeout, self._pids, None))
+
+
+  def _schedule(self, delay, function):
+    """Schedule a function to be invoked after a delay, unless we are cleaned up earlier."""
+    mux = self._fds.mux
+    timer = mux.schedule(delay, function)
+    self._later.defer(mux.cancel, timer)
+
+
+  def add(self, pid, command, timeout=None):
+    """Add a process, optionally with a timeout of its own, starting now."""
+    self._pids += [pid]
+
+    if timeout is not None:
+      self._schedule(timeout, lambda: self._expire(timeout, [pid], command))
+
+
+  def _expire(self, timeout, pids, command):
+    """Handle the expiration of a deadline."""
+    pids = list(pids)
+    if self.expired is None:
+      self.expired = timeout, pids, command
+
+    # Terminated processes will not consume any more input. We also do
+    # not want to be bothered by a broken pipe.
+    self._fds.closeStdin()
+
+    self._signal(pids, SIGTERM)
+    self._schedule(self._grace, lambda: self._signal(pids, SIGKILL))
+
+
+  def _signal(self, pids, signal):
+    """Send a signal to the process groups led by the given processes."""
+    for pid in pids:
+      # Stages run in a thread cannot be signaled. They finish once the
+      # processes they read from or write to are gone.
+      if isinstance(_foreign.get(pid), _Stage):
+        continue
+
+      try:
+        killpg(pid, signal)
+      except ProcessLookupError:
+        # All processes of the group are gone already.
+        pass
+
+
+  def check(self, commands, stdout, stderr, data_out, data_err):
+    """Raise a ProcessTimeoutError if a deadline expired."""
+    if self.expired is None:
+      return
+
+    timeout, pids, command = self.expired
+    # We report the status of the first process that got terminated.
+    reaped = self._fds.reaped()
+    statuses = [reaped.get(pid, 0) for pid in pids]
+    status = next((s for s in statuses if s != 0), 0)
+
+    name = formatCommands(commands if command is None else [command])
+    if stdout is None or isinstance(stdout, int):
+      data_out = None
+    if stderr is None:
+      data_err = None
+    else:
+      data_err = data_err.decode("utf-8", "replace")
+
+    raise ProcessTimeoutError(status, name, timeout, data_out, data_err)
+
+
+def _deadlines(fds, later, commands, timeout, timeouts, grace):
+  """Create a _Deadlines object if any timeout is given, None otherwise."""
+  if timeout is None and timeouts is None:
+    return None
+
+  if timeouts is not None and len(timeouts) != len(commands):
+    raise ValueError("Number of timeouts does not match number of commands")
+
+  return _Deadlines(fds, later, timeout, grace)
+
+
+def _checkOverflow(fds, commands, stderr, data_err):
+  """Raise an OutputLimitError if an output exceeded its limit under the RAISE policy."""
+  overflowed = fds.overflowed()
+  if overflowed is None:
+    return
+
+  stream, limit = overflowed
+  # The process writing the output was likely killed by SIGPIPE. We
+  # report the first failure, if any.
+  statuses = fds.reaped().values()
+  status = next((s for s in statuses if s != 0), 0)
+
+  name = formatCommands(commands)
+  if stderr is None:
+    data_err = None
+  else:
+    data_err = data_err.decode("utf-8", "replace")
+
+  raise OutputLimitError(status, name, stream, limit, data_err)
+
 
+def _timeouts(timeouts):
+  """Iterate over a list of per-command timeouts, which may be None."""
+  return iter(timeouts) if timeouts is not None else repeat(None)
 
-def pipeline(commands, env=None, stdin=None, stdout=None, stderr=b""):
+
+def _output(stdout, stderr, data_out, data_err):
+  """Retrieve the value to return to the user given the stdout and stderr arguments."""
+  # We mirror the logic from _PipelineFileDescriptors' __init__ in that
+  # we special case values of None and of type int and treating
+  # everything else as data.
+  stdout_valid = stdout is not None and not isinstance(stdout, int)
+  stderr_valid = stderr is not None and not isinstance(stderr, int)
+
+  if stdout_valid and stderr_valid:
+    return data_out, data_err
+  elif stdout_valid:
+    return data_out
+  elif stderr_valid:
+    return data_err
+
+
+def pipeline(commands, env=None, stdin=None, stdout=None, stderr=b"", launcher=None,
+             timeout=None, timeouts=None, grace=5, max_stdout=None, max_stderr=None,
+             overflow=None, spill=None, memfd=None, usage=None, trace=None):
   """Execute a pipeline, supplying the given data to stdin and reading from stdout & stderr.
 
     This function executes a pipeline of commands and connects their
     stdin and stdout file descriptors as desired. All keyword parameters
     can be either None (in which case they get implicitly redirected
     to/from a null device), a valid file descriptor, or some data. In
-    case data is given (which should be a byte-like object) it will be
+    case data is given (which should be a byte-like object or, in case
+    of stdin, any object supporting the buffer protocol) it will be
     fed into the standard input of the first command (in case of stdin)
     or be used as the initial buffer content of data to read (stdout and
     stderr) of the last command (which means all actually read data will
-    just be appended).
+    just be appended). If a bytearray is supplied for stdout or stderr,
+    data is appended to it in-place and the very object is returned.
+    Any other writable object supporting the buffer protocol (e.g., a
+    memoryview, a writable mmap, or a NumPy array) provided for stdout
+    is filled with the data read, without any intermediate copies, and
+    the number of bytes stored in it is returned. The size of the buffer
+    acts as a limit on the output, just as 'max_stdout' does (see
+    below), except that the default policy is RAISE.
+    Otherwise the read data is returned as bytes.
+    Stdin can also be a file source, i.e., a path-like object (such as
+    a pathlib.Path) or a file object. Paths are opened and the first
+    command reads from the file directly. For file objects, reading
+    starts at the current position of the underlying file descriptor.
+    Either way, the file's data never passes through our process.
+    The 'launcher' parameter selects the mechanism used for starting
+    processes (FORK, SPAWN, or a ForkServer). If it is None, the default
+    launcher as set by setDefaultLauncher is used.
+    A 'timeout' (in seconds) can be set for the pipeline as a whole.
+    Alternatively or in addition, 'timeouts' can be a list containing a
+    timeout (or None) for each command. If a timeout is set, each
+    command runs in a process group of its own. Once a timeout expires,
+    the process groups of all affected commands are sent SIGTERM,
+    followed by SIGKILL if they are still around after 'grace' seconds.
+    Once all processes got reaped, a ProcessTimeoutError containing
+    the output captured so far is raised.
+    The amount of data read from stdout and stderr can be limited to
+    'max_stdout' and 'max_stderr' bytes, respectively. The 'overflow'
+    policy decides what happens to an output exceeding its limit: with
+    HEAD only the first bytes are kept, with TAIL (the default) only the
+    last ones (which, for stderr, are the ones ending up in a
+    ProcessError). With RAISE the output is no longer read once the
+    limit is exceeded and an OutputLimitError is raised after all
+    processes got reaped.
+    For large outputs, a 'spill' threshold (in bytes) can be set
+    instead. Once more than that much data was read from stdout, it is
+    moved into an anonymous file (a memfd, if supported) and all further
+    data is spliced into the latter directly. The captured output is
+    then returned as a read-only memoryview of a memory mapping of the
+    file, keeping it out of the Python heap. For consistency, a
+    memoryview is returned for smaller outputs as well.
+    If stdin data is larger than 'memfd' bytes, it is written into a
+    sealed memfd (if supported) which is then used as the first
+    command's stdin. Instead of us feeding the data through a pipe
+    while polling, the command reads it directly from the file (and
+    could also seek in it or mmap it).
+    If a list is provided as 'usage', it is extended by the resource
+    usage (a resource.struct_rusage object, as reported by wait4) of
+    each command, in order, with None for commands that did not run.
+    The same list is attached to a ProcessError, should one be raised.
+    Lifecycle events of the pipeline can be observed by providing a
+    'trace' function. It is invoked as trace(event, time, subject), with
+    'time' being the time.monotonic timestamp of the event. Events are
+    "fork" (the start of launching a process, with its process ID as
+    the subject), "exec" (all processes exec'd successfully, no
+    subject), "output" (the first data read from "stdout" or "stderr"),
+    "eof" (for "stdin", "stdout", or "stderr"), and "exit" (a process,
+    identified by its ID, got reaped).
+    Instead of a command, a Python callable can be used as a stage of
+    the pipeline, saving a process for small transformations. It is run
+    in a thread, connected to its neighbors through pipes, and invoked
+    with a binary file object for reading its input (iterating over
+    which yields lines). It has to return an iterable of bytes-like
+    objects (e.g., by being a generator) to write to its output. An
+    exception raised by the callable is reported just as the failure
+    of a Python process would be: a ProcessError with status 1 is
+    raised and the traceback is written to stderr. No resource usage
+    is reported for such a stage and it is not subject to timeouts.
   """
+  fds, pids, stages, status, failed, data_out, data_err, int_err = _runPipeline(
+    commands, env, stdin, stdout, stderr, launcher, timeout, timeouts, grace,
+    trace, max_stdout=max_stdout, max_stderr=max_stderr, overflow=overflow,
+    spill=spill, memfd=memfd
+  )
+
+  # We have read or written all data that was available, the last thing
+  # to do is to wait for all the processes to finish and to clean them
+  # up.
+  error = data_err if stderr is not None else None
+  _wait(pids, commands, error, int_err, status=status, failed=failed,
+        reaped=fds.reaped(), usage=fds.usage(), stages=stages, out=usage)
+
+  return _output(stdout, stderr, data_out, data_err)
+
+
+def _runPipeline(commands, env, stdin, stdout, stderr, launcher, timeout, timeouts,
+                 grace, trace, **kwargs):
+  """Run a pipeline until all of its data got transferred.
+
+    The function returns the file descriptors used, the IDs of the
+    processes to wait for, the process IDs by command, the status and
+    failed command of a failed launch, and the data read. Additional
+    keyword arguments are passed to _PipelineFileDescriptors.
+  """
+  launch = _traceLaunch(_launchFunction(launcher), trace)
+  if timeout is not None or timeouts is not None:
+    launch = partial(launch, group=True)
+
   with defer() as later:
     with defer() as here:
       # Set up the file descriptors to pass to our execution pipeline.
-      fds = _PipelineFileDescriptors(later, here, stdin, stdout, stderr)
+      fds = _PipelineFileDescriptors(later, here, stdin, stdout, stderr,
+                                     trace=trace, **kwargs)
+      deadlines = _deadlines(fds, later, commands, timeout, timeouts, grace)
 
       # Finally execute our pipeline and pass in the prepared file
       # descriptors to use.
-      pids = _pipeline(commands, env, fds.stdin, fds.stdout, fds.stderr, fds.interr)
+      pids, status, failed = _pipeline(commands, env, fds.stdin, fds.stdout,
+                                       fds.stderr, fds.interr, launch)
+      # Reap processes as they terminate while we handle their data.
+      for pid in pids:
+        fds.watch(pid)
+
+      if deadlines is not None:
+        for pid, command, timeout_ in zip(pids, commands, _timeouts(timeouts)):
+          deadlines.add(pid, command, timeout_)
 
     for _ in fds.poll():
       pass
 
     data_out, data_err, int_err = fds.data()
 
-  # We have read or written all data that was available, the last thing
-  # to do is to wait for all the processes to finish and to clean them
-  # up.
-  _wait(pids, commands, data_err if stderr is not None else None, int_err)
+  if deadlines is not None:
+    deadlines.check(commands, stdout, stderr, data_out, data_err)
 
-  # We mirror the logic from __init__ in that we special case values of
-  # None and of type int and treating everything else as data.
-  stdout_valid = stdout is not None and not isinstance(stdout, int)
-  stderr_valid = stderr is not None and not isinstance(stderr, int)
+  _checkOverflow(fds, commands, stderr, data_err)
 
-  if stdout_valid and stderr_valid:
-    return data_out, data_err
-  elif stdout_valid:
-    return data_out
-  elif stderr_valid:
-    return data_err
+  stages = _stages(pids, commands)
+  return fds, pids, stages, status, failed, data_out, data_err, int_err
 
 
-def _spring(commands, env, fds):
-  """Execute a series of commands and accumulate their output to a single destination.
+def _stream(fds, poller, lines):
+  """Yield stdout data, in chunks or lines, as it is read by a poller."""
+  def chunks():
+    """Yield chunks of data as they arrive."""
+    for _ in poller:
+      chunk = fds.drain()
+      if chunk:
+        yield chunk
+
+    # Data may have been read before we started iterating the poller.
+    chunk = fds.drain()
+    if chunk:
+      yield chunk
+
+  if not lines:
+    yield from chunks()
+    return
+
+  # We accumulate data in a bytearray to stay linear in the amount of
+  # data even for lines spanning many chunks.
+  rest = bytearray()
+  for chunk in chunks():
+    rest += chunk
+    if b"\n" in chunk:
+      lines_ = bytes(rest).split(b"\n")
+      rest = bytearray(lines_.pop())
+      for line in lines_:
+        yield line + b"\n"
+
+  if rest:
+    yield bytes(rest)
+
+
+def pipelineIter(commands, env=None, stdin=None, stderr=b"", lines=False, launcher=None):
+  """Execute a pipeline and yield the data it writes to stdout as it arrives.
+
+    This function is the streaming counterpart to pipeline. Instead of
+    accumulating all output in memory, it yields chunks of data (or
+    lines, including the line terminator, if 'lines' is True) as they
+    are read. The remaining parameters behave as they do for pipeline.
+    Once the iterator is exhausted or closed, all processes are waited
+    for and errors are reported by means of a ProcessError, just as for
+    pipeline. Note that closing the iterator early closes the pipe the
+    last command writes to, which may very well cause it to fail.
+  """
+  launch = _launchFunction(launcher)
+  pids = None
 
-    Due to the nature of springs control flow here is a bit tricky. We
-    want to execute the first set of commands in a serial manner.
-    However, we need to get the remaining processes running in order to
-    not stall everything (because nobody consumes any of the output).
-    Furthermore, we need to poll for incoming data to be processed. That
-    in turn is a process that must not block. Last but not least,
-    because the first set of commands runs in a serial manner, we need
-    to wait for each process to finish, which might be done with an
-    error code. In such a case we return early but still let the _wait
-    function handle the error propagation.
-  """
-  def pollData(poller):
-    """Poll for new data."""
-    # The poller might become exhausted here under certain
-    # circumstances. We do not care, it will always quit with an
-    # StopIteration exception which we kindly ignore.
-    try:
-      next(poller)
-    except StopIteration:
-      pass
+  try:
+    with defer() as later:
+      with defer() as here:
+        fds = _PipelineFileDescriptors(later, here, stdin, bytearray(), stderr)
+        pids, status, failed = _pipeline(commands, env, fds.stdin, fds.stdout,
+                                         fds.stderr, fds.interr, launch)
+        for pid in pids:
+          fds.watch(pid)
+
+      yield from _stream(fds, fds.poll(), lines)
+  finally:
+    # Waiting happens in any case, even if we got closed early.
+    if pids is not None:
+      _, data_err, int_err = fds.data()
+      error = data_err if stderr is not None else None
+      _wait(pids, commands, error, int_err, status=status, failed=failed,
+            reaped=fds.reaped())
+
+
+class _Spring:
+  """A spring executed in an event driven manner.
+
+    By default, the commands of the spring are started one after the
+    other, each once the previous one terminated successfully and each
+    writing directly into the pipeline following the spring.
+    Termination is detected through the multiplexer the spring's file
+    descriptors are registered with, i.e., no waiting is performed
+    outside of polling. Instead of a command, the spring may contain
+    file sources, the data of which we move to the spring's output as
+    part of polling, once it is their turn.
+
+    If 'parallel' is given, up to that many commands of the spring run
+    concurrently instead, each writing into a pipe of its own. We read
+    from all those pipes and forward the data downstream in the order in
+    which commands were declared, buffering the output of commands whose
+    turn has not yet come. As in the serial case, no more commands are
+    started once one of them failed and the output of the commands
+    following the failed one is discarded.
+  """
+  def __init__(self, commands, env, fds, later, here, launch, parallel=None,
+               deadlines=None, timeouts=None):
+    """Initialize the spring.
+
+      The 'here' defer object is destroyed once the spring is done,
+      i.e., once all of its commands got started (serial case) or once
+      all of their output got forwarded (parallel case), or starting
+      them failed.
+      If 'deadlines' is given, all processes are added to it, with
+      'timeouts' containing the per-command timeouts, if any, in the
+      same structure as the commands. Once a deadline expired, no more
+      commands of the spring are started.
+    """
+    assert len(commands) > 0, commands
+    assert len(commands[0]) > 0, commands
+    assert isinstance(commands[0][0], list) or _isSource(commands[0][0]), commands
+    assert parallel is None or parallel > 0, parallel
+
+    self._commands = commands
+    self._env = env
+    self._fds = fds
+    self._later = later
+    self._here = here
+    self._launch = launch
+    self._parallel = parallel
+    self._deadlines = deadlines
+    self._timeouts = timeouts if timeouts is not None else [None] * len(commands)
+    self._index = 0
+    self._fd_out = None
+    self._reader = None
+    # The currently running (and watched) command of a serial spring.
+    self._head = None
+    # File descriptors for the file sources of the spring, by index. We
+    # open them right away in order to report errors before any command
+    # got started.
+    self._sources = {
+      i: _openSource(source, later)
+      for i, source in enumerate(commands[0]) if _isSource(source)
+    }
+    # The function handling events for the file descriptor we move the
+    # data of a file source to, if one is being pumped.
+    self._pumping = None
+    # The process IDs of the commands of the spring that got started, by
+    # index, and those of the pipeline following it.
+    self._started = {}
+    self._piped = []
+
+    # State of a parallel spring. We keep a dict for each command that
+    # got started, the index of the command whose output we currently
+    # forward, the number of commands running, and the number of
+    # commands that we may start at most (which is lowered once one of
+    # them failed).
+    self._heads = []
+    self._emit = 0
+    self._running = 0
+    self._limit = len(commands[0])
+    self._out = None
+    self._chunk = None
+    self._broken = False
+
+    self.pids = []
+    self.status = 0
+    self.failed = None
+    # A spring stays active until it is done, as described above.
+    self.active = True
+
+
+  def start(self):
+    """Start the pipeline following the spring as well as the first command(s) of the spring."""
+    fds = self._fds
+    pipe_cmds = self._commands[1:]
+
+    # We need a pipe to connect the spring's output with the pipeline's
+    # input, if there is a pipeline following the spring. The pipeline
+    # is started right away. It will just wait for input.
+    if pipe_cmds:
+      fd_in, self._fd_out = pipe2(O_CLOEXEC)
+      self._reader = self._here.defer(close_, fd_in)
+      self._here.defer(close_, self._fd_out)
+
+      pids, status, failed = _pipeline(pipe_cmds, self._env, fd_in, fds.stdout,
+                                       fds.stderr, fds.interr, self._launch)
+      self.pids += pids
+      self._piped = pids
+      for i, pid in enumerate(pids):
+        fds.watch(pid, self._unread if i == 0 else None)
+
+      if self._deadlines is not None:
+        timeouts = self._timeouts[1:]
+        for pid, command, timeout in zip(pids, pipe_cmds, timeouts):
+          self._deadlines.add(pid, command, timeout)
+
+      if status != 0:
+        self._finish(status, failed)
+        return
+    else:
+      self._fd_out = fds.stdout
 
-  assert len(commands) > 0, commands
-  assert len(commands[0]) > 0, commands
-  assert isinstance(commands[0][0], list), commands
+    if self._parallel is None:
+      self._next()
+    else:
+      # We are the only writer of the pipe if we created it or if it is
+      # the one used for capturing stdout, so we can make it
+      # non-blocking. Other file descriptors are left alone and we
+      # write to them in chunks small enough to never block.
+      if pipe_cmds or fds.captured:
+        set_blocking(self._fd_out, False)
 
-  pids = []
-  first = True
-  status = 0
-  failed = None
-  poller = None
-
-  fd_in = fds.stdin
-  fd_out = fds.stdout
-  fd_err = fds.stderr
-  fd_interr = fds.interr
-
-  # A spring consists of a number of commands executed in a serial
-  # fashion with their output accumulated to a single destination and a
-  # (possibly empty) pipeline that processes the output of the spring.
-  spring_cmds = commands[0]
-  pipe_cmds = commands[1:]
-  pipe_len = len(pipe_cmds)
-
-  # We need a pipe to connect the spring's output with the pipeline's
-  # input, if there is a pipeline following the spring.
-  if pipe_cmds:
-    fd_in_new, fd_out_new = pipe2(O_CLOEXEC)
-  else:
-    fd_in_new = fd_in
-    fd_out_new = fd_out
+      self._chunk = PIPE_BUF if get_blocking(self._fd_out) else None
+      self._out = self._channel({"out": self._fd_out, "data": None, "pos": 0}, "out")
+      self._update()
+
+
+  def _expired(self):
+    """Check whether a deadline expired, in which case no more commands are to be started."""
+    return self._deadlines is not None and self._deadlines.expired is not None
+
+
+  @property
+  def stages(self):
+    """Retrieve the process IDs of all commands, in order, with None for those not run."""
+    heads = [self._started.get(i) for i in range(len(self._commands[0]))]
+    return heads + _stages(self._piped, self._commands[1:])
+
+
+  def _launched(self, pid, index):
+    """Remember a just launched command of the spring and subject it to the deadlines, if any."""
+    self._started[index] = pid
+    if self._deadlines is not None:
+      timeouts = self._timeouts[0]
+      timeout = timeouts[index] if timeouts is not None else None
+      self._deadlines.add(pid, self._commands[0][index], timeout)
+
+
+  def _next(self):
+    """Start the next command of a serial spring."""
+    fds = self._fds
+    spring_cmds = self._commands[0]
+
+    if self._expired():
+      self._finish(self.status, self.failed)
+      return
+
+    command = spring_cmds[self._index]
+    last = self._index == len(spring_cmds) - 1
+
+    if self._index in self._sources:
+      self._pumpSource(self._index, lambda: self._pumped(last))
+      return
+
+    pid = self._launch(command, self._env, fds.stdin, self._fd_out,
+                       fds.stderr, fds.interr)
+    if pid is None:
+      self._finish(EXEC_FAIL, command)
+      return
+
+    self._launched(pid, self._index)
 
-  for i, command in enumerate(spring_cmds):
-    last = i == len(spring_cmds) - 1
+    if last:
+      # The last command of the spring is checked along with the
+      # pipeline, just as for a regular pipeline.
+      self.pids[0:0] = [pid]
+      fds.watch(pid)
+      self._finish(0, None)
+      return
 
-    pid = fork()
-    child = pid == 0
+    fds.watch(pid, self._exited)
+    self._head = pid
 
-    if child:
-      with exitOnException(fd_interr):
-        dup2(fd_in, stdin_.fileno())
-        dup2(fd_out_new, stdout_.fileno())
-        dup2(fd_err, stderr_.fileno())
 
-        if pipe_cmds:
-          close_(fd_in_new)
-          close_(fd_out_new)
+  def _pumped(self, last):
+    """Handle the exhaustion of a file source of a serial spring."""
+    if last:
+      self._finish(0, None)
+    else:
+      self._index += 1
+      self._next()
+
+
+  def _pumpSource(self, index, done):
+    """Move the data of a file source to our output, invoking 'done' once it is exhausted."""
+    if self._broken:
+      # Nobody is interested in our output anymore.
+      done()
+      return
+
+    data = _pumpData(self._sources[index], self._fd_out)
+    mux = self._fds.mux
+
+    def writable(event):
+      """Handle a poll event for the file descriptor we move the data to."""
+      try:
+        if event & POLLOUT and not self._broken:
+          if not _pump(data):
+            return
+        else:
+          raise BrokenPipeError()
+      except BrokenPipeError:
+        # Nobody is interested in our output anymore, which we treat
+        # just like the source being exhausted.
+        self._broken = True
+
+      unreg()
+      self._pumping = None
+      done()
+
+    mux.register(self._fd_out, _OUT, writable)
+    unreg = self._later.defer(mux.unregister, self._fd_out)
+    self._pumping = writable
+
+
+  def _unread(self, status):
+    """Handle the termination of the command reading the output of the spring.
 
-        _exec(*command, env=env)
+      We close our copy of the read end of the pipe to the pipeline, so
+      that commands writing to it see a broken pipe, just as they would
+      in a shell. Anything we still have to write is discarded.
+      If the command failed, that is the failure reported, as opposed
+      to those of the commands of the spring seeing the broken pipe.
+    """
+    if not self.active:
+      return
+
+    self._reader()
+    if status != 0:
+      self._finish(status, self._commands[1])
+      return
+
+    if self._parallel is not None:
+      self._break()
     else:
-      # After we started the first command from the spring we need to
-      # make sure that there is a consumer of the output data. If there
-      # were none, the new process could potentially block forever
-      # trying to write data. To that end, start the remaining commands
-      # in the form of a pipeline.
-      if first:
-        if pipe_cmds:
-          pids += _pipeline(pipe_cmds, env, fd_in_new, fd_out, fd_err, fd_interr)
-
-        first = False
-
-      # The pipeline could still be stalled at some point if there is no
-      # final consumer of the data. We are required here to poll for
-      # data in order to prevent starvation.
-      if not poller:
-        poller = fds.poll()
+      self._broken = True
+
+    if self._pumping is not None:
+      self._pumping(POLLERR)
+    elif self._parallel is not None:
+      self._release()
+      self._update()
+
+
+  def _exited(self, status):
+    """Handle the termination of a spring command."""
+    self._head = None
+    if not self.active:
+      return
+
+    if self._check(status):
+      self._next()
+
+
+  def _check(self, status):
+    """Check the status of the current command of the spring, advancing to the next one."""
+    if status != 0:
+      self._finish(status, self._commands[0][self._index])
+      return False
+
+    self._index += 1
+    return True
+
+
+  def _channel(self, data, key):
+    """Prepare a pipe dict of a parallel spring for being registered with the multiplexer repeatedly.
+
+      The file descriptor (data[key]) is registered by means of _watch
+      and unregistered by invoking data["unreg"], any number of times.
+      Only a single deferred function is involved, no matter how often
+      that happens.
+    """
+    data["unreg"] = partial(self._unwatch, data)
+    data["fd"] = data[key]
+    self._later.defer(data["unreg"])
+    return data
+
+
+  def _watch(self, data, events, handler):
+    """Register the file descriptor of a pipe dict with the multiplexer."""
+    self._fds.mux.register(data["fd"], events, handler)
+    data["watched"] = True
+
+
+  def _unwatch(self, data):
+    """Unregister the file descriptor of a pipe dict from the multiplexer, if registered."""
+    if data.pop("watched", False):
+      self._fds.mux.unregister(data["fd"])
+
+
+  def _startHeads(self):
+    """Start commands of a parallel spring until the limit of running ones is reached."""
+    fds = self._fds
+    spring_cmds = self._commands[0]
+
+    if self._expired():
+      self._limit = len(self._heads)
+
+    while self._running < self._parallel and len(self._heads) < self._limit:
+      index = len(self._heads)
+      last = index == len(spring_cmds) - 1
+      head = {
+        "index": index,
+        "pid": None,
+        "status": None,
+        "last": last,
+        "eof": False,
+        "done": False,
+        "paused": False,
+      }
+      self._heads += [head]
+
+      if index in self._sources:
+        # A file source does not run. Its data is moved to our output
+        # directly, once it is its turn.
+        head["status"] = 0
+        continue
+
+      fd_in, fd_out = pipe2(O_CLOEXEC)
+      close = self._later.defer(close_, fd_in)
+      try:
+        pid = self._launch(spring_cmds[index], self._env, fds.stdin, fd_out,
+                           fds.stderr, fds.interr)
+      finally:
+        close_(fd_out)
+
+      if pid is None:
+        close()
+        head["eof"] = True
+        head["status"] = EXEC_FAIL
+        self._settle(head)
+        continue
+
+      head["pid"] = pid
+      self._running += 1
+      self._launched(pid, index)
+
+      # The pipe is made non-blocking because its file descriptor may
+      # be a reused one that we still receive a stale event for.
+      set_blocking(fd_in, False)
+      head["pipe"] = self._channel({
+        "in": fd_in,
+        "data": bytearray(),
+        "size": _READ_SIZE,
+        "max": _pipeSize(fd_in),
+        "limit": None,
+        "close": close,
+      }, "in")
+
+      if self._broken:
+        # Just as in the serial case, the command sees a broken pipe
+        # once it writes anything.
+        self._closeHead(head)
+        self._settle(head)
       else:
-        pollData(poller)
+        self._resume(head)
 
-      if not last:
-        status = _waitpid(pid)
-        if status != 0:
-          # One command failed. Do not start any more commands and
-          # indicate failure to the caller. The caller may try reading
-          # data from stderr (if any and if reading from it is enabled)
-          # and will raise an exception.
-          failed = formatCommands(command)
-          break
+      if last:
+        # Just as in the serial case, the status of the last command is
+        # checked along with the pipeline.
+        self.pids[0:0] = [pid]
+        fds.watch(pid)
       else:
-        # If we reached the last command in the spring we can just have
-        # it run in background and wait for it to finish later on -- no
-        # more serialization is required at that point.
-        # We insert the pid just before the pids for the pipeline. The
-        # pipeline is started early but it runs the longest (because it
-        # processes the output of the spring) and we must keep this
-        # order in the pid list.
-        pids[-pipe_len:-pipe_len] = [pid]
+        fds.watch(pid, lambda status, head=head: self._reaped(head, status))
 
-  if pipe_cmds:
-    close_(fd_in_new)
-    close_(fd_out_new)
 
-  assert poller
-  return pids, poller, status, failed
+  def _resume(self, head):
+    """Start (or resume) reading the output of a command of a parallel spring."""
+    self._watch(head["pipe"], _IN, lambda event: self._readable(head, event))
+    head["paused"] = False
 
 
-def spring(commands, env=None, stdout=None, stderr=b""):
-  """Execute a series of commands and accumulate their output to a single destination."""
-  with defer() as later:
-    with defer() as here:
-      # A spring never receives any input from stdin, i.e., we always
-      # want it to be redirected from /dev/null.
-      fds = _PipelineFileDescriptors(later, here, None, stdout, stderr)
-      # When running the spring we need to alternate between spawning
-      # new processes and polling for data. In that scenario, we do not
-      # want the polling to block until we started processes for all
-      # commands passed in.
-      fds.blockable(False)
-
-      # Finally execute our spring and pass in the prepared file
-      # descriptors to use.
-      pids, poller, status, failed = _spring(commands, env, fds)
+  def _readable(self, head, event):
+    """Handle a poll event for the output pipe of a command of a parallel spring."""
+    pipe = head["pipe"]
+    try:
+      closed = _handle(pipe, event)
+    except BlockingIOError:
+      return
 
-    # We started all processes and will wait for them to finish. From
-    # now on we can allow any invocation of poll to block.
-    fds.blockable(True)
+    if closed:
+      pipe["unreg"]()
+      head["eof"] = True
+      self._settle(head)
+    elif len(pipe["data"]) >= _SPRING_BUFFER:
+      # Stop reading until the data got forwarded. The command will
+      # block once its pipe is full.
+      pipe["unreg"]()
+      head["paused"] = True
 
-    # Poll until there is no more data.
-    for _ in poller:
+    self._update()
+
+
+  def _reaped(self, head, status):
+    """Handle the termination of a command of a parallel spring."""
+    head["status"] = status
+    self._settle(head)
+    self._update()
+
+
+  def _settle(self, head):
+    """Check whether a command of a parallel spring is done."""
+    if head["done"] or not head["eof"]:
+      return
+
+    if head["status"] is None and not head["last"]:
+      return
+
+    head["done"] = True
+    if head["pid"] is not None:
+      self._running -= 1
+
+    if head["status"] is not None and head["status"] != 0:
+      # Just as in the serial case we do not start any commands after a
+      # failed one.
+      self._limit = min(self._limit, head["index"] + 1)
+
+
+  def _update(self):
+    """Start more commands of a parallel spring and forward their output."""
+    if not self.active:
+      return
+
+    self._startHeads()
+    self._forward()
+
+
+  def _forward(self):
+    """Forward the output of the commands of a parallel spring in order."""
+    out = self._out
+    while self.active and out["data"] is None:
+      if self._emit == len(self._heads):
+        if self._emit == self._limit:
+          self._finish(0, None)
+        return
+
+      head = self._heads[self._emit]
+      pipe = head.get("pipe")
+
+      if head["index"] in self._sources and not head["eof"]:
+        if self._broken:
+          head["eof"] = True
+          self._settle(head)
+        else:
+          if self._pumping is None:
+            self._pumpSource(head["index"], lambda: self._drained(head))
+          return
+      elif pipe is not None and pipe["data"]:
+        # Hand the buffered data to the writer without copying it.
+        data, pipe["data"] = pipe["data"], bytearray()
+        if head["paused"] and not head["eof"]:
+          self._resume(head)
+
+        if not self._broken:
+          out["data"] = memoryview(data)
+          out["pos"] = 0
+          self._watch(out, _OUT, self._writable)
+      elif head["done"]:
+        if head["status"] is not None and head["status"] != 0:
+          self._finish(head["status"], self._commands[0][head["index"]])
+          return
+
+        self._emit += 1
+      else:
+        return
+
+
+  def _drained(self, head):
+    """Handle the exhaustion of a file source of a parallel spring."""
+    head["eof"] = True
+    self._settle(head)
+    self._update()
+
+
+  def _writable(self, event):
+    """Handle a poll event for the file descriptor we forward output to."""
+    out = self._out
+    try:
+      if event & POLLOUT:
+        pos = out["pos"]
+        end = None if self._chunk is None else pos + self._chunk
+        out["pos"] += write(out["out"], out["data"][pos:end])
+        if out["pos"] < len(out["data"]):
+          return
+      else:
+        raise BrokenPipeError()
+    except BlockingIOError:
+      return
+    except BrokenPipeError:
+      self._break()
+
+    self._release()
+    self._update()
+
+
+  def _break(self):
+    """Handle the output of a parallel spring going away.
+
+      Nobody is interested in our output anymore. In the serial case,
+      commands write to the output directly and see a broken pipe. To
+      be consistent, we close the pipes of all commands still running
+      (as well as those of commands started later on).
+    """
+    self._broken = True
+    for head in self._heads:
+      if "pipe" in head and not head["eof"]:
+        self._closeHead(head)
+        self._settle(head)
+
+
+  def _closeHead(self, head):
+    """Stop reading the output of a command of a parallel spring and close the pipe."""
+    head["pipe"]["unreg"]()
+    head["pipe"]["close"]()
+    head["eof"] = True
+
+
+  def _release(self):
+    """Release the data currently being written by a parallel spring."""
+    out = self._out
+    if out is not None and out["data"] is not None:
+      out["unreg"]()
+      out["data"].release()
+      out["data"] = None
+
+
+  def _finish(self, status, failed):
+    """Finish the spring."""
+    self.status = status
+    self.failed = failed
+    self.active = False
+    self._release()
+
+    if self._pumping is not None:
+      self._pumping(POLLERR)
+
+    # The output of any commands of a parallel spring still running is
+    # of no interest anymore. We close their pipes. The processes are
+    # still reaped as part of polling.
+    heads = [head for head in self._heads if "pipe" in head and not head["eof"]]
+    if heads and status != 0:
+      # The commands may complain about their output being closed. Just
+      # as in the serial case, an error is reported with the stderr data
+      # written up to the failure only.
+      self._fds.markStderr()
+
+    for head in heads:
+      self._closeHead(head)
+
+    # Close our copies of all file descriptors handed to processes.
+    # Only after that will we see EOF on the pipes we read from.
+    self._here.destroy()
+
+
+  def abort(self):
+    """Stop the spring, reaping all of its commands still running.
+
+      The statuses of the commands reaped are recorded just as if they
+      got reaped while polling. The first one that failed is reported
+      as the spring's failure, unless the spring failed already.
+    """
+    spring_cmds = self._commands[0]
+    heads = [(self._head, self._index)] if self._head is not None else []
+    self._head = None
+    self._finish(self.status, self.failed)
+
+    heads += [
+      (head["pid"], head["index"]) for head in self._heads
+      if head["pid"] is not None and not head["last"] and head["status"] is None
+    ]
+
+    reaped = self._fds.reaped()
+    usage = self._fds.usage()
+    for pid, index in heads:
+      if pid not in reaped:
+        reaped[pid], usage[pid] = _waitpid(pid)
+
+      if reaped[pid] != 0 and self.status == 0:
+        self.status = reaped[pid]
+        self.failed = spring_cmds[index]
+
+
+  def poll(self):
+    """Poll until the spring is done and all file descriptors are closed.
+
+      Just as _PipelineFileDescriptors.poll, this method yields after
+      each round of handled events.
+    """
+    while self.active or not self._fds.done:
+      self._fds.mux.poll()
+      yield
+
+    yield
+
+
+def _flatten(commands):
+  """Flatten the commands of a spring for checking the statuses of its processes.
+
+    Consider a spring: [[a, b, c, d], e, f, g]. Error reporting works by
+    propagating up an error via 'failed' if it happened in the [a, b, c]
+    part of the spring. If d failed and for all failures in [e, f, g] we
+    proceed as we do for pipelines. To make sure that the correct
+    command is reported as failed (we index into the commands) we
+    "flatten" the commands list. That is, the command list becomes
+    [d, e, f, g]. If d is a file source, there is no process for it and
+    the list becomes [e, f, g].
+  """
+  last = commands[0][-1]
+  return ([] if _isSource(last) else [last]) + commands[1:]
+
+
+def _checkParallel(parallel):
+  """Check the degree of parallelism requested for a spring."""
+  if parallel is not None and parallel < 1:
+    raise ValueError("Invalid parallelism: {p}".format(p=parallel))
+
+
+def _checkSpringTimeouts(commands, timeouts):
+  """Check that the per-command timeouts for a spring match its commands."""
+  if timeouts is not None and len(timeouts) == len(commands):
+    if timeouts[0] is not None and len(timeouts[0]) != len(commands[0]):
+      raise ValueError("Number of timeouts does not match number of commands")
+
+
+def spring(commands, env=None, stdout=None, stderr=b"", launcher=None, parallel=None,
+           timeout=None, timeouts=None, grace=5, max_stdout=None, max_stderr=None,
+           overflow=None, spill=None, usage=None, trace=None):
+  """Execute a series of commands and accumulate their output to a single destination.
+
+    By default the commands of the spring are run one after the other.
+    If 'parallel' is given, up to that many of them run concurrently
+    instead. Their output is still passed on in the order in which the
+    commands were declared, i.e., the result is the same as that of a
+    serial spring. Note that the output of commands whose turn has not
+    yet come is buffered in memory (up to a limit, after which the
+    respective command is blocked).
+    Timeouts work as they do for pipeline, with the first element of
+    'timeouts' being a list of timeouts (or None) for the commands of
+    the spring itself. The timeout of each of these commands starts
+    once it is started. Output limits and spilling work as they do for
+    pipeline.
+    Instead of a command, the spring may contain a file source (a
+    path-like or a file object), the data of which is passed on just as
+    if it were the output of a command. The data is moved from the file
+    by the kernel (by means of splice or sendfile, if possible), saving
+    a process per file compared to using cat.
+    The resource usage of the commands can be retrieved as for pipeline,
+    with the commands of the spring being listed first. File sources
+    and commands not started are reported as None. Tracing works as it
+    does for pipeline.
+  """
+  fds, pids, stages, status, failed, data_out, data_err, int_err = _runSpring(
+    commands, env, stdout, stderr, launcher, parallel, timeout, timeouts, grace,
+    trace, max_stdout=max_stdout, max_stderr=max_stderr, overflow=overflow,
+    spill=spill
+  )
+
+  error = fds.error(data_err) if stderr is not None else None
+  _wait(pids, _flatten(commands), error, int_err, status=status, failed=failed,
+        reaped=fds.reaped(), usage=fds.usage(), stages=stages, out=usage)
+
+  return _output(stdout, stderr, data_out, data_err)
+
+
+def _runSpring(commands, env, stdout, stderr, launcher, parallel, timeout, timeouts,
+               grace, trace, **kwargs):
+  """Run a spring until all of its data got transferred.
+
+    Please refer to _runPipeline for a description of the result.
+  """
+  launch = _traceLaunch(_launchFunction(launcher), trace)
+  _checkParallel(parallel)
+  _checkSpringTimeouts(commands, timeouts)
+  if timeout is not None or timeouts is not None:
+    launch = partial(launch, group=True)
+
+  with defer() as later:
+    # The spring takes care of closing all file descriptors to be closed
+    # 'here' once it is done, i.e., while we are polling.
+    here = defer()
+    later.defer(here.destroy)
+
+    # A spring never receives any input from stdin, i.e., we always want
+    # it to be redirected from /dev/null.
+    fds = _PipelineFileDescriptors(later, here, None, stdout, stderr,
+                                   trace=trace, **kwargs)
+    deadlines = _deadlines(fds, later, commands, timeout, timeouts, grace)
+    run = _Spring(commands, env, fds, later, here, launch, parallel,
+                  deadlines, timeouts)
+    run.start()
+
+    # Commands of the spring are started as their predecessors
+    # terminate, which we get notified about while polling for data.
+    for _ in run.poll():
       pass
 
+    pids, status, failed = run.pids, run.status, run.failed
     data_out, data_err, int_err = fds.data()
 
-  error = data_err if stderr is not None else None
-  # Consider a spring: [[a, b, c, d], e, f, g]. Error reporting here
-  # works by propagating up an error via 'failed' if it happened in the
-  # [a, b, c] part of the spring. If d failed and for all failures in
-  # [e, f, g] we proceed as we do for pipelines. To make sure that the
-  # correct command is reported as failed (we index into "commands") we
-  # "flatten" the commands list here. That is, the command list becomes
-  # [d, e, f, g].
-  commands = [commands[0][-1]] + commands[1:]
-  _wait(pids, commands, error, int_err, status=status, failed=failed)
+  if deadlines is not None:
+    deadlines.check(commands, stdout, stderr, data_out, data_err)
 
-  stdout_valid = stdout is not None and not isinstance(stdout, int)
-  stderr_valid = stderr is not None and not isinstance(stderr, int)
+  _checkOverflow(fds, commands, stderr, data_err)
 
-  if stdout_valid and stderr_valid:
-    return data_out, data_err
-  elif stdout_valid:
-    return data_out
-  elif stderr_valid:
-    return data_err
+  return fds, pids, run.stages, status, failed, data_out, data_err, int_err
+
+
+def springIter(commands, env=None, stderr=b"", lines=False, launcher=None, parallel=None):
+  """Execute a spring and yield the data it writes to stdout as it arrives.
+
+    This function is the streaming counterpart to spring. Please refer
+    to pipelineIter for details.
+  """
+  launch = _launchFunction(launcher)
+  _checkParallel(parallel)
+  run = None
+
+  try:
+    with defer() as later:
+      here = defer()
+      later.defer(here.destroy)
+      fds = _PipelineFileDescriptors(later, here, None, bytearray(), stderr)
+      run = _Spring(commands, env, fds, later, here, launch, parallel)
+      run.start()
+
+      yield from _stream(fds, run.poll(), lines)
+  finally:
+    if run is not None:
+      # If we got closed early the spring may still be running.
+      if run.active:
+        run.abort()
+
+      pids, status, failed = run.pids, run.status, run.failed
+      _, data_err, int_err = fds.data()
+      error = fds.error(data_err) if stderr is not None else None
+      commands = _flatten(commands)
+      _wait(pids, commands, error, int_err, status=status, failed=failed,
+            reaped=fds.reaped())
+
+
+class Result:
+  """The outcome of running a pipeline or spring by means of run.
+
+    Captured output is provided as it was read, without any copies
+    being made. All other information is provided in lists containing
+    an entry for each command, in order, with None for commands that
+    did not run (such as file sources of a spring).
+  """
+  __slots__ = (
+    "stdout",
+    "stderr",
+    "statuses",
+    "durations",
+    "usage",
+    "_stdout_text",
+    "_stderr_text",
+  )
+
+  def __init__(self, stdout, stderr, statuses, durations, usage):
+    """Initialize the result."""
+    self.stdout = stdout
+    self.stderr = stderr
+    self.statuses = statuses
+    self.durations = durations
+    self.usage = usage
+    self._stdout_text = None
+    self._stderr_text = None
+
+
+  def __repr__(self):
+    """Retrieve a string representation of the result."""
+    return "Result(statuses={s!r}, durations={d!r})".format(s=self.statuses,
+                                                            d=self.durations)
+
+
+  @property
+  def status(self):
+    """Retrieve the status of the first command that failed or 0 if none did."""
+    return next((status for status in self.statuses if status), 0)
+
+
+  @property
+  def stdoutText(self):
+    """Retrieve the captured stdout output decoded as UTF-8.
+
+      The output is decoded on first access only.
+    """
+    if self._stdout_text is None and self.stdout is not None:
+      self._stdout_text = str(self.stdout, "utf-8")
+    return self._stdout_text
+
+
+  @property
+  def stderrText(self):
+    """Retrieve the captured stderr output decoded as UTF-8.
+
+      The output is decoded on first access only.
+    """
+    if self._stderr_text is None and self.stderr is not None:
+      self._stderr_text = str(self.stderr, "utf-8")
+    return self._stderr_text
+
+
+def run(commands, env=None, stdin=None, stdout=b"", stderr=b"", launcher=None,
+        parallel=None, timeout=None, timeouts=None, grace=5, max_stdout=None,
+        max_stderr=None, overflow=None, spill=None, memfd=None, trace=None,
+        check=True):
+  """Execute a pipeline or a spring and return a Result object.
+
+    Commands are treated as a spring if their first element is a list of
+    commands (and file sources), just as spring expects it, and as a
+    pipeline otherwise. All parameters work as they do for pipeline and
+    spring, except that output is captured by default and data read is
+    accumulated in a bytearray instead of being converted into bytes
+    eventually. The result contains the captured output, the status,
+    the duration (from the start of its launch until it got reaped) and
+    the resource usage of each command.
+    If 'check' is False, a failure of a command is not reported by means
+    of a ProcessError but only reflected in the statuses of the result.
+    All other errors (such as a failure to execute a command or an
+    expired timeout) are raised nevertheless.
+  """
+  started = {}
+  exited = {}
+
+  def record(event, time, subject):
+    """Record the times at which processes got started and reaped."""
+    if event == "fork":
+      started[subject] = time
+    elif event == "exit":
+      exited[subject] = time
+
+    if trace is not None:
+      trace(event, time, subject)
+
+  # The data read is appended to a bytearray directly. Spilling does not
+  # work with a bytearray, as the data ends up in a file instead.
+  if isinstance(stdout, bytes) and spill is None:
+    stdout = bytearray(stdout)
+  if isinstance(stderr, bytes):
+    stderr = bytearray(stderr)
+
+  kwargs = {
+    "max_stdout": max_stdout,
+    "max_stderr": max_stderr,
+    "overflow": overflow,
+    "spill": spill,
+  }
+  first = commands[0]
+  if not callable(first) and (isinstance(first[0], list) or _isSource(first[0])):
+    if stdin is not None:
+      raise ValueError("A spring does not read from stdin")
+
+    fds, pids, stages, status, failed, data_out, data_err, int_err = _runSpring(
+      commands, env, stdout, stderr, launcher, parallel, timeout, timeouts,
+      grace, record, **kwargs
+    )
+    commands = _flatten(commands)
+  else:
+    fds, pids, stages, status, failed, data_out, data_err, int_err = _runPipeline(
+      commands, env, stdin, stdout, stderr, launcher, timeout, timeouts, grace,
+      record, memfd=memfd, **kwargs
+    )
+
+  usage = []
+  error = fds.error(data_err) if stderr is not None else None
+  try:
+    _wait(pids, commands, error, int_err, status=status, failed=failed,
+          reaped=fds.reaped(), usage=fds.usage(), stages=stages, out=usage)
+  except ProcessError:
+    if check:
+      raise
+
+  reaped = fds.reaped()
+  statuses = [reaped.get(pid) if pid is not None else None for pid in stages]
+  durations = [
+    exited[pid] - started[pid] if pid in started and pid in exited else None
+    for pid in stages
+  ]
+  # Just as for _output, output that was not captured is reported as
+  # None.
+  if stdout is None or isinstance(stdout, int):
+    data_out = None
+  if stderr is None or isinstance(stderr, int):
+    data_err = None
+
+  return Result(data_out, data_err, statuses, durations, usage)
@@ -0,0 +1,436 @@
+# fanout_.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Execution of a pipeline feeding its output to several other pipelines.
+
+  A fan-out is a tree shaped set of commands: the output of a single
+  pipeline is duplicated and passed on to any number of downstream
+  pipelines (the branches), each consuming all of it. That way an
+  expensive command has to run only once, no matter how many consumers
+  its output has. We sit in between the pipeline and the branches and
+  duplicate the data within the kernel (by means of tee and splice), if
+  possible, or copy it through a buffer otherwise.
+"""
+
+from deso.cleanup import (
+  defer,
+)
+from deso.execute.execute_ import (
+  _IN,
+  _isBuffer,
+  _launchFunction,
+  _Multiplexer,
+  _OUT,
+  _output,
+  _pipeline,
+  _PipelineFileDescriptors,
+  _pipeSize,
+  _stages,
+  _wait,
+  _write,
+)
+from functools import (
+  partial,
+)
+from os import (
+  close as close_,
+  O_CLOEXEC,
+  pipe2,
+  read,
+  set_blocking,
+  strerror,
+)
+from select import (
+  POLLIN,
+  POLLOUT,
+)
+
+try:
+  from os import (
+    splice,
+    SPLICE_F_NONBLOCK,
+  )
+except ImportError:
+  splice = None
+
+try:
+  from ctypes import (
+    c_int,
+    c_size_t,
+    c_ssize_t,
+    c_uint,
+    CDLL,
+    get_errno,
+  )
+
+  _libcTee = CDLL(None, use_errno=True).tee
+  _libcTee.argtypes = (c_int, c_int, c_size_t, c_uint)
+  _libcTee.restype = c_ssize_t
+except (ImportError, AttributeError, OSError):
+  # tee is Linux specific and, unlike splice, not exposed by the os
+  # module. We call it through the C library, if possible. Without it
+  # (or splice) data is copied through a buffer.
+  _libcTee = None
+
+
+def _tee(fd_in, fd_out, size):
+  """Duplicate up to 'size' bytes from one pipe into another, without consuming them."""
+  count = _libcTee(fd_in, fd_out, size, SPLICE_F_NONBLOCK)
+  if count < 0:
+    errno = get_errno()
+    # OSError picks the subclass matching the error code, e.g.,
+    # BlockingIOError for EAGAIN, just as functions of the os module do.
+    raise OSError(errno, strerror(errno))
+
+  return count
+
+
+class _Tee:
+  """Duplicate the data arriving on a pipe into a set of other pipes.
+
+    Data is transferred in chunks of at most the capacity of the input
+    pipe. A chunk is duplicated into all outputs but the last by means
+    of tee and then spliced into the last one, i.e., it never enters our
+    address space. Should an output not accept the entire chunk, the
+    chunk is read and the remainder written to the output from a
+    buffer. No more data is read before all outputs received the
+    current chunk, i.e., the slowest reader dictates the pace. Outputs
+    whose reader went away are closed and no longer fed.
+  """
+  def __init__(self, count, mux, later, here):
+    """Create the input pipe and 'count' output pipes.
+
+      The ends of the pipes to be handed to processes are closed by
+      'here', our ends are closed by 'later' or as soon as we are done
+      with them.
+    """
+    self._mux = mux
+    self._in, self.stdout = pipe2(O_CLOEXEC)
+    self._close = later.defer(close_, self._in)
+    # The input is registered with the multiplexer only while we read,
+    # the outputs only while we wait for them to become writable. We
+    # make sure to unregister them before they get closed.
+    later.defer(self._pause)
+    here.defer(close_, self.stdout)
+    set_blocking(self._in, False)
+
+    self._size = _pipeSize(self._in)
+    self._kernel = _libcTee is not None and splice is not None
+    self._reading = False
+    self._eof = False
+    self._outs = []
+    self.stdins = []
+
+    for _ in range(count):
+      fd_in, fd_out = pipe2(O_CLOEXEC)
+      here.defer(close_, fd_in)
+      self.stdins += [fd_in]
+      out = {
+        "out": fd_out,
+        "close": later.defer(close_, fd_out),
+        # The data of the current chunk not yet written, if it could not
+        # be moved by the kernel in its entirety.
+        "data": None,
+        "pos": 0,
+        "waiting": False,
+        "broken": False,
+      }
+      later.defer(self._unblock, out)
+      self._outs += [out]
+      set_blocking(fd_out, False)
+
+    # We stay active until the input is exhausted and all of its data
+    # got passed on, or no output is left to pass it on to.
+    self.active = True
+
+
+  def start(self):
+    """Start transferring data."""
+    self._resume()
+
+
+  def _live(self):
+    """Retrieve the outputs that still have a reader."""
+    return [out for out in self._outs if not out["broken"]]
+
+
+  def _resume(self):
+    """Read more data, unless we are waiting for an output to become writable."""
+    if not self.active or any(out["waiting"] for out in self._outs):
+      return
+
+    if self._eof or not self._live():
+      self._finish()
+    elif not self._reading:
+      self._mux.register(self._in, _IN, self._readable)
+      self._reading = True
+
+
+  def _pause(self):
+    """Stop reading data."""
+    if self._reading:
+      self._mux.unregister(self._in)
+      self._reading = False
+
+
+  def _block(self, out):
+    """Wait for an output to become writable before reading more data."""
+    self._pause()
+    if not out["waiting"]:
+      self._mux.register(out["out"], _OUT, partial(self._writable, out))
+      out["waiting"] = True
+
+
+  def _unblock(self, out):
+    """Stop waiting for an output to become writable."""
+    if out["waiting"]:
+      self._mux.unregister(out["out"])
+      out["waiting"] = False
+
+
+  def _break(self, out):
+    """Stop feeding an output because its reader went away."""
+    self._unblock(out)
+    out["broken"] = True
+    out["data"] = None
+    out["close"]()
+
+
+  def _send(self, out):
+    """Write the pending data of an output, waiting for it to become writable if necessary."""
+    try:
+      if _write(out):
+        out["data"] = None
+        return
+    except BrokenPipeError:
+      self._break(out)
+      return
+
+    self._block(out)
+
+
+  def _writable(self, out, event):
+    """Handle a poll event for an output we are waiting for."""
+    if not event & POLLOUT:
+      self._break(out)
+    elif out["data"] is not None:
+      try:
+        if not _write(out):
+          return
+      except BrokenPipeError:
+        self._break(out)
+
+    if not out["broken"]:
+      self._unblock(out)
+      out["data"] = None
+
+    self._resume()
+
+
+  def _readable(self, event):
+    """Handle a poll event for the input."""
+    if not event & POLLIN:
+      # A hang up without any data left means EOF.
+      self._eof = True
+    elif self._kernel:
+      self._duplicate()
+    else:
+      self._copy()
+
+    self._resume()
+
+
+  def _move(self, move, out, count):
+    """Move data to an output, returning the amount moved or None if the reader went away."""
+    try:
+      return move(self._in, out["out"], count)
+    except BlockingIOError:
+      return 0
+    except BrokenPipeError:
+      self._break(out)
+      return None
+
+
+  def _duplicate(self):
+    """Duplicate the next chunk of input into all outputs within the kernel."""
+    outs = self._live()
+    splice_ = partial(splice, flags=SPLICE_F_NONBLOCK)
+
+    # The first output accepting data determines the size of the chunk.
+    # The chunk is tee'd into it, i.e., it stays in the input pipe,
+    # unless it is the only output.
+    while True:
+      first = outs[0]
+      move = splice_ if len(outs) == 1 else _tee
+      try:
+        count = move(self._in, first["out"], self._size)
+        break
+      except BlockingIOError:
+        self._block(first)
+        return
+      except BrokenPipeError:
+        self._break(first)
+        outs = outs[1:]
+        if not outs:
+          return
+
+    if count == 0:
+      self._eof = True
+      return
+
+    if len(outs) == 1:
+      return
+
+    *rest, last = outs[1:]
+    short = []
+    for out in rest:
+      moved = self._move(_tee, out, count)
+      if moved is not None and moved < count:
+        short += [(out, moved)]
+
+    if not short:
+      moved = self._move(splice_, last, count)
+      if moved is None:
+        # The data still has to be consumed.
+        read(self._in, count)
+      elif moved < count:
+        last["data"] = memoryview(read(self._in, count - moved))
+        last["pos"] = 0
+        self._send(last)
+      return
+
+    # Some outputs did not accept the entire chunk. We have to consume
+    # the chunk in order to get to the data following it and so the
+    # outputs lagging behind get the remainder from a buffer.
+    data = memoryview(read(self._in, count))
+    for out, moved in short + [(last, 0)]:
+      out["data"] = data
+      out["pos"] = moved
+      self._send(out)
+
+
+  def _copy(self):
+    """Copy the next chunk of input into all outputs through a buffer."""
+    data = read(self._in, self._size)
+    if not data:
+      self._eof = True
+      return
+
+    data = memoryview(data)
+    for out in self._live():
+      out["data"] = data
+      out["pos"] = 0
+      self._send(out)
+
+
+  def _finish(self):
+    """Finish the transfer, signaling EOF to all outputs."""
+    self._pause()
+    self._close()
+    for out in self._outs:
+      out["close"]()
+
+    self.active = False
+
+
+def fanout(commands, branches, env=None, stdin=None, stdout=None, stderr=b"",
+           launcher=None, usage=None):
+  """Execute a pipeline and feed its output to a number of other pipelines.
+
+    The output of the pipeline formed by 'commands' is duplicated and
+    supplied to each of the pipelines in 'branches' as its input, i.e.,
+    the pipeline runs only once, no matter the number of branches. On
+    Linux, the data is duplicated within the kernel (by means of tee
+    and splice), otherwise it is copied through a buffer. All branches
+    are fed at the pace of the slowest one. A branch no longer reading
+    its input is simply no longer fed.
+    Stdin, stderr, and the launcher work as they do for pipeline, with
+    all commands sharing stderr. Stdout can be a list containing a value
+    for each branch or a single value used for all of them, except for
+    a bytearray or other buffer, which has to be provided for each
+    branch separately. Captured output is returned as a list with an
+    entry for each branch, None for branches not captured.
+    The statuses of all commands are checked, those of the pipeline
+    first and then those of the branches, in order. Resource usage is
+    reported as for pipeline, in the same order.
+  """
+  if not branches:
+    raise ValueError("A fan-out requires at least one branch")
+
+  if isinstance(stdout, list):
+    if len(stdout) != len(branches):
+      raise ValueError("Number of outputs does not match number of branches")
+    outs = stdout
+  else:
+    if isinstance(stdout, bytearray) or _isBuffer(stdout):
+      raise ValueError("A buffer for stdout cannot be shared by multiple branches")
+    outs = [stdout] * len(branches)
+
+  launch = _launchFunction(launcher)
+
+  with defer() as later:
+    mux = _Multiplexer()
+    later.defer(mux.close)
+    with defer() as here:
+      tee = _Tee(len(branches), mux, later, here)
+      fds = _PipelineFileDescriptors(later, here, stdin, tee.stdout, stderr, mux)
+      outputs = [
+        _PipelineFileDescriptors(later, here, fd, out, fds.stderr, mux)
+        for fd, out in zip(tee.stdins, outs)
+      ]
+
+      parts = [commands] + branches
+      channels = [fds] + outputs
+      started = [[] for _ in parts]
+      status, failed = 0, None
+
+      # The branches are started first. They just wait for input. Once
+      # launching a command failed, nothing else is started and the
+      # commands started already see EOF on their input.
+      for i in list(range(1, len(parts))) + [0]:
+        started[i], status, failed = _pipeline(parts[i], env, channels[i].stdin,
+                                               channels[i].stdout, fds.stderr,
+                                               fds.interr, launch)
+        for pid in started[i]:
+          fds.watch(pid)
+
+        if status != 0:
+          fds.closeStdin()
+          break
+
+    tee.start()
+    while tee.active or not all(f.done for f in channels):
+      mux.poll()
+
+    _, data_err, int_err = fds.data()
+    data_out = [f.data()[0] if f.captured else None for f in outputs]
+
+  # Statuses are checked for the pipeline first, followed by the
+  # branches.
+  pids, names, stages = [], [], []
+  for part, pids_ in zip(parts, started):
+    pids += pids_
+    names += part[:len(pids_)]
+    stages += _stages(pids_, part)
+
+  error = data_err if stderr is not None else None
+  _wait(pids, names, error, int_err, status=status, failed=failed,
+        reaped=fds.reaped(), usage=fds.usage(), stages=stages, out=usage)
+
+  return _output(stdout, stderr, data_out, data_err)
@@ -0,0 +1,366 @@
+# server.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""A fork server launching processes on behalf of its creator.
+
+  Forking a process with a large address space is expensive: all of its
+  page tables have to be copied and every page written to afterwards
+  (by either process) is copied as well. A fork server is a small
+  helper process, forked off early while the process is still small,
+  that forks and execs commands on our behalf. The file descriptors the
+  command is to use are passed to the server over a UNIX domain socket.
+  As the started processes are children of the server, it reaps them
+  and forwards their statuses to us. For each process, the server also
+  holds the write end of a pipe that it closes once it reported the
+  process' termination, which allows for waiting for the process by
+  means of polling.
+"""
+
+from deso.execute.execute_ import (
+  _foreign,
+  _fork,
+)
+from os import (
+  chdir,
+  close as close_,
+  closerange,
+  devnull,
+  dup,
+  dup2,
+  environ,
+  fork,
+  getcwd,
+  _exit,
+  O_CLOEXEC,
+  O_NONBLOCK,
+  O_RDWR,
+  open as open_,
+  pipe2,
+  read,
+  sysconf,
+  wait4,
+  waitpid,
+  WNOHANG,
+)
+from pickle import (
+  dumps,
+  loads,
+)
+from select import (
+  POLLIN,
+  poll,
+)
+from signal import (
+  set_wakeup_fd,
+  SIGCHLD,
+  SIGINT,
+  signal,
+)
+from socket import (
+  AF_UNIX,
+  MSG_CMSG_CLOEXEC,
+  MSG_DONTWAIT,
+  recv_fds,
+  send_fds,
+  SO_RCVBUF,
+  SO_SNDBUF,
+  SOCK_SEQPACKET,
+  socketpair,
+  SOL_SOCKET,
+)
+from threading import (
+  Condition,
+)
+
+
+# The maximum size of a message exchanged with the server. Messages
+# comprise a command along with its environment, which we expect to
+# stay well below this limit. Note that the kernel may impose a lower
+# limit, depending on the maximum socket buffer size.
+_MESSAGE_SIZE = 1024 * 1024
+
+
+def _serve(sock):
+  """Launch processes as requested over a socket, until the latter is closed."""
+  # We do not want to keep any file descriptors of our creator open.
+  # Pipes, for example, would not see EOF while we hold a copy of them.
+  keep = sock.fileno()
+  closerange(3, keep)
+  closerange(keep + 1, sysconf("SC_OPEN_MAX"))
+
+  null = open_(devnull, O_RDWR | O_CLOEXEC)
+  for fd in range(3):
+    dup2(null, fd)
+  close_(null)
+
+  # An interrupt (e.g., a Ctrl-C on the terminal) is meant for our
+  # creator, which will close the socket if it wants us gone. Note that
+  # we do not ignore the signal, as that would be inherited by all
+  # processes we start.
+  signal(SIGINT, lambda signum, frame: None)
+
+  # We get notified about terminated children through a pipe the
+  # handler of SIGCHLD writes to.
+  wakeup_in, wakeup_out = pipe2(O_CLOEXEC | O_NONBLOCK)
+  set_wakeup_fd(wakeup_out)
+  signal(SIGCHLD, lambda signum, frame: None)
+
+  poller = poll()
+  poller.register(keep, POLLIN)
+  poller.register(wakeup_in, POLLIN)
+
+  # The write ends of the pipes signaling the termination of our
+  # children, by process ID.
+  done = {}
+
+  while True:
+    for fd, _ in poller.poll():
+      if fd == wakeup_in:
+        while read(wakeup_in, 512) == 512:
+          pass
+
+        _reapAll(sock, done)
+      elif not _launch(sock, done):
+        return
+
+
+def _reapAll(sock, done):
+  """Reap all terminated children and report their statuses."""
+  while True:
+    try:
+      pid, status, usage = wait4(-1, WNOHANG)
+    except ChildProcessError:
+      return
+
+    if pid == 0:
+      return
+
+    sock.send(dumps(("exit", pid, status, usage)))
+    # The pipe is closed only once the message got sent, so that it is
+    # available to our creator by the time it sees EOF.
+    close_(done.pop(pid))
+
+
+def _launch(sock, done):
+  """Handle a single request to launch a process, returning False once the socket got closed."""
+  data, fds, _, _ = recv_fds(sock, _MESSAGE_SIZE, 5, MSG_CMSG_CLOEXEC)
+  if not data:
+    return False
+
+  *fds, notify = fds
+  try:
+    _, id_, command, env, cwd, group = loads(data)
+    try:
+      # Children inherit our working directory.
+      chdir(cwd)
+      pid = _fork(command, env, *fds, group=group)
+      done[pid] = notify
+      notify = None
+      reply = ("pid", id_, pid)
+    except Exception as e:
+      reply = ("error", id_, e)
+  finally:
+    for fd in fds:
+      close_(fd)
+    if notify is not None:
+      close_(notify)
+
+  sock.send(dumps(reply))
+  return True
+
+
+class ForkServer:
+  """A helper process forking off and executing commands on our behalf.
+
+    A fork server can be used as the launcher for all functions
+    executing commands. It should be created early, while the process
+    is still small, as creating it requires a fork. The working
+    directory and environment (if none is provided explicitly) of the
+    processes started are those of the caller at the time of the
+    launch. All other process attributes (such as resource limits) are
+    those of the caller at the time the server was created.
+    Statuses and resource usage of the processes started by the server
+    are forwarded to us. Note that, in contrast to our own children,
+    their process IDs may be reused once the server reaped them.
+  """
+  def __init__(self):
+    """Create the server process."""
+    self._socket, sock = socketpair(AF_UNIX, SOCK_SEQPACKET)
+    for option in (SO_SNDBUF, SO_RCVBUF):
+      self._socket.setsockopt(SOL_SOCKET, option, _MESSAGE_SIZE)
+      sock.setsockopt(SOL_SOCKET, option, _MESSAGE_SIZE)
+
+    self._pid = fork()
+    if self._pid == 0:
+      status = 0
+      try:
+        self._socket.close()
+        _serve(sock)
+      except BaseException:
+        status = 1
+      finally:
+        _exit(status)
+
+    sock.close()
+
+    self._condition = Condition()
+    # Whether a thread is currently waiting for messages to arrive.
+    self._receiving = False
+    self._id = 0
+    # Replies to launch requests, by request ID.
+    self._replies = {}
+    # The status and resource usage of terminated processes, by ID.
+    self._exited = {}
+    # The read ends of the pipes the server closes once it reported the
+    # termination of a process, by ID.
+    self._done = {}
+
+
+  def __enter__(self):
+    """The context manager entry function is a no-op."""
+    return self
+
+
+  def __exit__(self, type_, value, traceback):
+    """The context manager exit function closes the server."""
+    self.close()
+
+
+  def close(self):
+    """Terminate the server.
+
+      All processes started by the server should have been waited for
+      by the time the server is closed.
+    """
+    if self._socket is not None:
+      self._socket.close()
+      self._socket = None
+      waitpid(self._pid, 0)
+
+      for fd in self._done.values():
+        close_(fd)
+      self._done = {}
+
+
+  def _receive(self):
+    """Receive all messages available from the server."""
+    while True:
+      try:
+        data = self._socket.recv(_MESSAGE_SIZE, MSG_DONTWAIT)
+      except BlockingIOError:
+        return
+
+      if not data:
+        raise ConnectionError("Fork server terminated unexpectedly")
+
+      message = loads(data)
+      if message[0] == "exit":
+        self._exited[message[1]] = message[2:]
+      else:
+        self._replies[message[1]] = (message[0], message[2])
+
+
+  def _await(self, retrieve):
+    """Wait for a message from the server, as determined by the 'retrieve' function."""
+    with self._condition:
+      while True:
+        self._receive()
+        result = retrieve()
+        if result is not None:
+          return result
+
+        if self._receiving:
+          # Another thread is waiting for messages already and will
+          # notify us once some arrived.
+          self._condition.wait()
+          continue
+
+        self._receiving = True
+        self._condition.release()
+        try:
+          poller = poll()
+          poller.register(self._socket, POLLIN)
+          poller.poll()
+        finally:
+          self._condition.acquire()
+          self._receiving = False
+          self._condition.notify_all()
+
+
+  def launch(self, command, env, fd_in, fd_out, fd_err, fd_interr, group=False):
+    """Launch a command by means of the server, just as _fork does."""
+    # The server closes its end of the pipe once it reported the
+    # termination of the process.
+    done, notify = pipe2(O_CLOEXEC)
+    try:
+      try:
+        with self._condition:
+          self._id += 1
+          id_ = self._id
+          env = dict(environ) if env is None else env
+          request = dumps(("launch", id_, command, env, getcwd(), group))
+          fds = [fd_in, fd_out, fd_err, fd_interr, notify]
+          send_fds(self._socket, [request], fds)
+      finally:
+        close_(notify)
+
+      kind, value = self._await(lambda: self._replies.pop(id_, None))
+      if kind == "error":
+        raise value
+    except BaseException:
+      close_(done)
+      raise
+
+    with self._condition:
+      self._done[value] = done
+
+    _foreign[value] = self
+    return value
+
+
+  def wait4(self, pid, options):
+    """Wait for a process started by the server, just as os.wait4 does."""
+    if options & WNOHANG:
+      with self._condition:
+        self._receive()
+        result = self._exited.pop(pid, None)
+
+      if result is None:
+        return 0, 0, None
+    else:
+      result = self._await(lambda: self._exited.pop(pid, None))
+
+    with self._condition:
+      close_(self._done.pop(pid))
+
+    status, usage = result
+    return pid, status, usage
+
+
+  def pidfd(self, pid):
+    """Retrieve a file descriptor becoming readable once the server reported a process' termination."""
+    with self._condition:
+      return dup(self._done[pid])
+
+
+  def terminated(self, pid):
+    """Check whether a process started by the server terminated."""
+    with self._condition:
+      self._receive()
+      return pid in self._exited
@@ -0,0 +1,197 @@
+# template.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Templates of commands and pipelines to be executed repeatedly.
+
+  Executing a command involves work that does not depend on the data it
+  processes: the spec has to be checked, executables have to be looked
+  up, and arguments and environment have to be converted into the byte
+  strings the OS expects. A template does all that once, when it is
+  created, and can then be invoked any number of times, with only the
+  parts varying between invocations being supplied.
+"""
+
+from deso.execute.execute_ import (
+  execute,
+  pipeline,
+)
+from deso.execute.util import (
+  findCommand,
+  isExecutable,
+)
+from errno import (
+  ENOENT,
+)
+from inspect import (
+  signature,
+)
+from os import (
+  fsdecode,
+  fsencode,
+  fspath,
+  sep,
+  strerror,
+)
+
+
+class _Prepared(list):
+  """A command along with its arguments encoded for being passed to the OS.
+
+    The command itself (a list of strings) is what is reported to users,
+    e.g., as part of a ProcessError. Launchers use the encoded arguments
+    instead (see _argv).
+  """
+  def __init__(self, args, argv):
+    """Initialize the command from its arguments and their encoded form."""
+    super().__init__(args)
+    self.argv = argv
+
+
+  def extended(self, args):
+    """Create a copy of the command with the given arguments appended."""
+    args = [fsdecode(fspath(arg)) for arg in args]
+    return _Prepared(self + args, self.argv + [fsencode(arg) for arg in args])
+
+
+def _prepare(command):
+  """Check a command and prepare it for being executed repeatedly.
+
+    The executable is looked up in PATH, unless a path to it is given.
+    Python callables (to be run as a stage of a pipeline) are used as
+    they are.
+  """
+  if callable(command):
+    return command
+
+  if not isinstance(command, list) or not command:
+    raise ValueError("Invalid command: {c}".format(c=command))
+
+  args = [fsdecode(fspath(arg)) for arg in command]
+  if sep not in args[0]:
+    args[0] = findCommand(args[0])
+  elif not isExecutable(args[0]):
+    raise FileNotFoundError(ENOENT, strerror(ENOENT), args[0])
+
+  return _Prepared(args, [fsencode(arg) for arg in args])
+
+
+def _encodeEnv(env):
+  """Encode an environment for being passed to the OS."""
+  if env is None:
+    return None
+
+  encoded = {}
+  for key, value in env.items():
+    key = fsencode(key)
+    if not key or b"=" in key:
+      raise ValueError("Invalid environment variable name: {k}".format(k=key))
+
+    encoded[key] = fsencode(value)
+
+  return encoded
+
+
+# The keyword arguments accepted by the templates, i.e., by execute and
+# pipeline, respectively.
+_COMMAND_OPTIONS = frozenset(signature(execute).parameters) - {"args"}
+_PIPELINE_OPTIONS = frozenset(signature(pipeline).parameters) - {"commands"}
+
+
+def _check(kwargs, options):
+  """Check that all keyword arguments are among the given options."""
+  invalid = kwargs.keys() - options
+  if invalid:
+    raise TypeError("Invalid keyword arguments: {k}".format(k=", ".join(sorted(invalid))))
+
+
+def _options(env, kwargs, options):
+  """Check keyword arguments and combine them with the encoded environment."""
+  # Invalid arguments are reported right away, instead of on every
+  # invocation of the template.
+  _check(kwargs, options)
+  return dict(kwargs, env=_encodeEnv(env))
+
+
+class Command:
+  """A template of a command to execute repeatedly.
+
+    The template is created with the command's arguments and with
+    keyword arguments as accepted by execute. If no environment is
+    given, the one at the time of an invocation is used.
+  """
+  def __init__(self, *args, env=None, **kwargs):
+    """Check and prepare the command."""
+    self._command = _prepare(list(args))
+    self._options = _options(env, kwargs, _COMMAND_OPTIONS)
+
+
+  def __repr__(self):
+    """Retrieve a textual representation of the template."""
+    return "Command({c})".format(c=", ".join(map(repr, self._command)))
+
+
+  def __call__(self, *args, **kwargs):
+    """Execute the command, with the given arguments appended to those of the template.
+
+      Keyword arguments override those the template was created with.
+      The result is the one of execute.
+    """
+    command = self._command.extended(args) if args else self._command
+    options = self._options
+    if kwargs:
+      _check(kwargs, _COMMAND_OPTIONS)
+      options = dict(options, **kwargs)
+
+    return pipeline([command], **options)
+
+
+class Pipeline:
+  """A template of a pipeline to execute repeatedly.
+
+    The template is created with the commands of the pipeline (which may
+    include Python callables) and with keyword arguments as accepted by
+    pipeline. If no environment is given, the one at the time of an
+    invocation is used.
+  """
+  def __init__(self, commands, env=None, **kwargs):
+    """Check and prepare the pipeline."""
+    if not commands:
+      raise ValueError("A pipeline requires at least one command")
+
+    self._commands = [_prepare(command) for command in commands]
+    self._options = _options(env, kwargs, _PIPELINE_OPTIONS)
+
+
+  def __repr__(self):
+    """Retrieve a textual representation of the template."""
+    return "Pipeline({c!r})".format(c=self._commands)
+
+
+  def __call__(self, **kwargs):
+    """Execute the pipeline.
+
+      Keyword arguments (e.g., stdin) override those the template was
+      created with. The result is the one of pipeline.
+    """
+    options = self._options
+    if kwargs:
+      _check(kwargs, _PIPELINE_OPTIONS)
+      options = dict(options, **kwargs)
+
+    return pipeline(self._commands, **options)
@@ -33,7 +33,12 @@ def allTests():
   # Explicitly load all tests by name and not using a single discovery
   # to be able to easily deselect parts.
   tests = [
+    "testAsync.py",
+    "testBatch.py",
     "testExecute.py",
+    "testFanout.py",
+    "testServer.py",
+    "testTemplate.py",
     "testUtil.py",
   ]
 
@@ -0,0 +1,246 @@
+# testAsync.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Tests for the asyncio based command execution functionality."""
+
+from asyncio import (
+  gather,
+  run,
+  wait_for,
+)
+from deso.execute import (
+  executeAsync,
+  findCommand,
+  pipelineAsync,
+  ProcessError,
+  SPAWN,
+  springAsync,
+)
+from deso.execute.execute_ import (
+  _fork,
+)
+from os import (
+  waitpid,
+  WNOHANG,
+)
+from pathlib import (
+  Path,
+)
+from sys import (
+  executable,
+)
+from tempfile import (
+  NamedTemporaryFile,
+)
+from time import (
+  monotonic,
+)
+from unittest import (
+  TestCase,
+  main,
+)
+
+
+_TRUE = findCommand("true")
+_FALSE = findCommand("false")
+_ECHO = findCommand("echo")
+_CAT = findCommand("cat")
+_TR = findCommand("tr")
+_SLEEP = findCommand("sleep")
+
+
+class TestAsync(TestCase):
+  """A test case for asyncio based command execution."""
+  def testExecuteAsync(self):
+    """Verify that we can execute a command asynchronously."""
+    out = run(executeAsync(_TR, "e", "a", stdin=b"hello", stdout=b"", stderr=None))
+    self.assertEqual(out, b"hallo")
+
+    out = run(executeAsync(_TRUE))
+    self.assertEqual(out, b"")
+
+
+  def testExecuteAsyncFailure(self):
+    """Verify that failures are reported properly."""
+    with self.assertRaises(ProcessError) as e:
+      run(executeAsync(executable, "-c", "exit(42)"))
+
+    self.assertEqual(e.exception.status, 42)
+
+    for launcher in (None, SPAWN):
+      with self.assertRaises(FileNotFoundError) as e:
+        run(executeAsync("/no/such/file", launcher=launcher))
+
+      self.assertEqual(e.exception.filename, "/no/such/file")
+
+
+  def testPipelineAsync(self):
+    """Verify that we can run a pipeline asynchronously."""
+    data = b"suaaerr" * 100000
+    commands = [
+      [_CAT],
+      [_TR, "a", "c"],
+      [_TR, "r", "s"],
+    ]
+    out, err = run(pipelineAsync(commands, stdin=data, stdout=b"", stderr=b""))
+    self.assertEqual(out, b"success" * 100000)
+    self.assertEqual(err, b"")
+
+    commands = [[_ECHO, "test"], [_FALSE], [_CAT]]
+    with self.assertRaises(ProcessError):
+      run(pipelineAsync(commands))
+
+
+  def testPipelineAsyncCallables(self):
+    """Verify that a pipeline run asynchronously can contain callables."""
+    upper = lambda file_: [file_.read().upper()]
+    commands = [[_ECHO, "test"], upper, [_CAT]]
+    out = run(pipelineAsync(commands, stdout=b"", stderr=None))
+    self.assertEqual(out, b"TEST\n")
+
+
+  def testPipelineAsyncConcurrency(self):
+    """Verify that multiple pipelines can run concurrently."""
+    async def runAll():
+      """Run a couple of pipelines concurrently."""
+      commands = [[_SLEEP, "0.5"], [_ECHO, "done"]]
+      pipelines = [pipelineAsync(commands, stdout=b"", stderr=None) for _ in range(8)]
+      return await gather(*pipelines)
+
+    start = monotonic()
+    results = run(runAll())
+    self.assertLess(monotonic() - start, 2)
+    self.assertEqual(results, [b"done\n"] * 8)
+
+
+  def testSpringAsync(self):
+    """Verify that we can run a spring asynchronously."""
+    commands = [
+      [[_ECHO, "suaaerr"], [_ECHO, "yippie"], [_ECHO, "wohoo"]],
+      [_TR, "a", "c"],
+      [_TR, "r", "s"],
+    ]
+    out = run(springAsync(commands, stdout=b"", stderr=None))
+    self.assertEqual(out, b"success\nyippie\nwohoo\n")
+
+    out = run(springAsync([commands[0]], stdout=b"", stderr=None))
+    self.assertEqual(out, b"suaaerr\nyippie\nwohoo\n")
+
+
+  def testSpringAsyncFileSources(self):
+    """Verify that a spring run asynchronously can contain file sources."""
+    data = b"a" * 200000
+
+    with NamedTemporaryFile() as file_in:
+      file_in.write(data)
+      file_in.flush()
+
+      heads = [Path(file_in.name), [_ECHO, "foo"], Path(file_in.name)]
+      for pipe_cmds in ([], [[_TR, "a", "b"]]):
+        out = run(springAsync([heads] + pipe_cmds, stdout=b"", stderr=None))
+        expected = data + b"foo\n" + data
+        self.assertEqual(out, expected if not pipe_cmds else expected.replace(b"a", b"b"))
+
+      with self.assertRaises(ProcessError):
+        run(springAsync([[Path(file_in.name)] * 2, [_FALSE]]))
+
+      out = run(pipelineAsync([[_CAT]], stdin=Path(file_in.name), stdout=b"", stderr=None))
+      self.assertEqual(out, data)
+
+
+  def testAsyncResourceUsage(self):
+    """Verify that the resource usage of commands run asynchronously is reported."""
+    usage = []
+    run(pipelineAsync([[_ECHO, "test"], [_CAT]], usage=usage))
+    self.assertEqual(len(usage), 2)
+    self.assertGreater(usage[0].ru_maxrss, 0)
+
+    with NamedTemporaryFile() as file_in:
+      usage = []
+      commands = [[[_ECHO, "test"], Path(file_in.name), [_TRUE]], [_CAT]]
+      run(springAsync(commands, usage=usage))
+      self.assertEqual(len(usage), 4)
+      self.assertIsNone(usage[1])
+      self.assertNotIn(None, usage[0:1] + usage[2:])
+
+    usage = []
+    with self.assertRaises(ProcessError) as e:
+      run(springAsync([[[_FALSE], [_TRUE]], [_CAT]], usage=usage))
+
+    self.assertIs(e.exception.usage, usage)
+    self.assertIsNotNone(usage[0])
+    self.assertIsNone(usage[1])
+
+
+  def testSpringAsyncFailure(self):
+    """Verify that failures in a spring are reported properly."""
+    fail = [executable, "-c", "from sys import stdin; stdin.read(); exit(1)"]
+    for commands in [
+      [[[_ECHO, "test"], fail, [_ECHO, "test"]], [_CAT]],
+      [[[_ECHO, "test"], [_ECHO, "test"]], fail],
+    ]:
+      with self.assertRaises(ProcessError) as e:
+        run(springAsync(commands))
+
+      self.assertEqual(e.exception.status, 1)
+      self.assertIn("exit(1)", e.exception.name)
+
+    with self.assertRaises(FileNotFoundError):
+      run(springAsync([[[_ECHO, "test"], ["/no/such/file"]], [_CAT]], stderr=b""))
+
+
+  def testSpringAsyncCancellation(self):
+    """Verify that all commands started are reaped if a spring gets cancelled."""
+    class Launcher:
+      """A launcher recording the IDs of the processes it started."""
+      def __init__(self):
+        self.pids = []
+
+      def launch(self, *args, **kwargs):
+        pid = _fork(*args, **kwargs)
+        self.pids += [pid]
+        return pid
+
+    launcher = Launcher()
+    commands = [[[_ECHO, "test"], [_SLEEP, "0.5"], [_ECHO, "test"]], [_CAT]]
+    with self.assertRaises(TimeoutError):
+      run(wait_for(springAsync(commands, launcher=launcher), 0.1))
+
+    # The pipeline and the two commands of the spring started before
+    # the cancellation.
+    self.assertEqual(len(launcher.pids), 3)
+    for pid in launcher.pids:
+      with self.assertRaises(ChildProcessError):
+        waitpid(pid, WNOHANG)
+
+
+  def testAsyncCancellationWithOutput(self):
+    """Verify that cancelling commands still producing output does not block."""
+    produce = [executable, "-c", "while True: print('y' * 1024)"]
+    for function in (
+      lambda: pipelineAsync([produce], stdout=b""),
+      lambda: springAsync([[[_ECHO, "test"]], produce], stdout=b""),
+      lambda: springAsync([[produce, [_ECHO, "test"]]], stdout=b""),
+    ):
+      with self.assertRaises(TimeoutError):
+        run(wait_for(function(), 0.2))
+
+
+if __name__ == "__main__":
+  main()
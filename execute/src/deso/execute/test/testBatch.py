@@ -0,0 +1,234 @@
+# testAsync.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Tests for the batch execution functionality."""
+
+from deso.execute import (
+  findCommand,
+  OutputLimitError,
+  PipelineBatch,
+  ProcessError,
+  ProcessTimeoutError,
+  RAISE,
+  SPAWN,
+)
+from deso.execute.execute_ import (
+  _fork,
+)
+from os import (
+  waitpid,
+  WNOHANG,
+)
+from sys import (
+  executable,
+)
+from time import (
+  monotonic,
+)
+from unittest import (
+  TestCase,
+  main,
+)
+from unittest.mock import (
+  patch,
+)
+
+
+_TRUE = findCommand("true")
+_ECHO = findCommand("echo")
+_CAT = findCommand("cat")
+_TR = findCommand("tr")
+_SLEEP = findCommand("sleep")
+
+
+class TestBatch(TestCase):
+  """A test case for batch execution."""
+  def testEmptyBatch(self):
+    """Verify that an empty batch can be run."""
+    batch = PipelineBatch()
+    self.assertEqual(len(batch), 0)
+    self.assertEqual(batch.run(), [])
+
+
+  def testInvalidConcurrency(self):
+    """Verify that an invalid concurrency is rejected."""
+    with self.assertRaises(ValueError):
+      PipelineBatch(concurrency=0)
+
+
+  def testResultOrder(self):
+    """Verify that results are reported in the order jobs were added."""
+    for launcher in (None, SPAWN):
+      batch = PipelineBatch(concurrency=3, launcher=launcher)
+      for i in range(10):
+        # Later jobs finish earlier.
+        command = "import time; time.sleep({d}); print({i})"
+        command = command.format(d=(10 - i) / 100, i=i)
+        index = batch.execute(executable, "-c", command, stdout=b"", stderr=None)
+        self.assertEqual(index, i)
+
+      results = batch.run()
+      self.assertEqual(results, [("%d\n" % i).encode() for i in range(10)])
+
+
+  def testMixedJobs(self):
+    """Verify that commands, pipelines, and springs can be mixed in a batch."""
+    batch = PipelineBatch()
+    batch.execute(_TR, "a", "b", stdin=b"aaa", stdout=b"", stderr=None)
+    batch.pipeline([[_ECHO, "hello"], [_TR, "l", "x"]], stdout=b"", stderr=None)
+    batch.spring([[[_ECHO, "foo"], [_ECHO, "bar"]], [_CAT]], stdout=b"", stderr=None)
+    batch.spring([[[_ECHO, "baz"]]], stdout=b"")
+    batch.spring([[[_ECHO, "a"], [_ECHO, "b"], [_ECHO, "c"]]], stdout=b"",
+                 stderr=None, parallel=2)
+
+    out1, out2, out3, (out4, err4), out5 = batch.run()
+    self.assertEqual(out1, b"bbb")
+    self.assertEqual(out2, b"hexxo\n")
+    self.assertEqual(out3, b"foo\nbar\n")
+    self.assertEqual(out4, b"baz\n")
+    self.assertEqual(err4, b"")
+    self.assertEqual(out5, b"a\nb\nc\n")
+
+
+  def testLargeData(self):
+    """Verify that large amounts of data are handled for all jobs concurrently."""
+    data = b"x" * (1024 * 1024)
+    batch = PipelineBatch(concurrency=4)
+    for _ in range(8):
+      batch.pipeline([[_CAT], [_CAT]], stdin=data, stdout=b"", stderr=None)
+
+    self.assertEqual(batch.run(), [data] * 8)
+
+
+  def testFailures(self):
+    """Verify that failures are reported in place of the results."""
+    batch = PipelineBatch()
+    batch.execute(_TRUE, stderr=None)
+    batch.execute(executable, "-c", "import sys; sys.stderr.write('err'); exit(3)")
+    batch.execute("/no/such/file")
+    batch.spring([[[_ECHO, "foo"], [executable, "-c", "exit(4)"], [_ECHO, "bar"]]])
+    batch.execute(_ECHO, "ok", stdout=b"", stderr=None)
+
+    ok, error1, error2, error3, out = batch.run()
+    self.assertIsNone(ok)
+    self.assertIsInstance(error1, ProcessError)
+    self.assertEqual(error1.status, 3)
+    self.assertEqual(error1.stderr, "err")
+    self.assertIsInstance(error2, FileNotFoundError)
+    self.assertIsInstance(error3, ProcessError)
+    self.assertEqual(error3.status, 4)
+    self.assertEqual(out, b"ok\n")
+
+
+  def testStartFailure(self):
+    """Verify that processes started by a job failing to start are reaped."""
+    class Launcher:
+      """A launcher recording the IDs of the processes it started."""
+      def __init__(self):
+        self.pids = []
+
+      def launch(self, *args, **kwargs):
+        pid = _fork(*args, **kwargs)
+        self.pids += [pid]
+        return pid
+
+    launcher = Launcher()
+    batch = PipelineBatch(launcher=launcher)
+    batch.pipeline([[_ECHO, "test"], [_CAT]], timeout=10)
+
+    # Setting up the deadlines of the commands fails once they got
+    # started.
+    with patch("deso.execute.batch._timeouts", side_effect=RuntimeError):
+      error, = batch.run()
+
+    self.assertIsInstance(error, RuntimeError)
+    self.assertEqual(len(launcher.pids), 2)
+    for pid in launcher.pids:
+      with self.assertRaises(ChildProcessError):
+        waitpid(pid, WNOHANG)
+
+
+  def testConcurrency(self):
+    """Verify that jobs actually run concurrently."""
+    batch = PipelineBatch(concurrency=8)
+    for _ in range(8):
+      batch.execute(_SLEEP, "0.3", stderr=None)
+
+    start = monotonic()
+    batch.run()
+    # All eight processes should run at the same time and we should be
+    # done well before they would have been finished sequentially.
+    self.assertLess(monotonic() - start, 1.5)
+
+
+
+  def testTimeouts(self):
+    """Verify that timeouts of individual jobs are honored."""
+    batch = PipelineBatch(concurrency=2)
+    batch.execute(_SLEEP, "10", stderr=None, timeout=0.2)
+    batch.pipeline([[_SLEEP, "10"], [_CAT]], stdout=b"", stderr=None,
+                   timeouts=[0.2, None])
+    batch.spring([[[_ECHO, "foo"], [_SLEEP, "10"]]], stdout=b"", stderr=None,
+                 timeout=0.2)
+    batch.execute(_ECHO, "ok", stdout=b"", stderr=None, timeout=5)
+
+    start = monotonic()
+    error1, error2, error3, out = batch.run()
+    self.assertLess(monotonic() - start, 5)
+    self.assertIsInstance(error1, ProcessTimeoutError)
+    self.assertIsInstance(error2, ProcessTimeoutError)
+    self.assertEqual(error2.stdout, b"")
+    self.assertIsInstance(error3, ProcessTimeoutError)
+    self.assertEqual(error3.stdout, b"foo\n")
+    self.assertEqual(out, b"ok\n")
+
+
+  def testCapture(self):
+    """Verify that output limits and spilling are applied per job."""
+    batch = PipelineBatch()
+    batch.execute(_ECHO, "hello", stdout=b"", stderr=None, max_stdout=2)
+    batch.spring([[[_ECHO, "foo"], [_ECHO, "bar"]]], stdout=b"", stderr=None,
+                 max_stdout=1, overflow=RAISE)
+    batch.execute(_ECHO, "hello", stdout=b"", stderr=None)
+    batch.execute(_ECHO, "hello", stdout=b"", stderr=None, spill=1)
+    batch.execute(_CAT, stdin=b"input", stdout=b"", stderr=None, memfd=0)
+
+    out1, error, out2, out3, out4 = batch.run()
+    self.assertEqual(out1, b"o\n")
+    self.assertIsInstance(error, OutputLimitError)
+    self.assertEqual(out2, b"hello\n")
+    self.assertIsInstance(out3, memoryview)
+    self.assertEqual(out3, b"hello\n")
+    self.assertEqual(out4, b"input")
+
+
+  def testResourceUsage(self):
+    """Verify that the resource usage of the commands of each job is reported."""
+    usage1, usage2 = [], []
+    batch = PipelineBatch()
+    batch.pipeline([[_ECHO, "foo"], [_CAT]], usage=usage1)
+    batch.spring([[[_ECHO, "foo"], [_TRUE]], [_CAT]], parallel=2, usage=usage2)
+    batch.run()
+
+    self.assertEqual(len(usage1), 2)
+    self.assertEqual(len(usage2), 3)
+    self.assertNotIn(None, usage1 + usage2)
+
+if __name__ == "__main__":
+  main()
@@ -22,25 +22,69 @@
 from deso.execute import (
   execute as execute_,
   findCommand,
+  FORK,
   formatCommands,
+  HEAD,
+  isExecutable,
+  OutputLimitError,
   pipeline as pipeline_,
+  pipelineIter,
   ProcessError,
-  spring as spring_
+  ProcessTimeoutError,
+  RAISE,
+  Result,
+  run,
+  setDefaultLauncher,
+  SPAWN,
+  spring as spring_,
+  springIter,
+  TAIL,
+)
+from array import (
+  array,
+)
+from deso.cleanup import (
+  defer,
 )
 from deso.execute.execute_ import (
+  _EPOLL,
+  epoll,
   eventToString,
   EXEC_FAIL,
+  _foreign,
+  _fork,
+  _launchFunction,
+  _Multiplexer,
+  _pipeline as _pipeline_,
+  _PipelineFileDescriptors,
+  _POLL,
 )
 from itertools import (
   permutations,
 )
+from json import (
+  dumps,
+  loads,
+)
+from mmap import (
+  mmap,
+)
 from os import (
+  close as close_,
   environ,
+  listdir,
+  O_CLOEXEC,
+  pipe2,
+  read,
   remove,
+  write,
 )
 from os.path import (
   isfile,
 )
+from pathlib import (
+  Path,
+)
 from re import (
   escape,
 )
@@ -52,6 +96,11 @@ from select import (
   POLLOUT,
   POLLPRI,
 )
+from signal import (
+  SIGKILL,
+  SIGPIPE,
+  SIGTERM,
+)
 from subprocess import (
   CalledProcessError,
   check_call,
@@ -67,10 +116,16 @@ from tempfile import (
 from textwrap import (
   dedent,
 )
+from time import (
+  monotonic,
+)
 from unittest import (
   TestCase,
   main,
 )
+from unittest.mock import (
+  patch,
+)
 
 
 _TRUE = findCommand("true")
@@ -82,19 +137,24 @@ _TR = findCommand("tr")
 _DD = findCommand("dd")
 
 
-def execute(*args, env=None, stdin=None, stdout=None, stderr=None):
+def execute(*args, env=None, stdin=None, stdout=None, stderr=None, launcher=None,
+            **kwargs):
   """Run a program with reading from stderr disabled by default."""
-  return execute_(*args, env=env, stdin=stdin, stdout=stdout, stderr=stderr)
+  return execute_(*args, env=env, stdin=stdin, stdout=stdout, stderr=stderr,
+                  launcher=launcher, **kwargs)
 
 
-def pipeline(commands, env=None, stdin=None, stdout=None, stderr=None):
+def pipeline(commands, env=None, stdin=None, stdout=None, stderr=None, launcher=None,
+             **kwargs):
   """Run a pipeline with reading from stderr disabled by default."""
-  return pipeline_(commands, env=env, stdin=stdin, stdout=stdout, stderr=stderr)
+  return pipeline_(commands, env=env, stdin=stdin, stdout=stdout, stderr=stderr,
+                   launcher=launcher, **kwargs)
 
 
-def spring(commands, env=None, stdout=None, stderr=None):
+def spring(commands, env=None, stdout=None, stderr=None, launcher=None, **kwargs):
   """Run a spring with reading from stderr disabled by default."""
-  return spring_(commands, env=env, stdout=stdout, stderr=stderr)
+  return spring_(commands, env=env, stdout=stdout, stderr=stderr,
+                 launcher=launcher, **kwargs)
 
 
 class TestExecute(TestCase):
@@ -228,6 +288,70 @@ class TestExecute(TestCase):
     self.assertEqual(eventToString(POLLPRI),  "PRI")
 
 
+  def testMultiplexerBackends(self):
+    """Verify that all multiplexer backends dispatch events correctly."""
+    backends = [_POLL] + ([_EPOLL] if epoll is not None else [])
+    with defer() as d:
+      pipes = []
+      for _ in range(100):
+        fd_in, fd_out = pipe2(O_CLOEXEC)
+        d.defer(close_, fd_in)
+        d.defer(close_, fd_out)
+        pipes += [(fd_in, fd_out)]
+
+      with TemporaryFile() as file_:
+        for backend in backends + [None]:
+          mux = _Multiplexer(backend)
+          d.defer(mux.close)
+          events = {}
+          for fd_in, _ in pipes:
+            mux.register(fd_in, POLLIN, lambda e, fd=fd_in: events.update({fd: e}))
+
+          # Regular files are always ready.
+          mux.register(file_.fileno(), POLLOUT, lambda e: events.update({-1: e}))
+          for _, fd_out in pipes[::10]:
+            write(fd_out, b"x")
+
+          mux.poll()
+          expected = {fd_in: POLLIN for fd_in, _ in pipes[::10]}
+          expected[-1] = POLLOUT
+          self.assertEqual(events, expected)
+
+          for fd_in, fd_out in pipes:
+            mux.unregister(fd_in)
+            if fd_in in events:
+              read(fd_in, 1)
+
+          mux.unregister(file_.fileno())
+          self.assertEqual(len(mux), 0)
+          if backend is None:
+            # With many file descriptors registered we switched to epoll.
+            self.assertEqual(mux.backend, backends[-1])
+          else:
+            self.assertEqual(mux.backend, backend)
+
+    with self.assertRaises(ValueError):
+      _Multiplexer("select")
+
+
+  def testExecuteWithEpoll(self):
+    """Verify that pipelines and springs work when being polled by means of epoll."""
+    with patch("deso.execute.execute_._EPOLL_THRESHOLD", 0):
+      data = b"test" * 100000
+      out = pipeline([[_CAT], [_TR, "t", "x"]], stdin=data, stdout=b"")
+      self.assertEqual(out, data.replace(b"t", b"x"))
+
+      with NamedTemporaryFile() as file_in, TemporaryFile() as file_out:
+        file_in.write(data)
+        file_in.flush()
+        # The output of the spring is a regular file, which epoll does
+        # not support.
+        spring_([[Path(file_in.name), [_ECHO, "foo"]]], stdout=file_out.fileno(),
+                stderr=None, parallel=2)
+        file_out.seek(0)
+        self.assertEqual(file_out.read(), data + b"foo\n")
+
+
   def testExecuteErrorEventToStringMultiple(self):
     """Verify that our event to string conversion works as expected."""
     # Note that we cannot say for sure what the order of the event codes
@@ -304,6 +428,15 @@ class TestExecute(TestCase):
     self.assertEqual(output, b"success")
 
 
+  def testExecuteWithUnreadInput(self):
+    """Verify that input not read by a command is reported as a broken pipe."""
+    # The command may terminate at any point while we are writing. Either
+    # way the error has to be the same.
+    for _ in range(10):
+      with self.assertRaises(BrokenPipeError):
+        execute(_TRUE, stdin=b"x" * 10000000)
+
+
   def testExecuteRedirectAll(self):
     """Test that we can redirect stdin, stdout, and stderr at the same time."""
     out, err = execute(_DD, stdin=b"success", stdout=b"", stderr=b"")
@@ -473,6 +606,14 @@ class TestExecute(TestCase):
                "/bin/tr a a"
     self.assertEqual(formatCommands(commands), expected)
 
+    # Case 7) A spring containing file sources.
+    commands = [
+      [Path("/tmp/input1"), ["/bin/echo", "test"], Path("/tmp/input2")],
+      ["/bin/tr", "a", "a"],
+    ]
+    expected = "(< /tmp/input1 + /bin/echo test + < /tmp/input2) | /bin/tr a a"
+    self.assertEqual(formatCommands(commands), expected)
+
 
   def testPipelineSingleProgram(self):
     """Verify that a pipeline can run a single program."""
@@ -535,6 +676,124 @@ class TestExecute(TestCase):
         pipeline(pipe_cmds, stderr=b"some-data")
 
 
+  def testPipelineExecFailureIsPreferred(self):
+    """Verify that exec failures are reported even if a previous command failed as a consequence."""
+    script = "from time import sleep; sleep(0.2); print('x' * 1024 * 1024)"
+    commands = [
+      [executable, "-c", script],
+      ["/no/such/file"],
+    ]
+    with self.assertRaises(FileNotFoundError):
+      pipeline(commands, stderr=b"")
+
+
+  def testPipelineCallables(self):
+    """Verify that Python callables can be used as stages of a pipeline."""
+    def grep(lines):
+      """Filter lines containing a digit."""
+      for line in lines:
+        if any(c in b"0123456789" for c in line):
+          yield line
+
+    def reshape(file_):
+      """Convert a JSON object into a sorted list of its keys."""
+      return [dumps(sorted(loads(file_.read()))).encode()]
+
+    data = b"".join(b"line %d\n" % i if i % 2 else b"line\n" for i in range(100000))
+    expected = b"".join(b"line %d\n" % i for i in range(1, 100000, 2))
+    for launcher in (FORK, SPAWN):
+      for commands in (
+        [[_CAT], grep],
+        [grep, [_CAT]],
+        [[_CAT], grep, [_CAT]],
+        [grep, grep],
+        [grep],
+      ):
+        out = pipeline(commands, stdin=data, stdout=b"", launcher=launcher)
+        self.assertEqual(out, expected)
+
+    commands = [[_ECHO, '{"b": 1, "a": 2}'], reshape, [_TR, "a", "c"]]
+    out = pipeline(commands, stdout=b"")
+    self.assertEqual(out, b'["c", "b"]')
+
+    commands = [[_ECHO, "test"], grep, lambda lines: [b"x"]]
+    self.assertEqual(formatCommands(commands),
+                     "%s test | %s | %s" % (_ECHO, "grep", "<lambda>"))
+
+
+  def testPipelineCallableFailure(self):
+    """Verify that exceptions raised by callable stages are reported as a ProcessError."""
+    def fail(lines):
+      """Consume all input and fail."""
+      for _ in lines:
+        pass
+      raise ValueError("invalid input")
+
+    commands = [[_ECHO, "test"], fail, [_CAT]]
+    with self.assertRaises(ProcessError) as e:
+      pipeline(commands, stderr=b"")
+
+    self.assertEqual(e.exception.status, 1)
+    self.assertEqual(e.exception.name, "fail")
+    self.assertIn("ValueError: invalid input", e.exception.stderr)
+
+    # A stage writing to a closed pipe fails just as a process killed by
+    # SIGPIPE would.
+    def produce(lines):
+      """Produce an endless stream of data."""
+      while True:
+        yield b"x" * 4096
+
+    with self.assertRaises(ProcessError) as e:
+      pipeline([produce, [_TRUE]])
+
+    self.assertEqual(e.exception.status, -SIGPIPE)
+
+    result = run([[_ECHO, "test"], fail], check=False)
+    self.assertEqual(result.statuses, [0, 1])
+    self.assertEqual(result.usage[1], None)
+
+
+  def testPipelineCallableLaunchFailure(self):
+    """Verify that stages are cleaned up if launching a command following them fails."""
+    class Launcher:
+      """A launcher raising an error for commands that do not exist."""
+      def launch(self, command, *args, **kwargs):
+        if not isExecutable(command[0]):
+          raise FileNotFoundError(command[0])
+        return _fork(command, *args, **kwargs)
+
+    upper = lambda file_: [file_.read().upper()]
+    fds = listdir("/proc/self/fd")
+    foreign = dict(_foreign)
+
+    for launcher in (Launcher(), SPAWN):
+      with self.assertRaises(FileNotFoundError):
+        pipeline([upper, ["/no/such/file"]], launcher=launcher)
+
+      self.assertEqual(_foreign, foreign)
+      self.assertEqual(listdir("/proc/self/fd"), fds)
+
+
+  def testPipelineReapsWhilePolling(self):
+    """Verify that processes are reaped as part of polling for data."""
+    with defer() as later:
+      with defer() as here:
+        fds = _PipelineFileDescriptors(later, here, None, b"", None)
+        commands = [[_ECHO, "test"], [_CAT], [_FALSE]]
+        pids, _, _ = _pipeline_(commands, None, fds.stdin, fds.stdout,
+                                fds.stderr, fds.interr, _launchFunction(FORK))
+        for pid in pids:
+          fds.watch(pid)
+
+      for _ in fds.poll():
+        pass
+
+      reaped = fds.reaped()
+      self.assertEqual(reaped[pids[2]], 1)
+      self.assertEqual(set(reaped.keys()), set(pids))
+
+
   def testMultiplePipelineFailures(self):
     """Verify that multiple pipeline failures are reported properly."""
     with self.assertRaises(ProcessError):
@@ -574,6 +833,81 @@ class TestExecute(TestCase):
       self.assertEqual(len(out), len(data))
 
 
+  def testPipelineWithBufferInput(self):
+    """Verify that stdin data can be supplied by any buffer protocol object."""
+    data = b"abc" * 100000
+    commands = [[_CAT], [_TR, "a", "a"]]
+
+    out = pipeline(commands, stdin=bytearray(data), stdout=b"")
+    self.assertEqual(out, data)
+
+    out = pipeline(commands, stdin=memoryview(data)[3:], stdout=b"")
+    self.assertEqual(out, data[3:])
+
+    array_ = array("I", range(100000))
+    out = pipeline(commands, stdin=array_, stdout=b"")
+    self.assertEqual(out, array_.tobytes())
+
+    with TemporaryFile() as file_:
+      file_.write(data)
+      file_.flush()
+
+      with mmap(file_.fileno(), 0) as map_:
+        out = pipeline(commands, stdin=map_, stdout=b"")
+        self.assertEqual(out, data)
+
+
+  def testPipelineWithBufferOutput(self):
+    """Verify that output can be read into a user supplied bytearray."""
+    data = b"x" * 1024 * 1024
+    buf = bytearray(b"initial")
+    out, err = pipeline([[_CAT]], stdin=data, stdout=buf, stderr=bytearray())
+
+    self.assertIs(out, buf)
+    self.assertEqual(out, b"initial" + data)
+    self.assertIsInstance(err, bytearray)
+    self.assertEqual(err, b"")
+
+    # Data is still returned as bytes when bytes were supplied.
+    out = pipeline([[_CAT]], stdin=data, stdout=b"")
+    self.assertIsInstance(out, bytes)
+    self.assertEqual(out, data)
+
+
+  def testPipelineIter(self):
+    """Verify that we can iterate over the output of a pipeline."""
+    data = b"".join(b"line %d\n" % i for i in range(100000)) + b"last"
+    commands = [[_CAT], [_TR, "a", "a"]]
+
+    chunks = list(pipelineIter(commands, stdin=data))
+    self.assertGreater(len(chunks), 1)
+    self.assertEqual(b"".join(chunks), data)
+
+    lines = list(pipelineIter(commands, stdin=data, lines=True))
+    self.assertEqual(lines, data.splitlines(keepends=True))
+
+    self.assertEqual(list(pipelineIter([[_TRUE]])), [])
+
+
+  def testPipelineIterFailure(self):
+    """Verify that errors are reported when iterating over the output of a pipeline."""
+    commands = [[_ECHO, "test"], [_TR, "a", "a"], [_FALSE]]
+    with self.assertRaises(ProcessError):
+      list(pipelineIter(commands))
+
+    with self.assertRaises(FileNotFoundError):
+      list(pipelineIter([["/no/such/file"]]))
+
+    # Closing the iterator early may cause the pipeline to fail because
+    # there is nobody reading the output of the last command anymore.
+    script = "while True: print('y' * 1024)"
+    iterator = pipelineIter([[executable, "-c", script]])
+    self.assertTrue(next(iterator).startswith(b"y"))
+
+    with self.assertRaises(ProcessError):
+      iterator.close()
+
+
   def testPipelineWithFailingCommand(self):
     """Verify that a failing command in a pipeline fails the entire execution."""
     identity = [_TR, "a", "a"]
@@ -704,7 +1038,9 @@ class TestExecute(TestCase):
     """Verify a spring behaves correctly in the face of a command error."""
     path = mktemp()
     regex = r"%s.*No such file or directory" % _CAT
-    benign = [_ECHO, "test2"]
+    # The benign command consumes its input (if any), so that the
+    # commands of the spring do not see a broken pipe.
+    benign = [_TR, "a", "b"]
     faulty = [_CAT, path]
 
     for cmd1, cmd2 in [(benign, faulty), (faulty, benign)]:
@@ -780,10 +1116,758 @@ class TestExecute(TestCase):
       self.assertEqual(file_out.read(), expected)
 
 
+  def testSpringHeadExecFailure(self):
+    """Verify that exec failures of spring heads are reported properly."""
+    for launcher in (FORK, SPAWN):
+      for commands in [[["/no/such/file"], [_TRUE]], [[_TRUE], ["/no/such/file"]]]:
+        with self.assertRaises(FileNotFoundError) as e:
+          spring([commands], stderr=b"", launcher=launcher)
+
+        self.assertEqual(e.exception.filename, "/no/such/file")
+
+
+  def testSpringIter(self):
+    """Verify that we can iterate over the output of a spring."""
+    commands = [
+      [[_ECHO, "suaaerr"], [_ECHO, "yippie"], [_ECHO, "-n", "wohoo"]],
+      [_TR, "a", "c"],
+      [_TR, "r", "s"],
+    ]
+    out = b"".join(springIter(commands))
+    self.assertEqual(out, b"success\nyippie\nwohoo")
+
+    lines = list(springIter(commands, lines=True))
+    self.assertEqual(lines, [b"success\n", b"yippie\n", b"wohoo"])
+
+    with self.assertRaises(ProcessError):
+      list(springIter([[[_ECHO, "test"], [_FALSE]]]))
+
+
+  def testSpringIterClosedEarly(self):
+    """Verify that a command of a spring failing after the iterator got closed is reported."""
+    fail = [executable, "-c", "import time; print('x', flush=True); time.sleep(0.2); exit(3)"]
+    for parallel in (None, 2):
+      iterator = springIter([[fail, [_ECHO, "y"]]], lines=True, parallel=parallel)
+      self.assertEqual(next(iterator), b"x\n")
+
+      with self.assertRaises(ProcessError) as e:
+        iterator.close()
+
+      self.assertEqual(e.exception.status, 3)
+      self.assertIn("exit(3)", e.exception.name)
+
+
+  def testSpringLargeOutput(self):
+    """Verify that spring commands can write more data than fits into a pipe."""
+    command = [_DD, "if=/dev/zero", "bs=1048576", "count=4"]
+    for pipe_cmds in [[], [[_CAT]]]:
+      out = spring([[command, [_ECHO, "-n", "x"], command]] + pipe_cmds, stdout=b"")
+      self.assertEqual(out, bytes(4 * 1048576) + b"x" + bytes(4 * 1048576))
+
+
+  def testParallelSpring(self):
+    """Verify that a parallel spring produces its output in declaration order."""
+    script = dedent("""\
+      import sys, time
+      time.sleep({delay})
+      sys.stdout.write("{text}" * {count})
+    """)
+    heads = []
+    data = b""
+    for i, count in enumerate([1, 100000, 10, 1500000, 0, 70000]):
+      # Earlier commands take longer to produce their output.
+      delay = (6 - i) / 100
+      text = chr(ord("a") + i)
+      heads += [[executable, "-c", script.format(delay=delay, text=text, count=count)]]
+      data += text.encode() * count
+
+    for pipe_cmds, expected in [
+      ([], data),
+      ([[_TR, "a", "A"]], data.replace(b"a", b"A")),
+      ([[_CAT], [_CAT]], data),
+    ]:
+      commands = [heads] + pipe_cmds
+
+      for parallel, launcher in [(1, FORK), (2, FORK), (2, SPAWN), (len(heads) + 1, FORK)]:
+        out = spring(commands, stdout=b"", launcher=launcher, parallel=parallel)
+        self.assertEqual(out, expected)
+
+
+  def testParallelSpringConcurrency(self):
+    """Verify that the commands of a parallel spring run concurrently."""
+    commands = [[[executable, "-c", "import time; time.sleep(0.5)"]] * 4]
+
+    start = monotonic()
+    spring(commands, parallel=4)
+    self.assertLess(monotonic() - start, 1.5)
+
+
+  def testParallelSpringFileDescriptor(self):
+    """Verify that a parallel spring can write to a file descriptor."""
+    with TemporaryFile() as file_out:
+      commands = [[[_ECHO, "-n", str(i) * 10000] for i in range(10)]]
+      spring(commands, stdout=file_out.fileno(), parallel=3)
+
+      file_out.seek(0)
+      expected = b"".join(str(i).encode() * 10000 for i in range(10))
+      self.assertEqual(file_out.read(), expected)
+
+    self.assertIsNone(spring(commands, parallel=3))
+
+
+  def testParallelSpringError(self):
+    """Verify that errors in a parallel spring are reported as for a serial one."""
+    regex = r"^\[Status 1\] %s$" % _FALSE
+
+    for commands in set(permutations([_TRUE, _TRUE, _FALSE])):
+      spring_cmds = [list(map(lambda x: [x], commands[0:2])), [commands[2]]]
+
+      with self.assertRaisesRegex(ProcessError, regex):
+        spring(spring_cmds, stderr=b"", parallel=2)
+
+    # The output of commands following a failed one is discarded.
+    commands = [
+      [[_ECHO, "foo"], [executable, "-c", "exit(3)"], [_ECHO, "bar"]],
+      [_TR, "o", "0"],
+    ]
+    with self.assertRaises(ProcessError) as e:
+      spring(commands, stdout=b"", stderr=b"", parallel=3)
+
+    self.assertEqual(e.exception.status, 3)
+
+    for launcher in (FORK, SPAWN):
+      for commands in [[["/no/such/file"], [_TRUE]], [[_TRUE], ["/no/such/file"]]]:
+        with self.assertRaises(FileNotFoundError) as e:
+          spring([commands], stderr=b"", launcher=launcher, parallel=2)
+
+        self.assertEqual(e.exception.filename, "/no/such/file")
+
+    with self.assertRaises(ValueError):
+      spring([[[_TRUE]]], parallel=0)
+
+
+  def testParallelSpringErrorOutput(self):
+    """Verify that a parallel spring reports the same stderr data on failure as a serial one."""
+    fail = [executable, "-c", "import sys; sys.stderr.write('failed'); exit(1)"]
+    # A command still running once the failure got detected complains
+    # about its output being closed.
+    late = [executable, "-c", "import time; time.sleep(0.2); print('late')"]
+
+    errors = []
+    for parallel in (None, 2):
+      with self.assertRaises(ProcessError) as e:
+        spring([[fail, late]], stderr=b"", parallel=parallel)
+
+      errors += [e.exception.stderr]
+
+    self.assertEqual(errors, ["failed", "failed"])
+
+
+  def testParallelSpringBrokenPipe(self):
+    """Verify that a parallel spring whose output goes away fails as a serial one."""
+    endless = [_CAT, "/dev/zero"]
+    commands = [[endless, [_ECHO, "x"]], [findCommand("head"), "-c", "1"]]
+
+    results = []
+    for parallel in (None, 2):
+      with self.assertRaises(ProcessError) as e:
+        spring(commands, stdout=b"", stderr=b"", parallel=parallel, timeout=10)
+
+      results += [e.exception.status]
+      self.assertRegex(str(e.exception), r"^\[Status [^\]]+\] %s /dev/zero" % _CAT)
+
+    self.assertEqual(results[0], results[1])
+    self.assertNotEqual(results[0], 0)
+
+
+  def testParallelSpringIter(self):
+    """Verify that we can iterate over the output of a parallel spring."""
+    commands = [
+      [[_ECHO, "suaaerr"], [_ECHO, "yippie"], [_ECHO, "-n", "wohoo"]],
+      [_TR, "a", "c"],
+      [_TR, "r", "s"],
+    ]
+    lines = list(springIter(commands, lines=True, parallel=2))
+    self.assertEqual(lines, [b"success\n", b"yippie\n", b"wohoo"])
+
+    with self.assertRaises(ProcessError):
+      list(springIter([[[_ECHO, "test"], [_FALSE]]], parallel=2))
+
+    # Closing the iterator early terminates the command still running
+    # and reaps it. Just as for a pipeline, the command fails because
+    # nobody reads its output anymore.
+    commands = [[[_CAT, "/dev/zero"], [_TRUE]]]
+    iterator = springIter(commands, parallel=2)
+    next(iterator)
+
+    with self.assertRaises(ProcessError):
+      iterator.close()
+
+
+  def testExecuteTimeout(self):
+    """Verify that a command running for too long is terminated."""
+    for launcher in (FORK, SPAWN):
+      command = "import time; print('partial', flush=True); time.sleep(10)"
+      start = monotonic()
+      with self.assertRaises(ProcessTimeoutError) as e:
+        execute(executable, "-c", command, stdout=b"", launcher=launcher,
+                timeout=0.2)
+
+      self.assertLess(monotonic() - start, 5)
+      self.assertEqual(e.exception.timeout, 0.2)
+      self.assertEqual(e.exception.stdout, b"partial\n")
+      self.assertEqual(e.exception.status, -SIGTERM)
+      self.assertTrue(str(e.exception).startswith("[Timeout 0.2s] "))
+
+    # A command finishing in time is not affected.
+    out = execute(_ECHO, "fast", stdout=b"", timeout=5)
+    self.assertEqual(out, b"fast\n")
+
+
+  def testExecuteTimeoutKill(self):
+    """Verify that a command ignoring SIGTERM is killed after the grace period."""
+    command = dedent("""\
+      import signal, sys, time
+      signal.signal(signal.SIGTERM, signal.SIG_IGN)
+      sys.stderr.write("ignoring")
+      sys.stderr.flush()
+      time.sleep(10)
+    """)
+    start = monotonic()
+    with self.assertRaises(ProcessTimeoutError) as e:
+      execute(executable, "-c", command, stderr=b"", timeout=0.2, grace=0.2)
+
+    self.assertLess(monotonic() - start, 5)
+    self.assertEqual(e.exception.status, -SIGKILL)
+    self.assertEqual(e.exception.stderr, "ignoring")
+    self.assertIsNone(e.exception.stdout)
+
+
+  def testExecuteTimeoutProcessGroup(self):
+    """Verify that children of a timed out command are terminated as well."""
+    command = "{sleep} 10 & wait".format(sleep=findCommand("sleep"))
+    start = monotonic()
+    with self.assertRaises(ProcessTimeoutError):
+      # The background process inherits our stdout. Unless it is
+      # terminated we would not see EOF on it.
+      execute(findCommand("sh"), "-c", command, stdout=b"", timeout=0.2)
+
+    self.assertLess(monotonic() - start, 5)
+
+
+  def testPipelineTimeouts(self):
+    """Verify that per-command timeouts of a pipeline work as expected."""
+    commands = [
+      [executable, "-c", "import time; time.sleep(10)"],
+      [_CAT],
+    ]
+    with self.assertRaises(ProcessTimeoutError) as e:
+      pipeline(commands, stdout=b"", timeouts=[0.2, None])
+
+    self.assertEqual(e.exception.name, formatCommands([commands[0]]))
+    self.assertEqual(e.exception.status, -SIGTERM)
+    self.assertEqual(e.exception.stdout, b"")
+
+    with self.assertRaises(ProcessTimeoutError) as e:
+      pipeline(commands, stdout=b"", timeout=0.2, timeouts=[None, 5])
+
+    self.assertEqual(e.exception.name, formatCommands(commands))
+
+    with self.assertRaises(ValueError):
+      pipeline(commands, timeouts=[1])
+
+
+  def testSpringTimeout(self):
+    """Verify that a spring can time out."""
+    sleep = [executable, "-c", "import time; time.sleep(10)"]
+    for parallel in (None, 2):
+      commands = [[[_ECHO, "first"], sleep, [_ECHO, "never"]], [_CAT]]
+      start = monotonic()
+      with self.assertRaises(ProcessTimeoutError) as e:
+        spring(commands, stdout=b"", parallel=parallel, timeout=0.2)
+
+      self.assertLess(monotonic() - start, 5)
+      self.assertTrue(e.exception.stdout.startswith(b"first\n"))
+      self.assertNotIn(b"never", e.exception.stdout)
+
+    with self.assertRaises(ProcessTimeoutError) as e:
+      spring([[[_ECHO, "first"], sleep]], stdout=b"", timeouts=[[None, 0.2]])
+
+    self.assertEqual(e.exception.name, formatCommands([sleep]))
+    self.assertEqual(e.exception.stdout, b"first\n")
+
+
+  def testOutputLimitHead(self):
+    """Verify that only the first bytes of an output are kept with the HEAD policy."""
+    data = bytes(range(256)) * 1024
+    for limit in (0, 1, 4095, 4096, 100000, len(data), 2 * len(data)):
+      out = execute(_CAT, stdin=data, stdout=b"", max_stdout=limit, overflow=HEAD)
+      self.assertEqual(out, data[:limit])
+
+    # The limit applies to the data read, not the initial contents.
+    out = bytearray(b"initial")
+    result = execute(_CAT, stdin=data, stdout=out, max_stdout=10, overflow=HEAD)
+    self.assertIs(result, out)
+    self.assertEqual(out, b"initial" + data[:10])
+
+
+  def testOutputLimitTail(self):
+    """Verify that only the last bytes of an output are kept with the TAIL policy."""
+    data = bytes(range(256)) * 1024
+    for limit in (0, 1, 4095, 4096, 100000, len(data), 2 * len(data)):
+      out = pipeline([[_CAT], [_CAT]], stdin=data, stdout=b"", max_stdout=limit)
+      self.assertEqual(out, data[len(data) - limit:] if limit else b"")
+
+    commands = [[[_ECHO, "foo"], [_CAT]], [_CAT]]
+    out = spring(commands, stdout=b"", max_stdout=5, overflow=TAIL, parallel=2)
+    self.assertEqual(out, b"foo\n")
+
+
+  def testOutputLimitStderr(self):
+    """Verify that a ProcessError contains only the last bytes of stderr."""
+    command = "import sys; sys.stderr.write('x' * 1000000 + 'the end'); exit(1)"
+    with self.assertRaises(ProcessError) as e:
+      execute(executable, "-c", command, stderr=b"", max_stderr=12)
+
+    self.assertEqual(e.exception.status, 1)
+    self.assertEqual(e.exception.stderr, "xxxxxthe end")
+
+
+  def testOutputLimitRaise(self):
+    """Verify that an OutputLimitError is raised with the RAISE policy."""
+    with self.assertRaises(OutputLimitError) as e:
+      execute(_CAT, "/dev/zero", stdout=b"", max_stdout=1024, overflow=RAISE)
+
+    self.assertEqual(e.exception.stream, "stdout")
+    self.assertEqual(e.exception.limit, 1024)
+    self.assertTrue(str(e.exception).startswith("[Limit 1024b exceeded on stdout] "))
+
+    command = "import sys; sys.stderr.write('e' * 100)"
+    with self.assertRaises(OutputLimitError) as e:
+      spring([[[_TRUE], [executable, "-c", command]]], stderr=b"",
+             max_stderr=10, overflow=RAISE)
+
+    self.assertEqual(e.exception.stream, "stderr")
+    self.assertEqual(e.exception.stderr, "e" * 10)
+
+    # Staying within the limit is fine.
+    out = execute(_ECHO, "ok", stdout=b"", max_stdout=3, overflow=RAISE)
+    self.assertEqual(out, b"ok\n")
+
+
+  def testOutputLimitInvalid(self):
+    """Verify that invalid output limits are rejected."""
+    with self.assertRaises(ValueError):
+      execute(_TRUE, stdout=b"", max_stdout=-1)
+
+    with self.assertRaises(ValueError):
+      execute(_TRUE, stdout=b"", max_stdout=1, overflow="middle")
+
+
+  def testOutputBuffer(self):
+    """Verify that output can be read into a user provided buffer."""
+    data = bytes(range(256)) * 1024
+
+    for size in (0, 1, 4095, 4096, 100000, len(data), 2 * len(data)):
+      for overflow in (HEAD, TAIL):
+        buf = bytearray(size)
+        count = pipeline([[_CAT], [_CAT]], stdin=data, stdout=memoryview(buf),
+                         overflow=overflow)
+        self.assertEqual(count, min(size, len(data)))
+
+        expected = data[:size] if overflow == HEAD else data[len(data) - size:]
+        self.assertEqual(buf[:count], expected if size else b"")
+
+    # Any writable object supporting the buffer protocol works.
+    buf = array("I", [0] * 4)
+    count = execute(_ECHO, "-n", "x" * 16, stdout=buf)
+    self.assertEqual(count, 16)
+    self.assertEqual(buf.tobytes(), b"x" * 16)
+
+    with mmap(-1, 1024) as buf:
+      count = spring([[[_ECHO, "foo"], [_ECHO, "bar"]]], stdout=buf)
+      self.assertEqual(count, 8)
+      self.assertEqual(buf[:count], b"foo\nbar\n")
+
+    with self.assertRaises(OutputLimitError) as e:
+      execute(_CAT, "/dev/zero", stdout=memoryview(bytearray(10)), overflow=RAISE)
+
+    self.assertEqual(e.exception.limit, 10)
+
+    # Output not fitting into the buffer is reported by default, instead
+    # of being truncated silently.
+    with self.assertRaises(OutputLimitError) as e:
+      execute(_ECHO, "-n", "x" * 16, stdout=memoryview(bytearray(10)))
+
+    self.assertEqual(e.exception.limit, 10)
+
+    with self.assertRaises(OutputLimitError):
+      spring([[[_ECHO, "foo"], [_ECHO, "bar"]]], stdout=memoryview(bytearray(4)))
+
+    # Exactly filling the buffer is fine.
+    count = execute(_CAT, stdin=data, stdout=memoryview(bytearray(len(data))),
+                    overflow=RAISE)
+    self.assertEqual(count, len(data))
+
+    with self.assertRaises(ValueError):
+      execute(_TRUE, stdout=memoryview(bytearray(1)), max_stdout=1)
+
+    with self.assertRaises(ValueError):
+      execute(_TRUE, stdout=memoryview(bytearray(1)), spill=1)
+
+    # A read-only buffer still provides the initial data.
+    out = execute(_ECHO, "foo", stdout=memoryview(b"bar"))
+    self.assertEqual(out, b"barfoo\n")
+
+
+  def testSpill(self):
+    """Verify that large outputs can be spilled into a file."""
+    data = bytes(range(256)) * 4096
+
+    def run(spill, data=data):
+      """Run a pipeline spilling its output."""
+      out = pipeline([[_CAT], [_CAT]], stdin=data, stdout=b"", spill=spill)
+      self.assertIsInstance(out, memoryview)
+      self.assertTrue(out.readonly)
+      self.assertEqual(out, data)
+
+    for spill in (0, 1, 4096, len(data) - 1, len(data), 2 * len(data)):
+      run(spill)
+
+    run(0, b"")
+
+    # Without splice and memfd_create data is copied into a temporary
+    # file.
+    with patch("deso.execute.execute_.splice", None),\
+         patch("deso.execute.execute_.memfd_create", None):
+      run(1)
+
+    commands = [[[_ECHO, "foo"], [_CAT, "-"], [_ECHO, "bar"]]]
+    for parallel in (None, 2):
+      out = spring(commands, stdout=b"head", spill=3, parallel=parallel)
+      self.assertEqual(out, b"headfoo\nbar\n")
+
+
+  def testSpillInvalid(self):
+    """Verify that invalid spill configurations are rejected."""
+    with self.assertRaises(ValueError):
+      execute(_TRUE, stdout=b"", spill=-1)
+
+    with self.assertRaises(ValueError):
+      execute(_TRUE, stdout=b"", spill=1, max_stdout=1)
+
+    with self.assertRaises(ValueError):
+      execute(_TRUE, stdout=bytearray(), spill=1)
+
+
+  def testMemfdInput(self):
+    """Verify that large stdin data can be passed in through a memfd."""
+    data = bytes(range(256)) * 4096
+
+    for memfd in (0, 1, len(data) - 1, len(data), 2 * len(data)):
+      out = pipeline([[_CAT], [_CAT]], stdin=data, stdout=b"", memfd=memfd)
+      self.assertEqual(out, data)
+
+    out = execute(_CAT, stdin=memoryview(data)[1:], stdout=b"", memfd=0)
+    self.assertEqual(out, data[1:])
+
+    # The first command's stdin is a file and not a pipe.
+    command = [executable, "-c",
+               "import os, stat, sys;"
+               "mode = os.fstat(0).st_mode;"
+               "sys.stdin.buffer.read();"
+               "print(stat.S_ISREG(mode))"]
+    out = execute(*command, stdin=data, stdout=b"", memfd=0)
+    self.assertEqual(out, b"True\n")
+
+    # Without memfd_create data is written to a pipe.
+    with patch("deso.execute.execute_.memfd_create", None):
+      out = execute(*command, stdin=data, stdout=b"", memfd=0)
+      self.assertEqual(out, b"False\n")
+
+    with self.assertRaises(ValueError):
+      execute(_CAT, stdin=data, stdout=b"", memfd=-1)
+
+
   # TODO: We need more tests for the spring functionality, especially
   #       with respect to the return values.
 
 
+  def testFileSourceInput(self):
+    """Verify that stdin can be read from a file source."""
+    data = bytes(range(256)) * 1024
+
+    with NamedTemporaryFile() as file_in:
+      file_in.write(data)
+      file_in.flush()
+
+      out = execute(_CAT, stdin=Path(file_in.name), stdout=b"")
+      self.assertEqual(out, data)
+
+      # A file object is read from its current position.
+      file_in.seek(256)
+      out = pipeline([[_CAT], [_CAT]], stdin=file_in, stdout=b"")
+      self.assertEqual(out, data[256:])
+
+    with self.assertRaises(FileNotFoundError):
+      execute(_CAT, stdin=Path(mktemp()))
+
+
+  def testSpringFileSources(self):
+    """Verify that a spring can contain file sources."""
+    data1 = b"a" * 200000
+    data2 = bytes(range(256)) * 1024
+
+    with NamedTemporaryFile() as file1, NamedTemporaryFile() as file2:
+      file1.write(data1)
+      file1.flush()
+      file2.write(data2)
+      file2.flush()
+
+      heads = [Path(file1.name), [_ECHO, "foo"], file2, Path(file1.name)]
+      expected = data1 + b"foo\n" + data2 + data1
+
+      def run(**kwargs):
+        """Run springs with file sources in various configurations."""
+        for pipe_cmds in ([], [[_CAT]], [[_CAT], [_CAT]]):
+          for parallel in (None, 1, 3):
+            file2.seek(0)
+            out = spring([heads] + pipe_cmds, stdout=b"", parallel=parallel, **kwargs)
+            self.assertEqual(out, expected)
+
+        with TemporaryFile() as file_out:
+          file2.seek(0)
+          spring([heads], stdout=file_out.fileno(), **kwargs)
+          file_out.seek(0)
+          self.assertEqual(file_out.read(), expected)
+
+      run()
+      run(launcher=SPAWN)
+
+      # Without splice and sendfile data is copied through a buffer.
+      with patch("deso.execute.execute_.splice", None),\
+           patch("deso.execute.execute_.sendfile", None):
+        run()
+
+      # A command following a file source is reported properly on
+      # failure.
+      commands = [[Path(file1.name)], [_FALSE]]
+      with self.assertRaisesRegex(ProcessError, escape(_FALSE)):
+        spring(commands)
+
+      # The output of a file source may not be of interest.
+      commands = [[Path(file1.name), Path(file1.name)], [_TRUE]]
+      for parallel in (None, 2):
+        spring(commands, parallel=parallel)
+
+    with self.assertRaises(FileNotFoundError):
+      spring([[[_ECHO, "foo"], Path(mktemp())]])
+
+
+  def testResourceUsage(self):
+    """Verify that the resource usage of all commands is reported."""
+    busy = [executable, "-c", "sum(range(10 ** 7))"]
+
+    usage = []
+    execute(*busy, usage=usage)
+    self.assertEqual(len(usage), 1)
+    self.assertGreater(usage[0].ru_utime, 0.05)
+    self.assertGreater(usage[0].ru_maxrss, 0)
+
+    usage = []
+    pipeline([[_ECHO, "foo"], busy, [_CAT]], usage=usage)
+    self.assertEqual(len(usage), 3)
+    self.assertGreater(usage[1].ru_utime, usage[0].ru_utime)
+
+    # Commands not started are reported as None.
+    usage = []
+    with self.assertRaises(ProcessError) as e:
+      pipeline([[_FALSE], [_CAT]], usage=usage)
+
+    self.assertIs(e.exception.usage, usage)
+    self.assertEqual(len(usage), 2)
+    self.assertIsNotNone(usage[0])
+
+    usage = []
+    with self.assertRaises(FileNotFoundError):
+      pipeline([[_ECHO, "foo"], ["/no/such/file"]], usage=usage)
+
+    self.assertEqual(len(usage), 2)
+
+    with NamedTemporaryFile() as file_:
+      for parallel in (None, 2):
+        usage = []
+        commands = [[[_ECHO, "foo"], Path(file_.name), busy], [_CAT]]
+        spring(commands, parallel=parallel, usage=usage)
+        self.assertEqual(len(usage), 4)
+        self.assertIsNotNone(usage[0])
+        self.assertIsNone(usage[1])
+        self.assertGreater(usage[2].ru_utime, 0.05)
+        self.assertIsNotNone(usage[3])
+
+      usage = []
+      with self.assertRaises(ProcessError):
+        spring([[[_FALSE], [_ECHO, "foo"]], [_CAT]], usage=usage)
+
+      self.assertIsNotNone(usage[0])
+      self.assertIsNone(usage[1])
+
+
+  def testTrace(self):
+    """Verify that lifecycle events are reported to a tracer."""
+    for launcher in (FORK, SPAWN):
+      events = []
+      trace = lambda event, time, subject: events.append((event, time, subject))
+      pipeline([[_CAT], [_CAT]], stdin=b"foo", stdout=b"", stderr=b"",
+               launcher=launcher, trace=trace)
+
+      times = [time for _, time, _ in events]
+      self.assertEqual(times, sorted(times))
+
+      forks = [subject for event, _, subject in events if event == "fork"]
+      exits = [subject for event, _, subject in events if event == "exit"]
+      self.assertEqual(len(forks), 2)
+      self.assertEqual(sorted(forks), sorted(exits))
+
+      names = [(event, subject) for event, _, subject in events]
+      for name in [("exec", None), ("output", "stdout"), ("eof", "stdout"),
+                   ("eof", "stderr"), ("eof", "stdin")]:
+        self.assertIn(name, names)
+
+      # No output was written to stderr.
+      self.assertNotIn(("output", "stderr"), names)
+      self.assertLess(names.index(("output", "stdout")), names.index(("eof", "stdout")))
+
+    events = []
+    trace = lambda event, time, subject: events.append(event)
+    spring([[[_ECHO, "foo"], [_ECHO, "bar"]], [_CAT]], trace=trace)
+    self.assertEqual(events.count("fork"), 3)
+    self.assertEqual(events.count("exit"), 3)
+    self.assertEqual(events.count("exec"), 1)
+
+    # An exec failure is not reported as success.
+    events = []
+    with self.assertRaises(FileNotFoundError):
+      execute("/no/such/file", trace=trace)
+
+    self.assertNotIn("exec", events)
+
+
+  def testRun(self):
+    """Verify that run reports the outcome of a pipeline in a Result object."""
+    result = run([[_ECHO, "hällo"], [_TR, "h", "H"]])
+    self.assertIsInstance(result, Result)
+    self.assertEqual(result.stdout, b"H\xc3\xa4llo\n")
+    self.assertEqual(result.stderr, b"")
+    self.assertEqual(result.stdoutText, "Hällo\n")
+    self.assertIs(result.stdoutText, result.stdoutText)
+    self.assertEqual(result.stderrText, "")
+    self.assertEqual(result.statuses, [0, 0])
+    self.assertEqual(result.status, 0)
+    self.assertEqual(len(result.usage), 2)
+    self.assertEqual(len(result.durations), 2)
+    for duration in result.durations:
+      self.assertGreater(duration, 0)
+
+    with self.assertRaises(AttributeError):
+      result.foo = 42
+
+    # Data is read into a user provided bytearray directly.
+    out = bytearray()
+    result = run([[_CAT]], stdin=b"data", stdout=out, stderr=None)
+    self.assertIs(result.stdout, out)
+    self.assertEqual(out, b"data")
+    self.assertIsNone(result.stderr)
+    self.assertIsNone(result.stderrText)
+
+    commands = [[executable, "-c", "exit(3)"], [_CAT]]
+    with self.assertRaises(ProcessError):
+      run(commands)
+
+    result = run(commands, check=False)
+    self.assertEqual(result.statuses, [3, 0])
+    self.assertEqual(result.status, 3)
+
+    with self.assertRaises(FileNotFoundError):
+      run([["/no/such/file"]], check=False)
+
+
+  def testRunSpring(self):
+    """Verify that run can execute a spring."""
+    with NamedTemporaryFile() as file_:
+      file_.write(b"file\n")
+      file_.flush()
+
+      commands = [[[_ECHO, "foo"], Path(file_.name), [_FALSE], [_ECHO, "bar"]], [_CAT]]
+      for parallel in (None, 2):
+        result = run(commands, parallel=parallel, check=False)
+        self.assertEqual(result.stdout, b"foo\nfile\n")
+        self.assertEqual(result.statuses[:3], [0, None, 1])
+        self.assertEqual(result.statuses[4], 0)
+        self.assertIsNone(result.durations[1])
+        self.assertIsNone(result.usage[1])
+        self.assertEqual(result.status, 1)
+
+      result = run([commands[0][:2]])
+      self.assertEqual(result.stdoutText, "foo\nfile\n")
+
+    with self.assertRaises(ValueError):
+      run([[[_ECHO, "foo"]]], stdin=b"")
+
+
+  def testSpawnLauncher(self):
+    """Verify that processes can be launched using posix_spawn."""
+    out = execute(_TR, "e", "a", stdin=b"hello", stdout=b"", launcher=SPAWN)
+    self.assertEqual(out, b"hallo")
+
+    commands = [
+      [_ECHO, "suaaerr"],
+      [_TR, "a", "c"],
+      [_TR, "r", "s"],
+    ]
+    out = pipeline(commands, stdout=b"", launcher=SPAWN)
+    self.assertEqual(out, b"success\n")
+
+    commands = [
+      [[_ECHO, "suaaerr"], [_ECHO, "yippie"]],
+      [_TR, "a", "c"],
+      [_TR, "r", "s"],
+    ]
+    out = spring(commands, stdout=b"", launcher=SPAWN)
+    self.assertEqual(out, b"success\nyippie\n")
+
+
+  def testSpawnLauncherErrors(self):
+    """Verify that errors are reported the same way for all launchers."""
+    with self.assertRaises(ProcessError) as e:
+      execute(executable, "-c", "exit(42)", launcher=SPAWN)
+
+    self.assertEqual(e.exception.status, 42)
+
+    for pipe_cmds in set(permutations(["/no/such/file", _TRUE, _TRUE])):
+      pipe_cmds = list(map(lambda x: [x], pipe_cmds))
+      with self.assertRaises(FileNotFoundError) as e:
+        pipeline(pipe_cmds, stderr=b"", launcher=SPAWN)
+
+      self.assertEqual(e.exception.filename, "/no/such/file")
+
+
+  def testDefaultLauncher(self):
+    """Verify that the default launcher can be changed."""
+    setDefaultLauncher(SPAWN)
+    try:
+      out = pipeline([[_ECHO, "spawned"]], stdout=b"")
+      self.assertEqual(out, b"spawned\n")
+    finally:
+      setDefaultLauncher(FORK)
+
+    with self.assertRaises(ValueError):
+      setDefaultLauncher("vfork")
+
+    with self.assertRaises(ValueError):
+      execute(_TRUE, launcher="vfork")
+
+
   def testBackgroundTaskIsWaited(self):
     """Verify that if a started program forks we can see its output as well."""
     def runAndRead(close=False):
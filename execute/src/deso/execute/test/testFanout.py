@@ -0,0 +1,177 @@
+# testAsync.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+
+"""Tests for fanning out the output of a pipeline to several pipelines."""
+
+from deso.execute import (
+  fanout,
+  findCommand,
+  ProcessError,
+  SPAWN,
+)
+from deso.execute.fanout_ import (
+  _libcTee,
+)
+from os import (
+  close as close_,
+  pipe,
+  read,
+)
+from sys import (
+  executable,
+)
+from tempfile import (
+  TemporaryFile,
+)
+from unittest import (
+  TestCase,
+  main,
+)
+from unittest.mock import (
+  patch,
+)
+
+
+_FALSE = findCommand("false")
+_ECHO = findCommand("echo")
+_CAT = findCommand("cat")
+_TR = findCommand("tr")
+_HEAD = findCommand("head")
+_TRUE = findCommand("true")
+
+
+class TestFanout(TestCase):
+  """A test case for fan-outs."""
+  def testFanout(self):
+    """Verify that the output of a pipeline reaches all branches."""
+    branches = [
+      [[_CAT]],
+      [[_TR, "l", "x"]],
+      [[_CAT], [_TR, "h", "j"]],
+    ]
+    for launcher in (None, SPAWN):
+      out = fanout([[_ECHO, "hello"], [_CAT]], branches, stdout=b"", stderr=None,
+                   launcher=launcher)
+      self.assertEqual(out, [b"hello\n", b"hexxo\n", b"jello\n"])
+
+
+  def testFanoutLargeData(self):
+    """Verify that large amounts of data are duplicated correctly."""
+    data = bytes(range(256)) * 40000
+    # One of the branches is considerably slower than the others, making
+    # it lag behind.
+    slow = [executable, "-c", "from sys import stdin, stdout; from time import sleep\n"
+            "while True:\n"
+            "  b = stdin.buffer.read1(4096)\n"
+            "  if not b: break\n"
+            "  stdout.buffer.write(b); sleep(0.0001)"]
+    branches = [[[_CAT]], [slow], [[_CAT], [_CAT]]]
+
+    for tee in (_libcTee, None):
+      with patch("deso.execute.fanout_._libcTee", tee):
+        out, err = fanout([[_CAT]], branches, stdin=data, stdout=b"")
+        self.assertEqual(out, [data] * 3)
+        self.assertEqual(err, b"")
+
+
+  def testFanoutOutputs(self):
+    """Verify that outputs can be provided per branch."""
+    data = b"test" * 10000
+    array = bytearray(b"x")
+    fd_in, fd_out = pipe()
+    try:
+      with TemporaryFile() as file_:
+        outs = [array, None, fd_out, b"", file_.fileno()]
+        out = fanout([[_CAT]], [[[_CAT]]] * 5, stdin=data, stdout=outs,
+                     stderr=None)
+        close_(fd_out)
+        fd_out = None
+
+        self.assertIs(out[0], array)
+        self.assertEqual(out, [b"x" + data, None, None, data, None])
+        self.assertEqual(read(fd_in, len(data) + 1), data)
+        file_.seek(0)
+        self.assertEqual(file_.read(), data)
+    finally:
+      close_(fd_in)
+      if fd_out is not None:
+        close_(fd_out)
+
+    out = fanout([[_ECHO, "test"]], [[[_CAT]]], stderr=None)
+    self.assertIsNone(out)
+
+    with self.assertRaises(ValueError):
+      fanout([[_ECHO, "test"]], [[[_CAT]]] * 2, stdout=bytearray())
+
+    with self.assertRaises(ValueError):
+      fanout([[_ECHO, "test"]], [[[_CAT]]] * 2, stdout=[b""])
+
+    with self.assertRaises(ValueError):
+      fanout([[_ECHO, "test"]], [])
+
+
+  def testFanoutBrokenBranch(self):
+    """Verify that branches not reading their entire input do not affect the others."""
+    data = b"a\n" * 500000
+    branches = [[[_HEAD, "-n", "1"]], [[_CAT]], [[_TRUE]]]
+    for tee in (_libcTee, None):
+      with patch("deso.execute.fanout_._libcTee", tee):
+        out = fanout([[_CAT]], branches, stdin=data, stdout=b"", stderr=None)
+        self.assertEqual(out, [b"a\n", data, b""])
+
+    # If no branch reads, the pipeline sees a broken pipe.
+    with self.assertRaises(ProcessError):
+      fanout([[_HEAD, "-c", "1000000", "/dev/zero"]], [[[_TRUE]]] * 2, stderr=None)
+
+
+  def testFanoutFailure(self):
+    """Verify that failures of all branches are reported."""
+    fail = [executable, "-c", "from sys import stdin, stderr; stdin.read(); "
+            "stderr.write('failure'); exit(3)"]
+    for commands, branches in [
+      ([[_ECHO, "test"], fail], [[[_CAT]], [[_CAT]]]),
+      ([[_ECHO, "test"]], [[[_CAT]], [fail]]),
+      ([[_ECHO, "test"]], [[[_CAT]], [[_CAT], fail]]),
+    ]:
+      usage = []
+      with self.assertRaises(ProcessError) as e:
+        fanout(commands, branches, usage=usage)
+
+      self.assertEqual(e.exception.status, 3)
+      self.assertIn("exit(3)", e.exception.name)
+      self.assertEqual(e.exception.stderr, "failure")
+      self.assertEqual(len(usage), len(commands) + sum(map(len, branches)))
+      self.assertNotIn(None, usage)
+
+    # The pipeline is reported first.
+    with self.assertRaises(ProcessError) as e:
+      fanout([[_FALSE]], [[[_CAT], fail]])
+
+    self.assertEqual(e.exception.name, _FALSE)
+
+    for launcher in (None, SPAWN):
+      with self.assertRaises(FileNotFoundError) as e:
+        fanout([[_ECHO, "test"]], [[[_CAT]], [["/no/such/file"]]], launcher=launcher)
+
+      self.assertEqual(e.exception.filename, "/no/such/file")
+
+
+if __name__ == "__main__":
+  main()
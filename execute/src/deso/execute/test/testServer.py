@@ -0,0 +1,252 @@
+# testAsync.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+"""Tests for the fork server."""
+
+from asyncio import (
+  run,
+)
+from deso.execute import (
+  execute,
+  executeAsync,
+  findCommand,
+  FORK,
+  ForkServer,
+  pipeline,
+  pipelineAsync,
+  PipelineBatch,
+  ProcessError,
+  ProcessTimeoutError,
+  setDefaultLauncher,
+  spring,
+)
+from deso.execute.async_ import (
+  _tryWaitpid as tryWaitpid_,
+)
+from deso.execute.execute_ import (
+  _pidfd,
+  _reap,
+)
+from os import (
+  close as close_,
+  devnull,
+  getpid,
+  O_RDWR,
+  open as open_,
+  WNOHANG,
+)
+from select import (
+  POLLIN,
+  poll,
+)
+from sys import (
+  executable,
+)
+from threading import (
+  Thread,
+)
+from unittest import (
+  TestCase,
+  main,
+)
+from unittest.mock import (
+  patch,
+)
+
+
+_FALSE = findCommand("false")
+_ECHO = findCommand("echo")
+_CAT = findCommand("cat")
+_TR = findCommand("tr")
+_SLEEP = findCommand("sleep")
+
+
+class TestServer(TestCase):
+  """A test case for the fork server."""
+  @classmethod
+  def setUpClass(cls):
+    """Start the fork server shared by all tests."""
+    cls._server = ForkServer()
+
+
+  @classmethod
+  def tearDownClass(cls):
+    """Terminate the fork server."""
+    cls._server.close()
+
+
+  def testExecute(self):
+    """Verify that commands can be executed by the fork server."""
+    server = self._server
+    out, _ = execute(_ECHO, "test", stdout=b"", launcher=server)
+    self.assertEqual(out, b"test\n")
+
+    # The started process is not a child of ours.
+    script = "from os import getppid; print(getppid())"
+    out, _ = execute(executable, "-c", script, stdout=b"", launcher=server)
+    self.assertNotEqual(int(out), getpid())
+
+    commands = [[_CAT], [_TR, "a", "b"], [_CAT]]
+    out, _ = pipeline(commands, stdin=b"a" * 100000, stdout=b"", launcher=server)
+    self.assertEqual(out, b"b" * 100000)
+
+    commands = [[[_ECHO, "foo"], [_ECHO, "bar"]], [_CAT]]
+    for parallel in (None, 2):
+      out, _ = spring(commands, stdout=b"", parallel=parallel, launcher=server)
+      self.assertEqual(out, b"foo\nbar\n")
+
+
+  def testErrors(self):
+    """Verify that errors are reported just as for other launchers."""
+    server = self._server
+    with self.assertRaises(ProcessError) as e:
+      execute(executable, "-c", "exit(42)", launcher=server)
+
+    self.assertEqual(e.exception.status, 42)
+
+    with self.assertRaises(FileNotFoundError) as e:
+      execute("/no/such/file", launcher=server)
+
+    self.assertEqual(e.exception.filename, "/no/such/file")
+
+    with self.assertRaises(ProcessTimeoutError):
+      execute(_SLEEP, "10", launcher=server, timeout=0.1)
+
+
+  def testUsage(self):
+    """Verify that the resource usage of processes is forwarded."""
+    usage = []
+    execute(_ECHO, launcher=self._server, usage=usage)
+    self.assertGreater(usage[0].ru_maxrss, 0)
+
+
+  def testEnvironment(self):
+    """Verify that the environment is passed to the server."""
+    out, _ = execute(executable, "-c", "import os; print(os.environ['FOO'])",
+                     env={"FOO": "bar"}, stdout=b"", launcher=self._server)
+    self.assertEqual(out, b"bar\n")
+
+
+  def testAsync(self):
+    """Verify that the fork server can be used asynchronously."""
+    out, _ = run(executeAsync(_ECHO, "test", stdout=b"", launcher=self._server))
+    self.assertEqual(out, b"test\n")
+
+
+  def testWaitReadiness(self):
+    """Verify that a process can be waited for once its file descriptor became readable."""
+    server = self._server
+    null = open_(devnull, O_RDWR)
+    try:
+      pid = server.launch([_SLEEP, "0.1"], None, null, null, null, null)
+    finally:
+      close_(null)
+
+    fd = _pidfd(pid)
+    try:
+      poller = poll()
+      poller.register(fd, POLLIN)
+      self.assertEqual(poller.poll(0), [])
+      self.assertNotEqual(poller.poll(), [])
+    finally:
+      close_(fd)
+
+    # The status was reported by the time the file descriptor became
+    # readable.
+    pid_, status, _ = server.wait4(pid, WNOHANG)
+    self.assertEqual((pid_, status), (pid, 0))
+
+
+  def testNoSpuriousReaping(self):
+    """Verify that processes of the server are only attempted to be reaped once terminated."""
+    for function in (pipeline, lambda *args, **kwargs: run(pipelineAsync(*args, **kwargs))):
+      results = []
+
+      def reap(data):
+        """Reap a process, recording the result."""
+        results.append(_reap(data))
+        return results[-1]
+
+      def tryWaitpid(pid):
+        """Check for the termination of a process, recording the result."""
+        result = tryWaitpid_(pid)
+        results.append(result is not None)
+        return result
+
+      with patch("deso.execute.execute_._reap", side_effect=reap),\
+           patch("deso.execute.async_._tryWaitpid", side_effect=tryWaitpid):
+        for _ in range(5):
+          function([[_SLEEP, "0.05"], [_CAT]], stdout=b"", launcher=self._server)
+
+      # Each process is checked at most once before it terminated.
+      self.assertLessEqual(results.count(False), 10)
+      self.assertEqual(results.count(True), 10)
+
+
+  def testConcurrency(self):
+    """Verify that the fork server can be used by multiple threads and batches."""
+    results = []
+
+    def work():
+      """Execute a couple of commands."""
+      for _ in range(20):
+        results.append(execute(_ECHO, "test", stdout=b"", launcher=self._server))
+
+    threads = [Thread(target=work) for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(results, [(b"test\n", b"")] * 80)
+
+    batch = PipelineBatch(concurrency=4, launcher=self._server)
+    for _ in range(8):
+      batch.execute(_SLEEP, "0.1")
+    batch.execute(_FALSE)
+
+    results = batch.run()
+    self.assertEqual(results[:-1], [b""] * 8)
+    self.assertIsInstance(results[-1], ProcessError)
+
+
+  def testDefaultLauncher(self):
+    """Verify that the fork server can be set as the default launcher."""
+    setDefaultLauncher(self._server)
+    try:
+      out, _ = execute(_ECHO, "test", stdout=b"")
+      self.assertEqual(out, b"test\n")
+    finally:
+      setDefaultLauncher(FORK)
+
+    with self.assertRaises(ValueError):
+      setDefaultLauncher(object())
+
+
+  def testClose(self):
+    """Verify that a fork server can be used as a context manager."""
+    with ForkServer() as server:
+      out, _ = execute(_ECHO, "test", stdout=b"", launcher=server)
+      self.assertEqual(out, b"test\n")
+
+    server.close()
+
+
+if __name__ == "__main__":
+  main()
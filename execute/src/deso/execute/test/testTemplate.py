@@ -0,0 +1,164 @@
+# testAsync.py
+
+#/***************************************************************************
+# *   Copyright (C) 2018 Daniel Mueller (deso@posteo.net)                   *
+# *                                                                         *
+# *   This program is free software: you can redistribute it and/or modify  *
+# *   it under the terms of the GNU General Public License as published by  *
+# *   the Free Software Foundation, either version 3 of the License, or     *
+# *   (at your option) any later version.                                   *
+# *                                                                         *
+# *   This program is distributed in the hope that it will be useful,       *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+# *   GNU General Public License for more details.                          *
+# *                                                                         *
+# *   You should have received a copy of the GNU General Public License     *
+# *   along with this program.  If not, see <http://www.gnu.org/licenses/>. *
+# ***************************************************************************/
+
+
+"""Tests for command and pipeline templates."""
+
+from deso.execute import (
+  Command,
+  findCommand,
+  FORK,
+  ForkServer,
+  Pipeline,
+  ProcessError,
+  SPAWN,
+)
+from os import (
+  environ,
+)
+from unittest import (
+  TestCase,
+  main,
+)
+
+
+_FALSE = findCommand("false")
+_ECHO = findCommand("echo")
+_CAT = findCommand("cat")
+_TR = findCommand("tr")
+_ENV = findCommand("env")
+
+
+class TestTemplate(TestCase):
+  """A test case for templates."""
+  def testCommand(self):
+    """Verify that a command template can be executed repeatedly with varying arguments."""
+    with ForkServer() as server:
+      for launcher in (FORK, SPAWN, server):
+        echo = Command("echo", "hello", stdout=b"", stderr=None, launcher=launcher)
+        self.assertEqual(echo(), b"hello\n")
+        self.assertEqual(echo("world"), b"hello world\n")
+        self.assertEqual(echo("there"), b"hello there\n")
+        self.assertEqual(echo(b"bytes"), b"hello bytes\n")
+
+
+  def testCommandStdin(self):
+    """Verify that the input of a command template can be supplied on invocation."""
+    tr = Command(_TR, "a-z", "A-Z", stdout=b"", stderr=None)
+    self.assertEqual(tr(stdin=b"hello"), b"HELLO")
+    self.assertEqual(tr(stdin=b"world"), b"WORLD")
+
+
+  def testCommandEnvironment(self):
+    """Verify that the environment of a template is passed to the command."""
+    for launcher in (FORK, SPAWN):
+      env = Command(_ENV, env={"FOO": "bar", "BAZ": "qux"}, stdout=b"", stderr=None,
+                    launcher=launcher)
+      self.assertEqual(sorted(env().splitlines()), [b"BAZ=qux", b"FOO=bar"])
+
+
+  def testCommandInheritedEnvironment(self):
+    """Verify that a template without an environment uses the one at invocation time."""
+    env = Command(_ENV, stdout=b"", stderr=None)
+    environ["DESO_EXECUTE_TEMPLATE"] = "1"
+    try:
+      self.assertIn(b"DESO_EXECUTE_TEMPLATE=1", env().splitlines())
+    finally:
+      del environ["DESO_EXECUTE_TEMPLATE"]
+
+
+  def testCommandFailure(self):
+    """Verify that a failing template reports the command as given."""
+    false = Command(_FALSE)
+    with self.assertRaises(ProcessError) as e:
+      false("argument")
+
+    self.assertEqual(e.exception.status, 1)
+    self.assertEqual(e.exception.name, "{f} argument".format(f=_FALSE))
+
+
+  def testCommandValidation(self):
+    """Verify that invalid templates are rejected upon creation."""
+    with self.assertRaises(ValueError):
+      Command()
+
+    with self.assertRaises(FileNotFoundError):
+      Command("this-command-does-not-exist")
+
+    with self.assertRaises(FileNotFoundError):
+      Command("/this/command/does/not/exist")
+
+    with self.assertRaises(ValueError):
+      Command(_ENV, env={"A=B": "C"})
+
+    with self.assertRaises(TypeError):
+      Command(_ENV, this_option_does_not_exist=True)
+
+    # Options only applicable to pipelines are rejected for a command.
+    with self.assertRaises(TypeError):
+      Command(_ENV, timeouts=[1])
+
+    with self.assertRaises(TypeError):
+      Command(_ENV, stdout=b"")(timeouts=[1])
+
+
+  def testPipeline(self):
+    """Verify that a pipeline template can be executed repeatedly with varying input."""
+    with ForkServer() as server:
+      for launcher in (FORK, SPAWN, server):
+        upper = Pipeline([[_CAT], ["tr", "a-z", "A-Z"], [_CAT]], stdout=b"", stderr=None,
+                         launcher=launcher)
+        self.assertEqual(upper(stdin=b"hello"), b"HELLO")
+        self.assertEqual(upper(stdin=b"world"), b"WORLD")
+
+
+  def testPipelineCallable(self):
+    """Verify that a pipeline template can contain Python callables."""
+    def reverse(file_):
+      """Reverse the input."""
+      return [file_.read()[::-1]]
+
+    pipeline = Pipeline([[_CAT], reverse], stdout=b"", stderr=None)
+    self.assertEqual(pipeline(stdin=b"abc"), b"cba")
+    self.assertEqual(pipeline(stdin=b"xyz"), b"zyx")
+
+
+  def testPipelineValidation(self):
+    """Verify that invalid pipeline templates are rejected upon creation."""
+    with self.assertRaises(ValueError):
+      Pipeline([])
+
+    with self.assertRaises(ValueError):
+      Pipeline([[_CAT], []])
+
+    with self.assertRaises(ValueError):
+      Pipeline([[_CAT], _CAT])
+
+    with self.assertRaises(TypeError):
+      Pipeline([[_CAT]], this_option_does_not_exist=True)
+
+    cat = Pipeline([[_CAT], [_CAT]], stdout=b"", stderr=None, timeouts=[5, None])
+    self.assertEqual(cat(stdin=b"test"), b"test")
+
+    with self.assertRaises(TypeError):
+      cat(this_option_does_not_exist=True)
+
+
+if __name__ == "__main__":
+  main()
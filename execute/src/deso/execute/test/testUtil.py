@@ -20,11 +20,21 @@
 """Tests for the utility functionality."""
 
 from deso.execute import (
+  clearCommandCache,
+  commandCacheInfo,
+  findCommand,
+  findCommands,
   isExecutable,
 )
 from os import (
+  chdir,
+  chmod,
+  curdir,
+  environ,
   fchmod,
   fstat,
+  getcwd,
+  pathsep,
   unlink,
   symlink,
 )
@@ -45,6 +55,19 @@ from unittest import (
   TestCase,
   main,
 )
+from unittest.mock import (
+  patch,
+)
+
+
+def _createExecutable(directory, name):
+  """Create an executable file in the given directory."""
+  path = join(directory, name)
+  with open(path, "w"):
+    pass
+
+  chmod(path, S_IXUSR)
+  return path
 
 
 class TestExecute(TestCase):
@@ -73,5 +96,101 @@ class TestExecute(TestCase):
         self.assertTrue(isExecutable(link))
 
 
+  def testFindCommandCache(self):
+    """Verify that findCommand caches results and detects changes."""
+    with TemporaryDirectory() as d1, TemporaryDirectory() as d2:
+      with patch.dict(environ, {"PATH": pathsep.join([d1, d2])}):
+        clearCommandCache()
+        path = _createExecutable(d2, "foo")
+
+        self.assertEqual(findCommand("foo"), path)
+        self.assertEqual(commandCacheInfo(), (0, 1, 1))
+        self.assertEqual(findCommand("foo"), path)
+        self.assertEqual(commandCacheInfo(), (1, 1, 1))
+
+        # A command showing up in an earlier directory takes precedence.
+        path = _createExecutable(d1, "foo")
+        self.assertEqual(findCommand("foo"), path)
+        self.assertEqual(commandCacheInfo(), (1, 2, 1))
+
+        # Removal of a command is detected as well.
+        unlink(path)
+        unlink(join(d2, "foo"))
+        with self.assertRaises(FileNotFoundError):
+          findCommand("foo")
+
+        with self.assertRaises(FileNotFoundError):
+          findCommand("foo")
+
+        self.assertEqual(commandCacheInfo(), (2, 3, 1))
+
+        path = _createExecutable(d2, "foo")
+        self.assertEqual(findCommand("foo"), path)
+
+      # A different PATH results in a different cache entry.
+      with patch.dict(environ, {"PATH": d1}):
+        with self.assertRaises(FileNotFoundError):
+          findCommand("foo")
+
+      self.assertEqual(commandCacheInfo(), (2, 5, 2))
+      clearCommandCache()
+      self.assertEqual(commandCacheInfo(), (0, 0, 0))
+
+
+  def testFindCommands(self):
+    """Verify that multiple commands can be found at once."""
+    with TemporaryDirectory() as d1, TemporaryDirectory() as d2:
+      with patch.dict(environ, {"PATH": pathsep.join([d1, "/no/such/dir", d2])}):
+        clearCommandCache()
+        foo = _createExecutable(d1, "foo")
+        bar = _createExecutable(d2, "bar")
+        baz = _createExecutable(d2, "baz")
+        # A file that is not executable is not considered a command.
+        with open(join(d1, "bar"), "w"):
+          pass
+
+        commands = findCommands(["foo", "bar", "baz", baz])
+        self.assertEqual(commands, {"foo": foo, "bar": bar, "baz": baz, baz: baz})
+
+        # Results of findCommands are used by findCommand and vice versa.
+        self.assertEqual(findCommand("bar"), bar)
+        self.assertEqual(findCommands(["bar"]), {"bar": bar})
+        self.assertEqual(commandCacheInfo().hits, 2)
+
+        with self.assertRaisesRegex(FileNotFoundError, "qux"):
+          findCommands(["foo", "qux"])
+
+
+  def testFindCommandsRelativePath(self):
+    """Verify that findCommands treats empty PATH entries as findCommand does."""
+    cwd = getcwd()
+    self.addCleanup(chdir, cwd)
+
+    with TemporaryDirectory() as d1, TemporaryDirectory() as d2:
+      with patch.dict(environ, {"PATH": ":/bin"}):
+        clearCommandCache()
+        _createExecutable(d1, "foo")
+        foo = join(curdir, "foo")
+        chdir(d1)
+
+        self.assertEqual(findCommands(["foo", "sh"]), {"foo": foo, "sh": "/bin/sh"})
+        self.assertEqual(findCommand("foo"), foo)
+
+        clearCommandCache()
+        self.assertEqual(findCommand("foo"), foo)
+        self.assertEqual(findCommands(["foo"]), {"foo": foo})
+
+        # The result depends on the working directory.
+        chdir(d2)
+        with self.assertRaises(FileNotFoundError):
+          findCommand("foo")
+
+        with self.assertRaises(FileNotFoundError):
+          findCommands(["foo"])
+
+        chdir(d1)
+        self.assertEqual(findCommands(["foo"]), {"foo": foo})
+
+
 if __name__ == "__main__":
   main()
@@ -19,35 +19,202 @@
 
 """Utility functionality related to command execution."""
 
+from collections import (
+  namedtuple,
+)
 from os import (
   access,
+  curdir,
   environ,
+  getcwd,
+  listdir,
   pathsep,
+  sep,
+  stat,
   F_OK,
   X_OK,
 )
 from os.path import (
+  isabs,
   join,
 )
 
 
+# Statistics about the command cache, as reported by commandCacheInfo.
+CommandCacheInfo = namedtuple("CommandCacheInfo", ["hits", "misses", "size"])
+
+# The cache used by findCommand and findCommands. It maps (name, PATH)
+# pairs (along with the current working directory, if PATH contains
+# relative directories) to the resolved path (or None if the command was not found)
+# along with the modification times of all directories that had to be
+# searched to get to that result. If any of those directories changed,
+# the entry is stale. Note that changes to the permissions of a file do
+# not alter the modification time of the directory containing it and
+# are hence not detected.
+_cache = {}
+_hits = 0
+_misses = 0
+
+
 def isExecutable(path):
   """Check if the given path references an executable file."""
   return access(path, F_OK | X_OK)
 
 
-def findCommand(name):
-  """Given a name, find the path to a command."""
+def _path():
+  """Retrieve the value of the PATH environment variable."""
   try:
-    path = environ["PATH"]
+    return environ["PATH"]
   except KeyError:
     raise EnvironmentError("Unable to find PATH variable")
 
-  dirs = path.split(pathsep)
 
-  for d in dirs:
-    f = join(d, name)
-    if isExecutable(f):
-      return f
+def _directories(path):
+  """Retrieve the directories listed in a PATH value.
+
+    An empty entry denotes the current working directory.
+  """
+  return [d or curdir for d in path.split(pathsep)]
+
+
+def _key(name, path):
+  """Create the cache key for looking up a command in PATH."""
+  if all(isabs(d) for d in _directories(path)):
+    return name, path
+
+  # Relative directories are resolved against the current working
+  # directory, so the result depends on it.
+  return name, path, getcwd()
+
+
+def _mtime(directory):
+  """Retrieve the modification time of a directory, or None if it does not exist."""
+  try:
+    return stat(directory).st_mtime_ns
+  except OSError:
+    return None
+
+
+def _lookup(key):
+  """Look up a key as created by _key in the cache, returning whether it was found and the result."""
+  global _hits
+
+  entry = _cache.get(key)
+  if entry is not None:
+    result, mtimes = entry
+    if all(_mtime(d) == mtime for d, mtime in mtimes):
+      _hits += 1
+      return True, result
+
+  return False, None
+
+
+def _store(key, result, mtimes):
+  """Store the result of a lookup in the cache."""
+  global _misses
+
+  _misses += 1
+  _cache[key] = result, mtimes
+
+
+def _notFound(name, path):
+  """Create the error to raise if a command was not found."""
+  return FileNotFoundError("No command named '%s' found in PATH (%s)" % (name, path))
+
+
+def findCommand(name):
+  """Given a name, find the path to a command.
+
+    Results are cached. Each cached result is checked for being up to
+    date by comparing the modification times of the directories it got
+    resolved from against the ones they had back then.
+  """
+  path = _path()
+  key = _key(name, path)
+
+  found, result = _lookup(key)
+  if not found:
+    mtimes = []
+    result = None
+
+    for d in _directories(path):
+      # The modification time has to be retrieved before searching the
+      # directory. Otherwise we could miss a change.
+      mtimes += [(d, _mtime(d))]
+
+      f = join(d, name)
+      if isExecutable(f):
+        result = f
+        break
+
+    _store(key, result, mtimes)
+
+  if result is None:
+    raise _notFound(name, path)
+
+  return result
+
+
+def findCommands(names):
+  """Find the paths to a set of commands, returning a dict mapping names to paths.
+
+    In contrast to invoking findCommand for each name, this function
+    lists every directory in PATH at most once, no matter how many
+    commands are looked up. Results are shared with findCommand's cache.
+  """
+  path = _path()
+  result = {}
+  pending = set()
+
+  for name in names:
+    found, command = _lookup(_key(name, path))
+    if found:
+      if command is None:
+        raise _notFound(name, path)
+      result[name] = command
+    elif sep in name:
+      # Names containing a path separator never show up in a directory
+      # listing.
+      result[name] = findCommand(name)
+    else:
+      pending.add(name)
+
+  mtimes = []
+  for d in _directories(path):
+    if not pending:
+      break
+
+    mtimes += [(d, _mtime(d))]
+    try:
+      entries = listdir(d)
+    except OSError:
+      continue
+
+    for name in pending.intersection(entries):
+      f = join(d, name)
+      if isExecutable(f):
+        result[name] = f
+        pending.remove(name)
+        _store(_key(name, path), f, list(mtimes))
+
+  for name in pending:
+    _store(_key(name, path), None, mtimes)
+
+  if pending:
+    raise _notFound(sorted(pending)[0], path)
+
+  return result
+
+
+def commandCacheInfo():
+  """Retrieve statistics about the command cache in the form of a CommandCacheInfo object."""
+  return CommandCacheInfo(_hits, _misses, len(_cache))
+
+
+def clearCommandCache():
+  """Clear the command cache and reset its statistics."""
+  global _hits, _misses
 
-  raise FileNotFoundError("No command named '%s' found in PATH (%s)" % (name, path))
+  _cache.clear()
+  _hits = 0
+  _misses = 0